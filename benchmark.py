@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of the PGGAN building blocks, one per resolution level.
+Usage: python benchmark.py wscale --device cpu --resol 256
+"""
+import argparse
+import os
+import time
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from models.base_model import *
+from models.model import Generator, Discriminator
+from tests.references import blend_gselect_forward, reference_mbstat, sample_loop
+
+
+def timeit(fn, n_iter=10, n_warmup=2, device='cpu'):
+    """Mean wall time of fn() in ms."""
+    for _ in range(n_warmup):
+        fn()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(n_iter):
+        fn()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_iter * 1000.0
+
+
+def saved_activation_bytes(fn):
+    """Bytes of the tensors autograd saves for backward while running fn()."""
+    return saved_tensor_bytes(fn)[0]
+
+
+def peak_memory_bytes(fn, device='cpu'):
+    """Peak allocated memory on cuda, bytes saved for backward elsewhere."""
+    if not device.startswith('cuda'):
+        return saved_activation_bytes(fn)
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    fn()
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated() - base
+
+
+def get_nf(stage, fmap_base=8192, fmap_decay=1.0, fmap_max=512):
+    return min(int(fmap_base / (2.0 ** (stage * fmap_decay))), fmap_max)
+
+
+def build_G(args, **kwargs):
+    return Generator(num_channels=3, latent_size=512, resolution=args.resol, fmap_max=512, fmap_base=8192, **kwargs).to(args.device)
+
+
+def build_D(args, **kwargs):
+    return Discriminator(num_channels=3, resolution=args.resol, fmap_max=512, fmap_base=8192, **kwargs).to(args.device)
+
+
+def levels(args):
+    """(level, resolution, channels) of the conv blocks up to args.resol."""
+    R = int(np.log2(args.resol))
+    return [(I - 1, 2 ** I, get_nf(I - 1)) for I in range(2, R + 1)]
+
+
+def bench_wscale(args):
+    print('%-6s %-5s %14s %14s %12s %12s' % ('level', 'resol', 'act MB wscale', 'act MB fused', 'ms wscale', 'ms fused'))
+    for level, resol, nf in levels(args):
+        x = torch.randn(args.batch_size, nf, resol, resol, device=args.device, requires_grad=True)
+        conv = nn.Conv2d(nf, nf, 3, 1, 1)
+        legacy = nn.Sequential(conv, WScaleLayer(conv), nn.LeakyReLU(0.2)).to(args.device)
+        fused = nn.Sequential(EqualizedConv2d(nf, nf, 3, 1, 1), nn.LeakyReLU(0.2)).to(args.device)
+        result = []
+        for net in [legacy, fused]:
+            step = lambda: net(x).sum().backward()
+            result += [saved_activation_bytes(lambda: net(x).sum()) / 2.0**20]
+            result += [timeit(step, args.n_iter, device=args.device)]
+        print('%-6d %-5d %14.2f %14.2f %12.2f %12.2f' % ((level, resol) + tuple(result[0::2] + result[1::2])))
+
+
+def bench_select(args):
+    G = build_G(args)
+    z = torch.randn(args.batch_size, 512, device=args.device)
+    print('%-6s %-5s %12s %12s %8s' % ('level', 'resol', 'ms blend', 'ms fast', 'speedup'))
+    with torch.no_grad():  # same outputs, checked in tests/test_layers.py
+        for level, resol, _ in levels(args):
+            t_blend = timeit(lambda: blend_gselect_forward(G.output_layer, z, level), args.n_iter, device=args.device)
+            t_fast = timeit(lambda: G(z, cur_level=level), args.n_iter, device=args.device)
+            print('%-6d %-5d %12.2f %12.2f %7.2fx' % (level, resol, t_blend, t_fast, t_blend / t_fast))
+
+
+def bench_gdrop(args):
+    D = build_D(args)
+    print('%-6s %-5s %12s %12s' % ('level', 'resol', 'ms no noise', 'ms noise'))
+    with torch.no_grad():
+        for level, resol, _ in levels(args):
+            x = torch.randn(args.batch_size, 3, resol, resol, device=args.device)
+            t_off = timeit(lambda: D(x, cur_level=level, gdrop_strength=0.0), args.n_iter, device=args.device)
+            t_on = timeit(lambda: D(x, cur_level=level, gdrop_strength=0.2), args.n_iter, device=args.device)
+            print('%-6d %-5d %12.2f %12.2f' % (level, resol, t_off, t_on))
+
+
+def bench_gdrop_registry(args):
+    print('%-5s %-8s %14s %14s' % ('resol', '#modules', 'us traversal', 'us registry'))
+    for _, resol, _ in levels(args):
+        D = Discriminator(num_channels=3, resolution=resol, fmap_max=512, fmap_base=8192)
+
+        def traversal():
+            for strength in [0.1, 0.0, 0.0]:  # D(real), D(fake), D(fake) for G per iteration
+                for module in D.modules():
+                    if hasattr(module, 'strength'):
+                        module.strength = strength
+
+        def registry():
+            for strength in [0.1, 0.0, 0.0]:
+                D.set_gdrop_strength(strength)
+
+        n_modules = len(list(D.modules()))
+        t_traversal = timeit(traversal, args.n_iter * 100) / 3 * 1000
+        t_registry = timeit(registry, args.n_iter * 100) / 3 * 1000
+        print('%-5d %-8d %14.2f %14.2f' % (resol, n_modules, t_traversal, t_registry))
+
+
+def bench_mbstat(args):
+    nf = get_nf(1)
+    x = torch.randn(args.batch_size, nf, 4, 4, device=args.device)
+    print('%-10s %-10s %10s %12s %12s' % ('averaging', 'group_size', 'max err', 'ms layer', 'ms reference'))
+    for averaging in ['all', 'flat', 'spatial', 'none', 'gpool', 'group4']:
+        for group_size in [None, 2]:
+            layer = MinibatchStatConcatLayer(averaging, group_size)
+            ref = reference_mbstat(x, averaging, group_size)
+            err = (layer(x) - ref).abs().max().item()  # checked in tests/test_layers.py
+            t_layer = timeit(lambda: layer(x), args.n_iter, device=args.device)
+            t_ref = timeit(lambda: reference_mbstat(x, averaging, group_size), args.n_iter, device=args.device)
+            print('%-10s %-10s %10.2e %12.3f %12.3f' % (averaging, group_size, err, t_layer, t_ref))
+
+
+def bench_amp(args):
+    G, D = build_G(args), build_D(args)
+    device_type = torch.device(args.device).type
+    dtype = torch.bfloat16 if device_type == 'cpu' else torch.float16
+    print('%-6s %-5s %10s %10s %10s' % ('level', 'resol', 'ms fp32', 'ms ' + str(dtype)[6:], 'D out err'))
+    for level, resol, _ in levels(args):
+        z = torch.randn(args.batch_size, 512, device=args.device)
+        results = []
+        for enabled in [False, True]:
+            def step():
+                with torch.autocast(device_type, dtype=dtype, enabled=enabled):
+                    d = D(G(z, cur_level=level), cur_level=level)
+                torch.mean(d.float() ** 2).backward()
+                return d
+            results += [(timeit(step, args.n_iter, device=args.device), step().float())]
+        err = (results[0][1] - results[1][1]).abs().max().item()  # checked in tests/test_train.py
+        print('%-6d %-5d %10.2f %10.2f %10.2e' % (level, resol, results[0][0], results[1][0], err))
+
+
+def bench_growable(args):
+    print('%-9s %12s %12s %12s %12s' % ('growable', 'ms G init', 'ms D init', 'G params MB', 'D params MB'))
+    for growable in [False, True]:
+        start = time.time()
+        G = build_G(args, growable=growable)
+        t_G = (time.time() - start) * 1000
+        start = time.time()
+        D = build_D(args, growable=growable)
+        t_D = (time.time() - start) * 1000
+        mb = lambda net: sum(p.numel() * p.element_size() for p in net.parameters()) / 2.0**20
+        print('%-9s %12.1f %12.1f %12.2f %12.2f' % (growable, t_G, t_D, mb(G), mb(D)))
+    print('%-6s %-5s %12s %12s' % ('level', 'resol', 'G params MB', 'D params MB'))
+    for level, resol, _ in levels(args):
+        G.grow(level)
+        D.grow(level)
+        print('%-6d %-5d %12.2f %12.2f' % (level, resol, mb(G), mb(D)))
+
+
+def bench_checkpoint(args):
+    G, D = build_G(args), build_D(args)
+    print('%-6s %-5s %-12s %14s %14s %10s %10s' % ('level', 'resol', 'ckpt >=', 'MB no ckpt', 'MB ckpt', 'ms no ckpt', 'ms ckpt'))
+    for level, resol, _ in levels(args):
+        z = torch.randn(args.batch_size, 512, device=args.device)
+
+        def step():
+            d = D(G(z, cur_level=level), cur_level=level)
+            torch.mean(d ** 2).backward()
+
+        def forward():
+            return D(G(z, cur_level=level), cur_level=level)
+
+        result = []
+        for resolution in [None, max(4, resol // 2)]:
+            G.set_checkpoint(resolution)
+            D.set_checkpoint(resolution)
+            memory = peak_memory_bytes(step if args.device.startswith('cuda') else forward, args.device)
+            result += [memory / 2.0**20, timeit(step, args.n_iter, device=args.device)]
+        G.set_checkpoint()
+        D.set_checkpoint()
+        print('%-6d %-5d %-12d %14.2f %14.2f %10.2f %10.2f' % ((level, resol, max(4, resol // 2)) + tuple(result[0::2] + result[1::2])))
+
+
+def bench_fused(args):
+    print('%-6s %-5s %-4s %12s %12s %10s %10s %10s' % ('level', 'resol', 'op', 'act MB', 'act MB fused', 'ms', 'ms fused', 'max err'))
+    for level, resol, nf in levels(args)[1:]:
+        up = UpscaleConv2d(nf, nf, 3, 1, 1).to(args.device)
+        down = ConvDownscale2d(nf, nf, 3, 1, 1).to(args.device)
+        he_init(up, 'leaky_relu', 0.2)
+        he_init(down, 'leaky_relu', 0.2)
+        ops = [('up', resol // 2, lambda x: F.conv2d(F.interpolate(x, scale_factor=2, mode='nearest'), up.weight * up.scale, up.bias, padding=1), up),
+               ('down', resol, lambda x: F.avg_pool2d(F.conv2d(x, down.weight * down.scale, down.bias, padding=1), 2), down)]
+        for name, size, unfused, fused in ops:
+            x = torch.randn(args.batch_size, nf, size, size, device=args.device, requires_grad=True)
+            result = []
+            for net in [unfused, fused]:
+                result += [saved_activation_bytes(lambda: net(x).sum()) / 2.0**20]
+                result += [timeit(lambda: net(x).sum().backward(), args.n_iter, device=args.device)]
+            err = (unfused(x) - fused(x)).abs().max().item()  # checked in tests/test_layers.py
+            print('%-6d %-5d %-4s %12.2f %12.2f %10.2f %10.2f %10.2e' % ((level, resol, name) + tuple(result[0::2] + result[1::2]) + (err,)))
+    # The fused generator computes the same function, the fused discriminator pools before the activation.
+    G, G_fused = build_G(args), build_G(args, fused_scale=True)
+    G_fused.load_state_dict(dict(zip(G_fused.state_dict().keys(), G.state_dict().values())))
+    z = torch.randn(args.batch_size, 512, device=args.device)
+    with torch.no_grad():
+        err = max((G(z, cur_level=level) - G_fused(z, cur_level=level)).abs().max().item() for level, _, _ in levels(args))
+    print('Generator(fused_scale=True) max err over all levels: %.2e' % err)
+
+
+def bench_channels_last(args):
+    G, D = build_G(args), build_D(args)
+    G_cl, D_cl = build_G(args, channels_last=True), build_D(args, channels_last=True)
+    G_cl.load_state_dict(G.state_dict())
+    D_cl.load_state_dict(D.state_dict())
+    print('%-6s %-5s %10s %10s %10s' % ('level', 'resol', 'ms NCHW', 'ms NHWC', 'max err'))
+    for level, resol, _ in levels(args):
+        z = torch.randn(args.batch_size, 512, device=args.device)
+        result = []
+        for G_, D_ in [(G, D), (G_cl, D_cl)]:
+            step = lambda: torch.mean(D_(G_(z, cur_level=level), cur_level=level) ** 2).backward()
+            result += [timeit(step, args.n_iter, device=args.device)]
+        with torch.no_grad():
+            fake = G_cl(z, cur_level=level)
+            err = (D(G(z, cur_level=level), cur_level=level) - D_cl(fake, cur_level=level)).abs().max().item()  # checked in tests/test_layers.py
+        print('%-6d %-5d %10.2f %10.2f %10.2e' % ((level, resol) + tuple(result) + (err,)))
+
+
+def bench_export(args):
+    from models.export import freeze_generator, check_frozen
+    G = build_G(args).eval()
+    print('%-6s %-5s %10s %10s %12s %10s' % ('level', 'resol', 'ms G', 'ms frozen', 'ms scripted', 'max err'))
+    for level, resol, _ in levels(args):
+        frozen = freeze_generator(G, level)
+        scripted = torch.jit.script(frozen)
+        err = check_frozen(G, scripted, level)
+        z = torch.randn(args.batch_size, 512, device=args.device)
+        with torch.no_grad():
+            result = [timeit(lambda: G(z, cur_level=level), args.n_iter, device=args.device),
+                      timeit(lambda: frozen(z), args.n_iter, device=args.device),
+                      timeit(lambda: scripted(z), args.n_iter, device=args.device)]
+        print('%-6d %-5d %10.2f %10.2f %12.2f %10.2e' % ((level, resol) + tuple(result) + (err,)))
+
+
+def bench_quantize(args):
+    from models.export import freeze_generator
+    from models.quantize import quantize_generator, quantization_report
+    G = build_G(args).cpu().eval()
+    calibration, test = torch.randn(64, 512), torch.randn(32, 512)
+    print('%-6s %-5s %10s %10s %8s %10s %8s %8s' % ('level', 'resol', 'ms fp32', 'ms int8', 'speedup', 'MSE', 'PSNR', 'SSIM'))
+    for level, resol, _ in levels(args):
+        frozen = freeze_generator(G, level)
+        quantized = quantize_generator(frozen, calibration)
+        report = quantization_report(frozen, quantized, test)
+        z = torch.randn(args.batch_size, 512)
+        with torch.no_grad():
+            result = [timeit(lambda: frozen(z), args.n_iter), timeit(lambda: quantized(z), args.n_iter)]
+        print('%-6d %-5d %10.2f %10.2f %8.2f %10.3f %8.2f %8.4f' % (level, resol, result[0], result[1], result[0] / result[1],
+                                                                report['mse'], report['psnr'], report['ssim']))
+
+
+def bench_ema(args):
+    G = build_G(args)
+    Gs = build_G(args).requires_grad_(False)
+    params, ema_params = [p.detach() for p in G.parameters()], list(Gs.parameters())
+    beta = 0.999
+
+    def naive():
+        for p, ema_p in zip(params, ema_params):
+            ema_p.copy_(ema_p * beta + p * (1 - beta))
+
+    def foreach():
+        torch._foreach_lerp_(ema_params, params, 1 - beta)
+
+    print('%d tensors, %.1f MB' % (len(params), sum(p.numel() * p.element_size() for p in params) / 2.0**20))
+    print('%-16s %12s' % ('update', 'ms / iter'))
+    print('%-16s %12.3f' % ('per tensor', timeit(naive, args.n_iter, device=args.device)))
+    print('%-16s %12.3f' % ('foreach', timeit(foreach, args.n_iter, device=args.device)))
+    for every in [4, 16]:
+        print('%-16s %12.3f' % ('foreach every %d' % every, timeit(foreach, args.n_iter, device=args.device) / every))
+
+
+def _ddp_worker(rank, world_size, args, port, results):
+    """Times D and G steps at the top level with the global batch split across world_size ranks."""
+    os.environ['MASTER_ADDR'], os.environ['MASTER_PORT'] = '127.0.0.1', str(port)
+    cuda = args.device.startswith('cuda')
+    dist.init_process_group('nccl' if cuda else 'gloo', rank=rank, world_size=world_size)
+    if cuda:
+        args.device = 'cuda:%d' % rank
+        torch.cuda.set_device(args.device)
+    else:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))  # ranks share the cpu cores
+    torch.manual_seed(0)
+    G, D = build_G(args), build_D(args)
+    device_ids = [rank] if cuda else None
+    # to_rgb / from_rgb of the lower levels are unused at the top level
+    netG = DistributedDataParallel(G, device_ids=device_ids, find_unused_parameters=True, broadcast_buffers=False)
+    netD = DistributedDataParallel(D, device_ids=device_ids, find_unused_parameters=True, broadcast_buffers=False)
+    optim_G, optim_D = torch.optim.Adam(G.parameters()), torch.optim.Adam(D.parameters())
+    level = levels(args)[-1][0]
+    local_batch_size = args.batch_size // world_size
+    z = torch.randn(local_batch_size, 512, device=args.device)
+    x = torch.randn(local_batch_size, 3, args.resol, args.resol, device=args.device)
+
+    def step():
+        optim_D.zero_grad()
+        fake = netG(z, cur_level=level)
+        d = netD(torch.cat([x, fake.detach()]), cur_level=level)
+        torch.mean(d ** 2).backward()
+        optim_D.step()
+        optim_G.zero_grad()
+        D.requires_grad_(False)
+        torch.mean(D(fake, cur_level=level) ** 2).backward()
+        D.requires_grad_(True)
+        optim_G.step()
+
+    ms = timeit(step, args.n_iter, device=args.device)
+    if rank == 0:
+        results.put(ms)
+    dist.destroy_process_group()
+
+
+def bench_ddp(args):
+    max_world_size = torch.cuda.device_count() if args.device.startswith('cuda') else 2
+    print('%-6s %-5s %-10s %10s %12s %10s' % ('ranks', 'resol', 'batch/rank', 'ms / iter', 'images / s', 'scaling'))
+    base = None
+    for world_size in range(1, max_world_size + 1):
+        if args.batch_size % world_size:
+            continue
+        results = mp.get_context('spawn').SimpleQueue()
+        mp.spawn(_ddp_worker, args=(world_size, args, 29600 + world_size, results), nprocs=world_size)
+        images_per_s = args.batch_size / (results.get() / 1000.0)
+        base = base or images_per_s
+        print('%-6d %-5d %-10d %10.2f %12.1f %10.2f' % (world_size, args.resol, args.batch_size // world_size,
+                                                       args.batch_size / images_per_s * 1000, images_per_s, images_per_s / base))
+
+
+def bench_ckpt_writer(args):
+    import tempfile
+    from utils.checkpoint import CheckpointWriter
+    G, D = build_G(args), build_D(args)
+    state_dicts = lambda: {'G': G.state_dict(), 'D': D.state_dict()}
+    ckpt_dir = tempfile.mkdtemp()
+    print('%.1f MB per checkpoint' % (sum(p.numel() * p.element_size() for p in list(G.parameters()) + list(D.parameters())) / 2.0**20))
+
+    def sync_save():
+        for suffix, sd in state_dicts().items():
+            torch.save(sd, os.path.join(ckpt_dir, 'sync-%s.pth' % suffix))
+
+    writer = CheckpointWriter(ckpt_dir, keep_last=2)
+    blocked = []
+    for it in range(args.n_iter):
+        blocked += [writer.save('%dx%d-stabilize-%06d' % (args.resol, args.resol, it), state_dicts())]
+        time.sleep(0.5)  # training steps between saves
+    writer.close()
+    print('%-12s %16s' % ('writer', 'ms blocked'))
+    print('%-12s %16.2f' % ('torch.save', timeit(sync_save, args.n_iter, n_warmup=1)))
+    print('%-12s %16.2f' % ('background', np.mean(blocked) * 1000))
+    print('kept: %s' % sorted(os.listdir(ckpt_dir)))
+
+
+class _NullLogger(object):
+    def add_histogram(self, *args):
+        pass
+
+    def flush(self):
+        pass
+
+
+def bench_histograms(args):
+    from utils.histograms import HistogramSampler
+    G, D = build_G(args), build_D(args)
+    level = levels(args)[-1][0]
+    z = torch.randn(args.batch_size, 512, device=args.device)
+    torch.mean(D(G(z, cur_level=level), cur_level=level) ** 2).backward()
+    named_tensors = []
+    for name, net in [('G/', G), ('D/', D)]:
+        for tag, value in net.named_parameters():
+            named_tensors += [(name + tag, value), (name + tag + '/grad', value.grad)]
+    named_tensors = [(tag, t) for tag, t in named_tensors if t is not None]
+
+    def numpy_histograms():  # what Logger.histo_summary does for every tensor
+        for _, t in named_tensors:
+            values = t.detach().cpu().numpy()
+            np.histogram(values, bins=1000)
+            np.min(values), np.max(values), np.sum(values), np.sum(values ** 2)
+
+    print('%d tensors, %.1f MB' % (len(named_tensors), sum(t.numel() * t.element_size() for _, t in named_tensors) / 2.0**20))
+    print('%-20s %14s %14s' % ('histograms', 'ms blocked', 'tensors / call'))
+    print('%-20s %14.2f %14d' % ('numpy', timeit(numpy_histograms, args.n_iter, device=args.device), len(named_tensors)))
+    for budget_ms in [0, 50, 10]:
+        sampler = HistogramSampler(_NullLogger(), 1000, budget_ms=budget_ms)
+        n = []
+        ms = timeit(lambda: n.append(len(sampler(named_tensors, 0))), args.n_iter, device=args.device)
+        sampler.close()
+        print('%-20s %14.2f %14.1f' % ('histc budget %s ms' % (budget_ms or '-'), ms, np.mean(n)))
+
+
+def bench_logger(args):
+    import tempfile
+    start = time.time()
+    from utils.logger import Logger
+    print('import utils.logger: %.1f ms' % ((time.time() - start) * 1000))
+    logger = Logger(tempfile.mkdtemp())
+    values = np.random.randn(512 * 512 * 3 * 3).astype(np.float32)
+    counts, edges = np.histogram(values, bins=1000)
+    image = np.random.rand(args.resol, args.resol * 4, 3)
+    calls = [('scalar_summary', lambda: logger.scalar_summary('loss', 0.5, 0)),
+             ('add_histogram', lambda: logger.add_histogram('w', counts, edges, -1.0, 1.0, values.size, 0.0, 1.0, 0)),
+             ('image_summary', lambda: logger.image_summary('samples', [image], 0))]
+    print('%-16s %14s' % ('call', 'ms blocked'))
+    for name, fn in calls:
+        print('%-16s %14.3f' % (name, timeit(fn, args.n_iter * 10)))
+    start = time.time()
+    logger.close()
+    print('writer thread finished %.1f ms after the last call' % ((time.time() - start) * 1000))
+
+
+def bench_samples(args):
+    import tempfile
+    from utils.images import SampleWriter, grid_rows, sample_grid, to_png
+    d = tempfile.mkdtemp()
+    writer = SampleWriter()
+    print('%-6s %-6s %16s %16s' % ('batch', 'rows', 'loop+png ms', 'grid+queue ms'))
+    for batch_size in sorted(set([args.batch_size, 16, 32])):
+        n_row = grid_rows(batch_size)
+        fake = torch.randn(batch_size, 3, args.resol, args.resol, device=args.device)
+        real = torch.randn(batch_size, 3, args.resol, args.resol, device=args.device)
+
+        def loop():
+            with open(os.path.join(d, 'loop.png'), 'wb') as f:
+                f.write(to_png(sample_loop(fake, real, n_row)))
+        t_loop = timeit(loop, args.n_iter, device=args.device)
+        t_grid = timeit(lambda: writer.write(os.path.join(d, 'grid.png'), sample_grid(fake, real, n_row)),
+                        args.n_iter, device=args.device)
+        print('%-6d %-6d %16.2f %16.2f' % (batch_size, n_row, t_loop, t_grid))
+    start = time.time()
+    writer.close()
+    print('writer thread finished %.1f ms after the last call' % ((time.time() - start) * 1000))
+
+
+def bench_d_reg(args):
+    D = build_D(args, sigmoid_at_end=False)
+    every = args.reg_every
+    print('D step (WGAN loss + drift) with a gradient penalty every step or every %d steps (lazy), ms per step' % every)
+    print('%-6s %-5s %10s %10s %10s %10s %10s' % ('level', 'resol', 'no reg', 'gp', 'gp lazy', 'r1', 'r1 lazy'))
+    for level, resol, _ in levels(args):
+        real = torch.randn(args.batch_size, 3, resol, resol, device=args.device)
+        fake = torch.randn(args.batch_size, 3, resol, resol, device=args.device)
+        counter = [0]
+
+        def step(reg, k):
+            D.zero_grad(set_to_none=True)
+            reg = reg if counter[0] % k == 0 else None
+            counter[0] += 1
+            x_real = real.clone().requires_grad_(reg == 'r1')
+            inputs = [x_real, fake]
+            if reg == 'gp':
+                eps = torch.rand(args.batch_size, 1, 1, 1, device=args.device)
+                inputs += [torch.lerp(fake, real, eps).requires_grad_(True)]
+            outputs = [D(x, cur_level=level) for x in inputs]
+            loss = outputs[1].mean() - outputs[0].mean() + 1e-3 * (outputs[0] ** 2).mean()
+            if reg is not None:
+                x, out = (inputs[2], outputs[2]) if reg == 'gp' else (x_real, outputs[0])
+                grad, = torch.autograd.grad(out.sum(), x, create_graph=True)
+                norm = grad.flatten(1).norm(dim=1)
+                penalty = 10 * ((norm - 1) ** 2).mean() if reg == 'gp' else 5 * (norm ** 2).mean()
+                loss = loss + penalty * k
+            loss.backward()
+
+        n_iter = max(args.n_iter, every) // every * every  # whole lazy periods
+        times = [timeit(lambda: step(reg, k), n_iter, device=args.device)
+                 for reg, k in [(None, 1), ('gp', 1), ('gp', every), ('r1', 1), ('r1', every)]]
+        print('%-6d %-5d %10.2f %10.2f %10.2f %10.2f %10.2f' % ((level, resol) + tuple(times)))
+
+
+BENCHMARKS = {
+    'wscale': bench_wscale,
+    'select': bench_select,
+    'gdrop': bench_gdrop,
+    'gdrop_registry': bench_gdrop_registry,
+    'mbstat': bench_mbstat,
+    'amp': bench_amp,
+    'growable': bench_growable,
+    'checkpoint': bench_checkpoint,
+    'fused': bench_fused,
+    'channels_last': bench_channels_last,
+    'export': bench_export,
+    'quantize': bench_quantize,
+    'ema': bench_ema,
+    'ddp': bench_ddp,
+    'ckpt_writer': bench_ckpt_writer,
+    'histograms': bench_histograms,
+    'logger': bench_logger,
+    'samples': bench_samples,
+    'd_reg': bench_d_reg,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', choices=sorted(BENCHMARKS.keys()), help='which benchmark to run.')
+    parser.add_argument('--device', default='cpu', type=str, help='device to run on, e.g. cpu or cuda:0.')
+    parser.add_argument('--resol', default=128, type=int, help='highest resolution to benchmark.')
+    parser.add_argument('--batch_size', default=4, type=int, help='batch size.')
+    parser.add_argument('--n_iter', default=10, type=int, help='# timed iterations.')
+    parser.add_argument('--reg_every', default=16, type=int, help='d_reg: lazy regularization interval.')
+    args = parser.parse_args()
+    BENCHMARKS[args.bench](args)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Export a trained generator at one level for inference.
+Usage: python export.py --ckpt exp/2018-01-01 000000/ckpts/128x128-stabilize-105000-G.pth --level 6 --torchscript G.pt --onnx G.onnx
+"""
+import argparse
+from models.export import load_generator, freeze_generator, export_torchscript, export_onnx, check_frozen
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', required=True, type=str, help='generator checkpoint, e.g. 128x128-stabilize-105000-G.pth.')
+    parser.add_argument('--level', default=0, type=int, help='level to export, 0 means the highest level in the checkpoint.')
+    parser.add_argument('--tanh', action='store_true', help='the generator was trained with tanh at the end.')
+    parser.add_argument('--torchscript', default='', type=str, help='TorchScript output file.')
+    parser.add_argument('--onnx', default='', type=str, help='ONNX output file.')
+    parser.add_argument('--opset', default=13, type=int, help='ONNX opset version.')
+    parser.add_argument('--atol', default=1e-4, type=float, help='tolerance of the check against the training generator.')
+    args = parser.parse_args()
+
+    G = load_generator(args.ckpt, tanh_at_end=args.tanh)
+    level = args.level or G.output_layer.N
+    frozen = freeze_generator(G, level)
+    print(frozen)
+    print('Max abs difference to the training generator: %g' % check_frozen(G, frozen, level, atol=args.atol))
+    if args.torchscript:
+        scripted = export_torchscript(frozen, args.torchscript)
+        print('Max abs difference of TorchScript: %g' % check_frozen(G, scripted, level, atol=args.atol))
+        print('Saved %s' % args.torchscript)
+    if args.onnx:
+        export_onnx(frozen, args.onnx, G._latent_size, args.opset)
+        print('Saved %s' % args.onnx)
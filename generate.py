@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Generate images from a trained generator without the trainer.
+Usage: python generate.py --ckpt_dir "exp/2018-01-01 000000/ckpts" --which_file 128x128-fade_in-105000 --n_images 1000 --out samples
+An --out ending in .h5 or .npz writes one uint8 NHWC array instead of PNG files.
+Image i is generated from seed --seed + i, whatever the batch size.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+import PIL.Image
+import torch
+from models.export import load_generator, freeze_generator
+from utils.sampling import generator_path, find_ckpts, read_options, ckpt_level, latents, to_uint8, batch_size_for_budget
+
+
+def wait_pending(futures, max_pending):
+    """
+    futures: [(future, # images)] in submission order. Waits on the oldest while more than
+    max_pending images are pending, raises the errors of finished writes, returns the pending ones.
+    """
+    pending = sum(n for _, n in futures)
+    while futures and pending > max_pending:
+        future, n = futures.pop(0)
+        future.result()
+        pending -= n
+    return [(f, n) for f, n in futures if not f.done() or f.result()]
+
+
+class PNGWriter(object):
+    """Encodes and writes one PNG per image in a thread pool, with at most max_pending images queued."""
+    def __init__(self, out_dir, n_images, workers=4, max_pending=256):
+        self.out_dir = out_dir
+        self.n_digits = len(str(max(n_images - 1, 1)))
+        os.makedirs(out_dir, exist_ok=True)
+        self.pool = ThreadPoolExecutor(workers)
+        self.max_pending = max_pending
+        self.futures = []
+
+    def _save(self, index, image):
+        image = image[:, :, 0] if image.shape[2] == 1 else image
+        PIL.Image.fromarray(image).save(os.path.join(self.out_dir, '%s.png' % str(index).zfill(self.n_digits)))
+
+    def write(self, start, images):
+        self.futures += [(self.pool.submit(self._save, start + i, image), 1) for i, image in enumerate(images)]
+        self.futures = wait_pending(self.futures, self.max_pending)  # raises write errors early
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for f, _ in self.futures:
+            f.result()
+
+
+class ArrayWriter(object):
+    """
+    Writes all images into one HDF5 dataset or NPZ array from a single background thread,
+    with at most max_pending images queued.
+    """
+    def __init__(self, path, n_images, shape, max_pending=256):
+        self.path = path
+        if path.endswith('.h5'):
+            self.h5_file = h5py.File(path, 'w')
+            self.data = self.h5_file.create_dataset('images', (n_images,) + tuple(shape), dtype=np.uint8)
+        else:
+            self.h5_file = None
+            self.data = np.empty((n_images,) + tuple(shape), dtype=np.uint8)
+        self.pool = ThreadPoolExecutor(1)  # h5py is not thread safe
+        self.max_pending = max_pending
+        self.futures = []
+
+    def _save(self, start, images):
+        self.data[start:start + len(images)] = images
+
+    def write(self, start, images):
+        self.futures += [(self.pool.submit(self._save, start, images), len(images))]
+        self.futures = wait_pending(self.futures, self.max_pending)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for f, _ in self.futures:
+            f.result()
+        if self.h5_file is not None:
+            self.h5_file.close()
+        else:
+            np.savez(self.path, images=self.data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt_dir', required=True, type=str, help='ckpts dir of an experiment.')
+    parser.add_argument('--which_file', default='', type=str, help='checkpoint to use, e.g. 128x128-fade_in-105000, default the latest.')
+    parser.add_argument('--level', default=0, type=float, help='cur_level to generate at, 0 to infer it from the checkpoint name.')
+    parser.add_argument('--n_images', default=100, type=int, help='# images to generate.')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the first image.')
+    parser.add_argument('--out', default='generated', type=str, help='output dir for PNGs, or a .h5/.npz file.')
+    parser.add_argument('--batch_size', default=0, type=int, help='batch size, 0 to derive it from --memory_budget.')
+    parser.add_argument('--memory_budget', default=1024, type=float, help='activation memory budget per batch (MB).')
+    parser.add_argument('--workers', default=4, type=int, help='# threads encoding PNGs.')
+    parser.add_argument('--max_pending', default=0, type=int, help='# generated images waiting to be written before generation waits, 0 means two batches.')
+    parser.add_argument('--tanh', action='store_true', help='the generator was trained with tanh at the end.')
+    parser.add_argument('--no_ema', action='store_true', help='use the trained G instead of its moving average Gs.')
+    parser.add_argument('--int8', action='store_true', help='run an int8 quantized generator on cpu (integer levels only).')
+    parser.add_argument('--gpu', default='', type=str, help='gpu(s) to use.')
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    device = torch.device('cuda' if args.gpu else 'cpu')
+    which_file = args.which_file or find_ckpts(args.ckpt_dir)[-1]
+    G = load_generator(generator_path(args.ckpt_dir, which_file, not args.no_ema), tanh_at_end=args.tanh).to(device)
+    level = args.level or ckpt_level(which_file, read_options(os.path.dirname(os.path.abspath(args.ckpt_dir))))
+    batch_size = args.batch_size or batch_size_for_budget(G, level, args.memory_budget * 2**20)
+    net = freeze_generator(G, int(level)) if level == int(level) else (lambda z: G(z, cur_level=level))
+    if args.int8:
+        from models.quantize import quantize_generator
+        assert level == int(level) and device.type == 'cpu', 'int8 generation needs an integer level on cpu'
+        net = quantize_generator(net, torch.from_numpy(latents(range(2**32 - 64, 2**32), G._latent_size)))  # calibrate on the last seeds
+    resol = 2 ** int(np.ceil(level + 1))
+    print('Generating %d images from %s at level %g (%dx%d), batch size %d' % (args.n_images, which_file, level, resol, resol, batch_size))
+
+    max_pending = args.max_pending or 2 * batch_size
+    if args.out.endswith('.h5') or args.out.endswith('.npz'):
+        writer = ArrayWriter(args.out, args.n_images, (resol, resol, G.num_channels), max_pending)
+    else:
+        writer = PNGWriter(args.out, args.n_images, args.workers, max_pending)
+    start_time = time.time()
+    with torch.no_grad():
+        for start in range(0, args.n_images, batch_size):
+            seeds = range(args.seed + start, args.seed + min(start + batch_size, args.n_images))
+            z = torch.from_numpy(latents(seeds, G._latent_size)).to(device)
+            writer.write(start, to_uint8(net(z)).cpu().numpy())
+    gen_time = time.time() - start_time
+    writer.close()
+    print('Generated in %.2fs, written in %.2fs (%.1f images/s)' % (gen_time, time.time() - start_time, args.n_images / (time.time() - start_time)))
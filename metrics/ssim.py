@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Structural similarity (Wang et al. 2004, https://ece.uwaterloo.ca/~z70wang/publications/ssim.pdf)
+with an 11x11 gaussian window of sigma 1.5, computed per channel and averaged.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def gaussian_window(size=11, sigma=1.5, device=None, dtype=torch.float32):
+    x = torch.arange(size, device=device, dtype=dtype) - (size - 1) / 2.0
+    g = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    return g[:, None] * g[None, :]
+
+
+def ssim(x, y, data_range=2.0, window_size=11, sigma=1.5, k1=0.01, k2=0.03):
+    """SSIM of each pair of NCHW images in x and y, a tensor of N values."""
+    C = x.size(1)
+    window_size = min(window_size, x.size(2), x.size(3))  # small progressive levels
+    window = gaussian_window(window_size, sigma, x.device, x.dtype).expand(C, 1, window_size, window_size)
+    blur = lambda t: F.conv2d(t, window, groups=C)
+    mu_x, mu_y = blur(x), blur(y)
+    sigma_xx = blur(x * x) - mu_x ** 2
+    sigma_yy = blur(y * y) - mu_y ** 2
+    sigma_xy = blur(x * y) - mu_x * mu_y
+    c1, c2 = (k1 * data_range) ** 2, (k2 * data_range) ** 2
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (sigma_xx + sigma_yy + c2))
+    return ssim_map.mean(dim=[1, 2, 3])
@@ -4,15 +4,39 @@ import torch.nn as nn
 from torch.autograd import Variable
 from torch.nn.parameter import Parameter
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from torch.nn.init import kaiming_normal, calculate_gain
 import numpy as np
+import re
 import sys
+from collections import OrderedDict
 if sys.version_info.major == 3:
     from functools import reduce
 
 DEBUG = False
 
 
+def memory_format_of(x):
+    """torch.channels_last if the 4-d tensor x is stored NHWC, torch.contiguous_format otherwise."""
+    if x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+def cat_channels(tensors, memory_format=torch.contiguous_format):
+    """torch.cat(tensors, 1) into memory_format (cat falls back to NCHW when an input has a single channel)."""
+    if memory_format == torch.contiguous_format:
+        return torch.cat(tensors, 1)
+    x = tensors[0]
+    out = torch.empty((x.size(0), sum(t.size(1) for t in tensors)) + x.shape[2:],
+                      dtype=x.dtype, device=x.device, memory_format=memory_format)
+    c = 0
+    for t in tensors:
+        out[:, c:c + t.size(1)] = t
+        c += t.size(1)
+    return out
+
+
 class PixelNormLayer(nn.Module):
     """
     Pixelwise feature vector normalization.
@@ -22,7 +46,9 @@ class PixelNormLayer(nn.Module):
         self.eps = eps
     
     def forward(self, x):
-        return x / torch.sqrt(torch.mean(x ** 2, dim=1, keepdim=True) + 1e-8)
+        with torch.autocast(x.device.type, enabled=False):  # always normalize in fp32
+            y = x.float()
+            return (y / torch.sqrt(torch.mean(y ** 2, dim=1, keepdim=True) + self.eps)).to(x.dtype)
 
     def __repr__(self):
         return self.__class__.__name__ + '(eps = %s)' % self.eps
@@ -53,6 +79,108 @@ class WScaleLayer(nn.Module):
         return self.__class__.__name__ + param_str
 
 
+class EqualizedConv2d(nn.Conv2d):
+    """
+    Conv2d with equalized learning rate. Fused replacement of Conv2d + WScaleLayer:
+    the wscale constant is applied to the weight at call time and the bias is
+    passed to the convolution, so no extra full-size multiply/add is needed.
+    """
+    def __init__(self, *args, **kwargs):
+        super(EqualizedConv2d, self).__init__(*args, **kwargs)
+        self.scale = 1.0  # set by he_init
+
+    def forward(self, x):
+        return F.conv2d(x, self.weight * self.scale, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+    def extra_repr(self):
+        return super(EqualizedConv2d, self).extra_repr() + ', scale=%.4g' % self.scale
+
+
+def _fused_kernel(w):
+    """Sum a 3x3 kernel over the four positions a 2x2 block covers: the 4x4 kernel of fused_scale."""
+    w = F.pad(w, [1, 1, 1, 1])
+    return w[:, :, 1:, 1:] + w[:, :, :-1, 1:] + w[:, :, 1:, :-1] + w[:, :, :-1, :-1]
+
+
+class UpscaleConv2d(EqualizedConv2d):
+    """
+    Nearest neighbor 2x upsampling followed by a 3x3 conv (padding 1), fused into a
+    single transposed conv with a 4x4 kernel, without the 4x larger upsampled tensor.
+    """
+    def __init__(self, *args, **kwargs):
+        super(UpscaleConv2d, self).__init__(*args, **kwargs)
+        assert self.kernel_size == (3, 3) and self.padding == (1, 1) and self.stride == (1, 1)
+
+    def fused_weight(self):
+        return _fused_kernel(self.weight * self.scale).flip([2, 3]).transpose(0, 1)
+
+    def forward(self, x):
+        return F.conv_transpose2d(x, self.fused_weight(), self.bias, stride=2, padding=1)
+
+
+class ConvDownscale2d(EqualizedConv2d):
+    """
+    3x3 conv (padding 1) followed by 2x2 average pooling, fused into a single
+    stride 2 conv with a 4x4 kernel, without the full resolution conv output.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ConvDownscale2d, self).__init__(*args, **kwargs)
+        assert self.kernel_size == (3, 3) and self.padding == (1, 1) and self.stride == (1, 1)
+
+    def fused_weight(self):
+        return _fused_kernel(self.weight * self.scale) * 0.25
+
+    def forward(self, x):
+        return F.conv2d(x, self.fused_weight(), self.bias, stride=2, padding=1)
+
+
+def convert_wscale_state_dict(state_dict, model=None):
+    """
+    Map a checkpoint saved with Conv2d + WScaleLayer pairs onto the EqualizedConv2d layout.
+    Old layout: 'seq.{i}.weight', 'seq.{i+1}.incoming.weight', 'seq.{i+1}.bias'.
+    New layout: 'seq.{i}.weight', 'seq.{i}.bias'; following indices of the Sequential shift down.
+    State dicts that are already in the new layout are returned unchanged.
+
+    The wscale constant was never saved: WScaleLayer used the empirical scale sqrt(mean(w**2))
+    of the initial weights of the model the checkpoint was loaded into. Given model, freshly
+    initialized in the new layout, that scale is computed from the weights of its receiving
+    layers and folded into the loaded weights, so the outputs of the old loader are preserved.
+    Without model the He constant of the new layer is used as is.
+    """
+    pattern = re.compile(r'^(.*)\.(\d+)\.incoming\.weight$')
+    wscale_idx = {}  # Sequential prefix -> indices of WScaleLayers in it
+    for key in state_dict:
+        m = pattern.match(key)
+        if m:
+            wscale_idx.setdefault(m.group(1), []).append(int(m.group(2)))
+    if not wscale_idx:
+        return state_dict
+
+    new_state_dict = OrderedDict()
+    for key, value in state_dict.items():
+        prefix, idx, name = None, None, None
+        for p in wscale_idx:
+            m = re.match(r'^%s\.(\d+)\.(.*)$' % re.escape(p), key)
+            if m:
+                prefix, idx, name = p, int(m.group(1)), m.group(2)
+                break
+        if prefix is None:
+            new_state_dict[key] = value
+            continue
+        if idx in wscale_idx[prefix]:
+            if name == 'incoming.weight':  # same tensor as the preceding conv's weight
+                continue
+            idx -= 1  # wscale bias goes to the conv it follows
+        shift = len([i for i in wscale_idx[prefix] if i <= idx])
+        new_key = '%s.%d.%s' % (prefix, idx - shift, name)
+        if model is not None and name == 'weight' and idx + 1 in wscale_idx[prefix]:
+            # old weight * empirical scale == new weight * layer.scale
+            layer = model.get_submodule(new_key[:-len('.weight')])
+            value = value * (layer.weight.detach().float() * layer.scale).pow(2).mean().sqrt().item() / layer.scale
+        new_state_dict[new_key] = value
+    return new_state_dict
+
+
 def mean(tensor, axis, **kwargs):
     if isinstance(axis, int):
         axis = [axis]
@@ -63,45 +191,108 @@ def mean(tensor, axis, **kwargs):
 
 class MinibatchStatConcatLayer(nn.Module):
     """Minibatch stat concatenation layer.
-    - averaging tells how much averaging to use ('all', 'spatial', 'none')
+    - averaging tells how much averaging to use ('all', 'flat', 'spatial', 'none', 'gpool', 'group<n>')
+    - group_size splits the minibatch into groups of that many samples and computes the statistics
+      within each group (StyleGAN style), None uses the whole minibatch as one group
     """
-    def __init__(self, averaging='all'):
+    def __init__(self, averaging='all', group_size=None):
         super(MinibatchStatConcatLayer, self).__init__()
         self.averaging = averaging.lower()
         if 'group' in self.averaging:
             self.n = int(self.averaging[5:])
         else:
-            assert self.averaging in ['all', 'flat', 'spatial', 'none', 'gpool'], 'Invalid averaging mode'%self.averaging
+            assert self.averaging in ['all', 'flat', 'spatial', 'none', 'gpool'], 'Invalid averaging mode: %s' % self.averaging
+        self.group_size = group_size
         self.adjusted_std = lambda x, **kwargs: torch.sqrt(torch.mean((x - torch.mean(x, **kwargs)) ** 2, **kwargs) + 1e-8) #Tstdeps in the original implementation
+        self.pool = None  # MinibatchStatPool of accumulated micro-batches, only used without group_size
+
+    def num_new_features(self, in_channels):
+        """Number of feature maps this layer concatenates to an input with in_channels."""
+        if self.averaging in ['all', 'flat']:
+            return 1
+        elif self.averaging in ['spatial', 'none', 'gpool']:
+            return in_channels
+        else:
+            return self.n
 
     def forward(self, x):
-        shape = list(x.size())
-        target_shape = shape.copy()
-        vals = self.adjusted_std(x, dim=0, keepdim=True)# per activation, over minibatch dim
-        if self.averaging == 'all':  # average everything --> 1 value per minibatch
-            target_shape[1] = 1
-            vals = torch.mean(vals, dim=1, keepdim=True)#vals = torch.mean(vals, keepdim=True)
-
-        elif self.averaging == 'spatial':  # average spatial locations
-            if len(shape) == 4:
-                vals = mean(vals, axis=[2,3], keepdim=True)  # torch.mean(torch.mean(vals, 2, keepdim=True), 3, keepdim=True)
-        elif self.averaging == 'none':  # no averaging, pass on all information
-            target_shape = [target_shape[0]] + [s for s in target_shape[1:]]
-        elif self.averaging == 'gpool':  # EXPERIMENTAL: compute variance (func) over minibatch AND spatial locations.
-            if len(shape) == 4:
-                vals = mean(x, [0,2,3], keepdim=True)  # torch.mean(torch.mean(torch.mean(x, 2, keepdim=True), 3, keepdim=True), 0, keepdim=True)
+        N, C, H, W = x.size()
+        if self.pool is not None and self.group_size is None:
+            with torch.autocast(x.device.type, enabled=False):
+                y = x.float()
+                vals = self.pooled_stats(*self.pool.moments(self, y.sum(0), (y * y).sum(0), N))
+            vals = vals.to(x.dtype).expand(N, -1, H, W)
+            return cat_channels([x, vals], memory_format_of(x))
+        G = N if self.group_size is None else min(self.group_size, N)
+        assert N % G == 0, 'Minibatch size %d is not divisible by group size %d' % (N, G)
+        M = N // G
+        with torch.autocast(x.device.type, enabled=False):  # statistics in fp32
+            vals = self.stats(x.float().view(G, M, C, H, W))  # sample g*M+m is the g-th member of group m
+        vals = vals.to(x.dtype).repeat(G, 1, 1, 1).expand(N, -1, H, W)
+        return cat_channels([x, vals], memory_format_of(x)) # feature-map concatanation
+
+    def stats(self, y):
+        G, M, C, H, W = y.size()
+        if self.averaging == 'gpool':  # EXPERIMENTAL: compute variance (func) over minibatch AND spatial locations.
+            vals = torch.mean(y, dim=[0, 3, 4])[:, :, None, None]
         elif self.averaging == 'flat':  # variance of ALL activations --> 1 value per minibatch
-            target_shape[1] = 1
-            vals = torch.FloatTensor([self.adjusted_std(x)])
-        else:  # self.averaging == 'group'  # average everything over n groups of feature maps --> n values per minibatch
-            target_shape[1] = self.n
-            vals = vals.view(self.n, self.shape[1]/self.n, self.shape[2], self.shape[3])
-            vals = mean(vals, axis=0, keepdim=True).view(1, self.n, 1, 1)
-        vals = vals.expand(*target_shape)
-        return torch.cat([x, vals], 1) # feature-map concatanation
+            vals = self.adjusted_std(y, dim=[0, 2, 3, 4], keepdim=True)[0]
+        else:
+            vals = self.adjusted_std(y, dim=0, keepdim=True)[0]  # per activation, over minibatch dim
+            if self.averaging == 'all':  # average everything --> 1 value per minibatch
+                vals = torch.mean(vals, dim=1, keepdim=True)
+            elif self.averaging == 'spatial':  # average spatial locations
+                vals = torch.mean(vals, dim=[2, 3], keepdim=True)
+            elif self.averaging == 'none':  # no averaging, pass on all information
+                pass
+            else:  # self.averaging == 'group'  # average everything over n groups of feature maps --> n values per minibatch
+                assert C % self.n == 0, 'Feature maps %d are not divisible into %d groups' % (C, self.n)
+                vals = torch.mean(vals.reshape(M, self.n, -1), dim=2)[:, :, None, None]
+        return vals
+
+    def pooled_stats(self, s1, s2, n):
+        """stats() of a single group given by the sums of its samples and their squares (CxHxW) and its size."""
+        mean = s1 / n
+        if self.averaging == 'gpool':
+            return torch.mean(mean, dim=[1, 2])[None, :, None, None]
+        if self.averaging == 'flat':
+            m = mean.mean()
+            return torch.sqrt(torch.clamp(s2.sum() / (n * s2.numel()) - m * m, min=0) + 1e-8).reshape(1, 1, 1, 1)
+        vals = torch.sqrt(torch.clamp(s2 / n - mean * mean, min=0) + 1e-8)[None]
+        if self.averaging == 'all':
+            vals = torch.mean(vals, dim=1, keepdim=True)
+        elif self.averaging == 'spatial':
+            vals = torch.mean(vals, dim=[2, 3], keepdim=True)
+        elif self.averaging != 'none':
+            assert vals.size(1) % self.n == 0, 'Feature maps %d are not divisible into %d groups' % (vals.size(1), self.n)
+            vals = torch.mean(vals.reshape(1, self.n, -1), dim=2)[:, :, None, None]
+        return vals
 
     def __repr__(self):
-        return self.__class__.__name__ + '(averaging = %s)' % (self.averaging)
+        return self.__class__.__name__ + '(averaging = %s, group_size = %s)' % (self.averaging, self.group_size)
+
+
+class MinibatchStatPool(object):
+    """
+    Minibatch statistics over several micro-batches for gradient accumulation. A no-grad pass
+    over every micro-batch with collecting = True records each MinibatchStatConcatLayer's sums,
+    the training pass of micro-batch `index` then uses the sums of the other micro-batches plus
+    its own: the statistics of the whole accumulated batch, with gradients through the current
+    micro-batch only.
+    """
+    def __init__(self):
+        self.sums = {}  # layer: [(sum, sum of squares, count) of each micro-batch]
+        self.collecting = True
+        self.index = 0
+
+    def moments(self, layer, s1, s2, n):
+        if self.collecting:
+            self.sums.setdefault(layer, []).append((s1.detach(), s2.detach(), n))
+            return s1, s2, n
+        for i, (o1, o2, m) in enumerate(self.sums[layer]):
+            if i != self.index:
+                s1, s2, n = s1 + o1, s2 + o2, n + m
+        return s1, s2, n
 
 
 class MinibatchDiscriminationLayer(nn.Module):
@@ -117,35 +308,49 @@ class GDropLayer(nn.Module):
     """
     # Generalized dropout layer. Supports arbitrary subsets of axes and different
     # modes. Mainly used to inject multiplicative Gaussian noise in the network.
+    # The noise is drawn on the input's device, optionally from a seeded generator.
     """
-    def __init__(self, mode='mul', strength=0.2, axes=(0,1), normalize=False):
+    def __init__(self, mode='mul', strength=0.2, axes=(0,1), normalize=False, seed=None):
         super(GDropLayer, self).__init__()
         self.mode = mode.lower()
-        assert self.mode in ['mul', 'drop', 'prop'], 'Invalid GDropLayer mode'%mode
+        assert self.mode in ['mul', 'drop', 'prop'], 'Invalid GDropLayer mode: %s' % mode
         self.strength = strength
         self.axes = [axes] if isinstance(axes, int) else list(axes)
         self.normalize = normalize
         self.gain = None
+        self.manual_seed(seed)
+
+    def manual_seed(self, seed):
+        """Seed the noise of this layer, None uses torch's default generators."""
+        self.seed = seed
+        self._generators = {}  # one generator per device
+
+    def _generator(self, device):
+        if self.seed is None:
+            return None
+        if device not in self._generators:
+            self._generators[device] = torch.Generator(device=device)
+            self._generators[device].manual_seed(self.seed)
+        return self._generators[device]
 
     def forward(self, x, deterministic=False):
-        if deterministic or not self.strength:
+        # a tensor strength stays on the device, zero strength then draws noise of scale zero
+        if deterministic or (not torch.is_tensor(self.strength) and not self.strength):
             return x
 
         rnd_shape = [s if axis in self.axes else 1 for axis, s in enumerate(x.size())]  # [x.size(axis) for axis in self.axes]
+        generator = self._generator(x.device)
         if self.mode == 'drop':
             p = 1 - self.strength
-            rnd = np.random.binomial(1, p=p, size=rnd_shape) / p
+            rnd = torch.empty(rnd_shape, device=x.device, dtype=x.dtype).bernoulli_(p, generator=generator) / p
         elif self.mode == 'mul':
-            rnd = (1 + self.strength) ** np.random.normal(size=rnd_shape)
+            rnd = (1 + self.strength) ** torch.randn(rnd_shape, device=x.device, dtype=x.dtype, generator=generator)
         else:
             coef = self.strength * x.size(1) ** 0.5
-            rnd = np.random.normal(size=rnd_shape) * coef + 1
+            rnd = torch.randn(rnd_shape, device=x.device, dtype=x.dtype, generator=generator) * coef + 1
 
         if self.normalize:
-            rnd = rnd / np.linalg.norm(rnd, keepdims=True)
-        rnd = Variable(torch.from_numpy(rnd).type(x.data.type()))
-        if x.is_cuda:
-            rnd = rnd.cuda()
+            rnd = rnd / torch.norm(rnd)
         return x * rnd
 
     def __repr__(self):
@@ -191,10 +396,11 @@ def resize_activations(v, so):
     si = list(v.size())
     so = list(so)
     assert len(si) == len(so) and si[0] == so[0]
+    memory_format = memory_format_of(v)
 
     # Decrease feature maps.
     if si[1] > so[1]:
-        v = v[:, :so[1]]
+        v = v[:, :so[1]].contiguous(memory_format=memory_format)
 
     # Shrink spatial axes.
     if len(si) == 4 and (si[2] > so[2] or si[3] > so[3]):
@@ -213,15 +419,77 @@ def resize_activations(v, so):
     # v = v.repeat(*shape)
     if si[2] < so[2]: 
         assert so[2] % si[2] == 0 and so[2] / si[2] == so[3] / si[3]  # currently only support this case
-        v = F.upsample(v, scale_factor=so[2]//si[2], mode='nearest')
+        v = F.interpolate(v, scale_factor=so[2]//si[2], mode='nearest')
 
     # Increase feature maps.
     if si[1] < so[1]:
-        z = torch.zeros((v.shape[0], so[1] - si[1]) + so[2:])
-        v = torch.cat([v, z], 1)
+        v = cat_channels([v, v.new_zeros([v.shape[0], so[1] - si[1]] + so[2:])], memory_format)
     return v
 
 
+def checkpoint_block(block, *args):
+    """
+    Run block with gradient checkpointing: its activations are recomputed during backward.
+    The recomputation runs with the state of the forward, which later calls may have changed:
+    GDropLayer strengths, seeded GDropLayer generators (rewound) and the MinibatchStatPool of
+    minibatch stddev layers. torch's default generators are restored by checkpoint itself.
+    """
+    saved = []  # (object, attribute, value at the forward)
+    generators = []  # (generator, state at the forward)
+    for m in block.modules():
+        if isinstance(m, GDropLayer):
+            saved += [(m, 'strength', m.strength)]
+            generator = m._generator(args[0].device)
+            if generator is not None:
+                generators += [(generator, generator.get_state())]
+        elif isinstance(m, MinibatchStatConcatLayer):
+            saved += [(m, 'pool', m.pool)]
+            if m.pool is not None:
+                saved += [(m.pool, 'collecting', m.pool.collecting), (m.pool, 'index', m.pool.index)]
+
+    def run(*args):
+        live = [(obj, name, getattr(obj, name)) for obj, name, _ in saved]
+        live_generators = [(generator, generator.get_state()) for generator, _ in generators]
+        for obj, name, value in saved:
+            setattr(obj, name, value)
+        for generator, state in generators:
+            generator.set_state(state)
+        try:
+            return block(*args)
+        finally:
+            for obj, name, value in live:
+                setattr(obj, name, value)
+            for generator, state in live_generators:
+                generator.set_state(state)
+    return checkpoint(run, *args, use_reentrant=False, preserve_rng_state=True)
+
+
+def saved_tensor_bytes(fn, *args):
+    """Run fn(*args), return (bytes of the tensors autograd saves for backward, output)."""
+    storages = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn(*args)
+    return sum(storages.values()), out
+
+
+def plan_checkpoint(level_bytes, memory_budget):
+    """Levels to checkpoint, largest first, until the stored activations of the others fit in memory_budget."""
+    levels = set()
+    total = sum(level_bytes.values())
+    for level in sorted(level_bytes, key=level_bytes.get, reverse=True):
+        if total <= memory_budget:
+            break
+        levels.add(level)
+        total -= level_bytes[level]
+    return levels
+
+
 class GSelectLayer(nn.Module):
     def __init__(self, pre, chain, post):
         super(GSelectLayer, self).__init__()
@@ -230,6 +498,13 @@ class GSelectLayer(nn.Module):
         self.chain = chain
         self.post = post
         self.N = len(self.chain)
+        self.checkpoint_levels = set()  # levels recomputed in backward instead of storing activations
+
+    def run_level(self, level, x, y=None, insert_y_at=None):
+        args = (x, y) if level == insert_y_at else (x,)
+        if level in self.checkpoint_levels and torch.is_grad_enabled():
+            return checkpoint_block(self.chain[level], *args)
+        return self.chain[level](*args)
 
     def forward(self, x, y=None, cur_level=None, insert_y_at=None):
         if cur_level is None:
@@ -238,7 +513,7 @@ class GSelectLayer(nn.Module):
             assert insert_y_at is not None
 
         min_level, max_level = int(np.floor(cur_level-1)), int(np.ceil(cur_level-1))
-        min_level_weight, max_level_weight = int(cur_level+1)-cur_level, cur_level-int(cur_level)
+        max_level_weight = cur_level-int(cur_level)
         
         _from, _to, _step = 0, max_level+1, 1
 
@@ -249,20 +524,18 @@ class GSelectLayer(nn.Module):
         if DEBUG:
             print('G: level=%s, size=%s' % ('in', x.size()))
         for level in range(_from, _to, _step):
-            if level == insert_y_at:
-                x = self.chain[level](x, y)
-            else:
-                x = self.chain[level](x)
+            x = self.run_level(level, x, y, insert_y_at)
 
             if DEBUG:
                 print('G: level=%d, size=%s' % (level, x.size()))
 
-            if level == min_level:
+            if level == max_level and min_level == max_level:  # stabilize: a single to_rgb, nothing to blend
+                x = self.post[level](x)
+            elif level == min_level:
                 out['min_level'] = self.post[level](x)
-            if level == max_level:
+            elif level == max_level:
                 out['max_level'] = self.post[level](x)
-                x = resize_activations(out['min_level'], out['max_level'].size()) * min_level_weight + \
-                        out['max_level'] * max_level_weight
+                x = torch.lerp(resize_activations(out['min_level'], out['max_level'].size()), out['max_level'], max_level_weight)
         if DEBUG:
             print('G:', x.size())
         return x
@@ -276,6 +549,13 @@ class DSelectLayer(nn.Module):
         self.chain = chain
         self.inputs = inputs
         self.N = len(self.chain)
+        self.checkpoint_levels = set()  # levels recomputed in backward instead of storing activations
+
+    def run_level(self, level, x, y=None, insert_y_at=None):
+        args = (x, y) if level == insert_y_at else (x,)
+        if level in self.checkpoint_levels and torch.is_grad_enabled():
+            return checkpoint_block(self.chain[level], *args)
+        return self.chain[level](*args)
 
     def forward(self, x, y=None, cur_level=None, insert_y_at=None):
         if cur_level is None:
@@ -284,7 +564,7 @@ class DSelectLayer(nn.Module):
             assert insert_y_at is not None
 
         max_level, min_level = int(np.floor(self.N-cur_level)), int(np.ceil(self.N-cur_level))
-        min_level_weight, max_level_weight = int(cur_level+1)-cur_level, cur_level-int(cur_level)
+        max_level_weight = cur_level-int(cur_level)
         
         _from, _to, _step = min_level+1, self.N, 1
 
@@ -296,31 +576,18 @@ class DSelectLayer(nn.Module):
 
         if max_level == min_level:
             x = self.inputs[max_level](x)
-            if max_level == insert_y_at:
-                x = self.chain[max_level](x, y)
-            else:
-                x = self.chain[max_level](x)
+            x = self.run_level(max_level, x, y, insert_y_at)
         else:
             out = {}
             tmp = self.inputs[max_level](x)
-            if max_level == insert_y_at:
-                tmp = self.chain[max_level](tmp, y)
-            else:
-                tmp = self.chain[max_level](tmp)
+            tmp = self.run_level(max_level, tmp, y, insert_y_at)
             out['max_level'] = tmp
             out['min_level'] = self.inputs[min_level](x)
-            x = resize_activations(out['min_level'], out['max_level'].size()) * min_level_weight + \
-                                out['max_level'] * max_level_weight
-            if min_level == insert_y_at:
-                x = self.chain[min_level](x, y)
-            else:
-                x = self.chain[min_level](x)
+            x = torch.lerp(resize_activations(out['min_level'], out['max_level'].size()), out['max_level'], max_level_weight)
+            x = self.run_level(min_level, x, y, insert_y_at)
 
         for level in range(_from, _to, _step):
-            if level == insert_y_at:
-                x = self.chain[level](x, y)
-            else:
-                x = self.chain[level](x)
+            x = self.run_level(level, x, y, insert_y_at)
 
             if DEBUG:
                 print('D: level=%d, size=%s' % (level, x.size()))
@@ -477,5 +744,11 @@ def he_init(layer, nonlinearity='conv2d', param=None):
         gain = calculate_gain(nonlinearity, param)
     else:
         gain = calculate_gain(nonlinearity)
-    kaiming_normal(layer.weight, a=gain)
+    if isinstance(layer, EqualizedConv2d):
+        # unit variance weights, He's constant is applied at runtime
+        fan_in = layer.weight.data[0].numel()
+        layer.weight.data.normal_()
+        layer.scale = calculate_gain('leaky_relu', gain) / np.sqrt(fan_in)
+    else:
+        kaiming_normal(layer.weight, a=gain)
 
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Inference export of a trained Generator at one fixed level: the blocks of that level
+only, equalized learning rate folded into the conv weights and no level selection,
+so the result can be compiled with TorchScript or exported to ONNX.
+"""
+import copy
+import torch
+import torch.nn as nn
+from models.base_model import *
+from models.model import Generator
+
+
+class FrozenPixelNorm(nn.Module):
+    """Scriptable PixelNormLayer."""
+    def __init__(self, eps=1e-8):
+        super(FrozenPixelNorm, self).__init__()
+        self.eps = eps
+
+    def forward(self, x):
+        return x * torch.rsqrt(torch.mean(x * x, dim=1, keepdim=True) + self.eps)
+
+
+def load_generator(path, num_channels=3, fmap_base=8192, fmap_max=512, tanh_at_end=False, map_location='cpu', **kwargs):
+    """
+    Generator restored from a '-G.pth' checkpoint. The number of levels, the latent size and
+    whether fused_scale was used are read from the weights, the rest defaults to train.py's
+    configuration (which never adds the final tanh).
+    """
+    saved = torch.load(path, map_location=map_location)
+    state_dict = convert_wscale_state_dict(saved)  # the layout only, G.load_state_dict converts the weights
+    chain = [k.split('.') for k in state_dict if k.startswith('output_layer.chain.')]
+    N = max(int(k[2]) for k in chain) + 1
+    latent_size = state_dict['output_layer.chain.0.1.weight'].size(1)
+    if 'fused_scale' not in kwargs:  # fused blocks have no Upsample in front of their first conv
+        kwargs['fused_scale'] = any(int(k[2]) > 0 and k[3] == '0' for k in chain)
+    G = Generator(num_channels=num_channels, latent_size=latent_size, resolution=2 ** (N + 1),
+                  fmap_base=fmap_base, fmap_max=fmap_max, tanh_at_end=tanh_at_end, **kwargs)
+    G.load_state_dict(saved)
+    return G.eval()
+
+
+def freeze_layer(layer):
+    """Plain torch equivalent of a Generator layer."""
+    if isinstance(layer, UpscaleConv2d):
+        w = layer.fused_weight()
+        frozen = nn.ConvTranspose2d(w.size(0), w.size(1), 4, stride=2, padding=1, bias=layer.bias is not None)
+        frozen.weight.data.copy_(w.data)
+    elif isinstance(layer, nn.Conv2d):  # EqualizedConv2d or plain Conv2d
+        frozen = nn.Conv2d(layer.in_channels, layer.out_channels, layer.kernel_size, layer.stride, layer.padding,
+                           layer.dilation, layer.groups, bias=layer.bias is not None)
+        frozen.weight.data.copy_(layer.weight.data * getattr(layer, 'scale', 1.0))
+    elif isinstance(layer, PixelNormLayer):
+        return FrozenPixelNorm(layer.eps)
+    elif isinstance(layer, ReshapeLayer):
+        return nn.Unflatten(1, layer.new_shape)
+    elif isinstance(layer, (nn.Upsample, nn.LeakyReLU, nn.ReLU, nn.Tanh, nn.Sigmoid, nn.BatchNorm2d)):
+        return copy.deepcopy(layer)
+    else:
+        raise NotImplementedError('Cannot freeze %s' % layer.__class__.__name__)
+    if layer.bias is not None:
+        frozen.bias.data.copy_(layer.bias.data)
+    return frozen
+
+
+def fuse_upsample(layers):
+    """Replace nearest 2x Upsample + 3x3 conv pairs by the equivalent UpscaleConv2d."""
+    fused = []
+    for layer in layers:
+        prev = fused[-1] if fused else None
+        if (isinstance(prev, nn.Upsample) and prev.mode == 'nearest' and prev.scale_factor in [2, 2.0, (2.0, 2.0)]
+                and type(layer) in [EqualizedConv2d, nn.Conv2d]
+                and layer.kernel_size == (3, 3) and layer.padding == (1, 1) and layer.stride == (1, 1)):
+            up = UpscaleConv2d(layer.in_channels, layer.out_channels, 3, 1, 1, bias=layer.bias is not None)
+            up.to(layer.weight.device, layer.weight.dtype)
+            up.weight.data.copy_(layer.weight.data)
+            up.scale = getattr(layer, 'scale', 1.0)
+            if layer.bias is not None:
+                up.bias.data.copy_(layer.bias.data)
+            fused[-1] = up
+        else:
+            fused += [layer]
+    return fused
+
+
+def freeze_generator(G, level=None):
+    """
+    nn.Sequential computing G(z, cur_level=level) for an integer level (default: all levels):
+    the blocks up to that level and its to_rgb layer, with upsampling fused into transposed
+    convs and the equalized learning rate folded into the weights.
+    """
+    layer = G.output_layer
+    level = layer.N if level is None else level
+    assert level == int(level) and 1 <= level <= layer.N, 'Only integer levels in [1, %d] can be frozen' % layer.N
+    assert not G.label_size, 'Conditional generators are not supported'
+    G.grow(level)
+    layers = [layer.pre] if layer.pre is not None else []
+    for i in range(int(level)):
+        layers += list(layer.chain[i])
+    layers += list(layer.post[int(level) - 1])
+    frozen = nn.Sequential(*[freeze_layer(m) for m in fuse_upsample(layers)])
+    p = next(G.parameters())
+    return frozen.to(p.device, p.dtype).eval()
+
+
+def export_torchscript(frozen, path):
+    """Compile the frozen generator with TorchScript and save it to path."""
+    scripted = torch.jit.script(frozen)
+    scripted.save(path)
+    return scripted
+
+
+def export_onnx(frozen, path, latent_size, opset_version=13):
+    """Export the frozen generator to ONNX with a dynamic batch dimension."""
+    p = next(frozen.parameters())
+    z = torch.randn(1, latent_size, device=p.device, dtype=p.dtype)
+    kwargs = {'dynamo': False} if 'dynamo' in torch.onnx.export.__code__.co_varnames else {}
+    torch.onnx.export(frozen, z, path, input_names=['latent'], output_names=['image'], opset_version=opset_version,
+                      dynamic_axes={'latent': {0: 'batch'}, 'image': {0: 'batch'}}, **kwargs)
+
+
+def check_frozen(G, frozen, level=None, batch_size=8, atol=1e-4):
+    """Max abs difference between the training generator and the frozen one, asserts it is below atol."""
+    level = G.output_layer.N if level is None else level
+    p = next(G.parameters())
+    z = torch.randn(batch_size, G._latent_size, device=p.device, dtype=p.dtype)
+    with torch.no_grad():
+        err = (G(z, cur_level=level) - frozen(z)).abs().max().item()
+    assert err < atol, 'Frozen generator differs by %g' % err
+    return err
@@ -2,13 +2,21 @@
 from models.base_model import *
 
 
+def conv_layer(in_channels, out_channels, kernel_size, padding, use_wscale=True, fused_scale=None):
+    # fused_scale: 'up' fuses a preceding 2x upsampling, 'down' a following 2x average pooling (requires wscale)
+    if fused_scale is not None:
+        assert use_wscale, 'fused_scale requires use_wscale'
+        conv = {'up': UpscaleConv2d, 'down': ConvDownscale2d}[fused_scale]
+    else:
+        conv = EqualizedConv2d if use_wscale else nn.Conv2d
+    return conv(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=1, padding=padding)
+
+
 def G_conv(incoming, in_channels, out_channels, kernel_size, padding, nonlinearity, init, param=None, 
-        to_sequential=True, use_wscale=True, use_batchnorm=False, use_pixelnorm=True):
+        to_sequential=True, use_wscale=True, use_batchnorm=False, use_pixelnorm=True, fused_scale=None):
     layers = incoming
-    layers += [nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=1, padding=padding)]
+    layers += [conv_layer(in_channels, out_channels, kernel_size, padding, use_wscale, fused_scale)]
     he_init(layers[-1], init, param)  # init layers
-    if use_wscale:
-        layers += [WScaleLayer(layers[-1])]
     layers += [nonlinearity]
     if use_batchnorm:
         layers += [nn.BatchNorm2d(out_channels)]
@@ -23,10 +31,8 @@ def G_conv(incoming, in_channels, out_channels, kernel_size, padding, nonlineari
 def NINLayer(incoming, in_channels, out_channels, nonlinearity, init, param=None, 
             to_sequential=True, use_wscale=True):
     layers = incoming
-    layers += [nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=1, stride=1, padding=0)]  # NINLayer in lasagne
+    layers += [conv_layer(in_channels, out_channels, 1, 0, use_wscale)]  # NINLayer in lasagne
     he_init(layers[-1], init, param)  # init layers
-    if use_wscale:
-        layers += [WScaleLayer(layers[-1])]
     if not (nonlinearity == 'linear'):
         layers += [nonlinearity]
     if to_sequential:
@@ -49,7 +55,10 @@ class Generator(nn.Module):
                 use_pixelnorm       = True,
                 use_leakyrelu       = True,
                 use_batchnorm       = False,
-                tanh_at_end         = None):
+                tanh_at_end         = None,
+                fused_scale         = False,    # Fuse upsample + conv in blocks of resolution >= 128.
+                channels_last       = False,    # Keep weights and activations in NHWC memory format.
+                growable            = False):   # Build blocks lazily with grow().
         super(Generator, self).__init__()
         self.num_channels = num_channels
         self.resolution = resolution
@@ -64,64 +73,136 @@ class Generator(nn.Module):
         self.use_leakyrelu = use_leakyrelu
         self.use_batchnorm = use_batchnorm
         self.tanh_at_end = tanh_at_end
+        self.fused_scale = fused_scale
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.growable = growable
 
         R = int(np.log2(resolution))
         assert resolution == 2**R and resolution >= 4
         if latent_size is None: 
             latent_size = self.get_nf(0)
-
-        negative_slope = 0.2
-        act = nn.LeakyReLU(negative_slope=negative_slope) if self.use_leakyrelu else nn.ReLU()
-        iact = 'leaky_relu' if self.use_leakyrelu else 'relu'
-        output_act = nn.Tanh() if self.tanh_at_end else 'linear'
-        output_iact = 'tanh' if self.tanh_at_end else 'linear'
+        self._latent_size = latent_size
 
         pre = None
-        lods = nn.ModuleList()
-        nins = nn.ModuleList()
-        layers = []
+        lods = nn.ModuleList([None] * (R - 1))  # filled by grow()
+        nins = nn.ModuleList([None] * (R - 1))
 
         if self.normalize_latents:
             pre = PixelNormLayer()
 
-        if self.label_size:
-            layers += [ConcatLayer()]
-
-        layers += [ReshapeLayer([latent_size, 1, 1])]
-        layers = G_conv(layers, latent_size, self.get_nf(1), 4, 3, act, iact, negative_slope, 
-                    False, self.use_wscale, self.use_batchnorm, self.use_pixelnorm) 
-        net = G_conv(layers, latent_size, self.get_nf(1), 3, 1, act, iact, negative_slope, 
-                    True, self.use_wscale, self.use_batchnorm, self.use_pixelnorm)  # first block
-        
-        lods.append(net)
-        nins.append(NINLayer([], self.get_nf(1), self.num_channels, output_act, output_iact, None, True, self.use_wscale))  # to_rgb layer
-
-        for I in range(2, R):  # following blocks
-            ic, oc = self.get_nf(I-1), self.get_nf(I)
-            layers = [nn.Upsample(scale_factor=2, mode='nearest')]  # upsample
-            layers = G_conv(layers, ic, oc, 3, 1, act, iact, negative_slope, False, self.use_wscale, self.use_batchnorm, self.use_pixelnorm)
-            net = G_conv(layers, oc, oc, 3, 1, act, iact, negative_slope, True, self.use_wscale, self.use_batchnorm, self.use_pixelnorm)
-            lods.append(net)
-            nins.append(NINLayer([], oc, self.num_channels, output_act, output_iact, None, True, self.use_wscale))  # to_rgb layer
-
         self.output_layer = GSelectLayer(pre, lods, nins)
+        self.grow(1 if self.growable else R - 1)
 
     def get_nf(self, stage):
         return min(int(self.fmap_base / (2.0 ** (stage * self.fmap_decay))), self.fmap_max)
 
+    def _build_level(self, level):
+        """Conv block and to_rgb layer of chain index `level`."""
+        negative_slope = 0.2
+        act = nn.LeakyReLU(negative_slope=negative_slope) if self.use_leakyrelu else nn.ReLU()
+        iact = 'leaky_relu' if self.use_leakyrelu else 'relu'
+        output_act = nn.Tanh() if self.tanh_at_end else 'linear'
+        output_iact = 'tanh' if self.tanh_at_end else 'linear'
+
+        if level == 0:  # first block
+            layers = []
+            if self.label_size:
+                layers += [ConcatLayer()]
+            layers += [ReshapeLayer([self._latent_size, 1, 1])]
+            layers = G_conv(layers, self._latent_size, self.get_nf(1), 4, 3, act, iact, negative_slope, 
+                        False, self.use_wscale, self.use_batchnorm, self.use_pixelnorm) 
+            net = G_conv(layers, self.get_nf(1), self.get_nf(1), 3, 1, act, iact, negative_slope, 
+                        True, self.use_wscale, self.use_batchnorm, self.use_pixelnorm)
+            oc = self.get_nf(1)
+        else:  # following blocks
+            ic, oc = self.get_nf(level), self.get_nf(level+1)
+            if self.fused_scale and 2 ** (level + 2) >= 128:  # transposed conv
+                layers = G_conv([], ic, oc, 3, 1, act, iact, negative_slope, False, self.use_wscale, self.use_batchnorm, self.use_pixelnorm, 'up')
+            else:
+                layers = [nn.Upsample(scale_factor=2, mode='nearest')]  # upsample
+                layers = G_conv(layers, ic, oc, 3, 1, act, iact, negative_slope, False, self.use_wscale, self.use_batchnorm, self.use_pixelnorm)
+            net = G_conv(layers, oc, oc, 3, 1, act, iact, negative_slope, True, self.use_wscale, self.use_batchnorm, self.use_pixelnorm)
+        nin = NINLayer([], oc, self.num_channels, output_act, output_iact, None, True, self.use_wscale)  # to_rgb layer
+        return net, nin
+
+    def grow(self, cur_level):
+        """
+        Build the blocks that are missing to run at cur_level.
+        Returns the parameters of every new level (one list per level, in build order),
+        already placed on the device, dtype and memory format of the existing ones.
+        """
+        chain, post = self.output_layer.chain, self.output_layer.post
+        params = [p for p in self.parameters()]
+        new_params = []
+        for level in range(int(np.ceil(cur_level - 1)) + 1):
+            if chain[level] is not None:
+                continue
+            net, nin = self._build_level(level)
+            if params:
+                net.to(params[0].device, params[0].dtype)
+                nin.to(params[0].device, params[0].dtype)
+            net.to(memory_format=self.memory_format)
+            nin.to(memory_format=self.memory_format)
+            chain[level], post[level] = net, nin
+            new_params += [list(net.parameters()) + list(nin.parameters())]
+        return new_params
+
+    def level_parameters(self):
+        """Parameters of every built level, one list per level in build order."""
+        layer = self.output_layer
+        return [list(layer.chain[i].parameters()) + list(layer.post[i].parameters())
+                for i in range(layer.N) if layer.chain[i] is not None]
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        levels = [int(k.split('.')[2]) for k in state_dict if k.startswith('output_layer.chain.')]
+        if levels:
+            self.grow(max(levels) + 1)
+        state_dict = convert_wscale_state_dict(state_dict, self)  # checkpoints of Conv2d + WScaleLayer
+        return super(Generator, self).load_state_dict(state_dict, *args, **kwargs)
+
+    def activation_bytes(self, batch_size):
+        """Bytes each built level stores for backward in a forward of batch_size samples."""
+        layer = self.output_layer
+        p = next(self.parameters())
+        result = {}
+        for n in [1, 2]:  # bytes = fixed + n * per_sample
+            x = torch.zeros(n, self._latent_size, device=p.device, dtype=p.dtype)
+            x = layer.pre(x) if layer.pre is not None else x
+            for level in range(layer.N):
+                if layer.chain[level] is None:
+                    break
+                nbytes, x = saved_tensor_bytes(layer.chain[level], x)
+                result[level] = nbytes if n == 1 else result[level] + (nbytes - result[level]) * (batch_size - 1)
+        return result
+
+    def set_checkpoint(self, resolution=None, memory_budget=None, batch_size=1):
+        """
+        Recompute the activations of some levels during backward instead of storing them:
+        every level working at `resolution` or above, or else the largest built levels until
+        a forward of batch_size samples stores at most memory_budget bytes.
+        Without arguments checkpointing is turned off. Returns the checkpointed levels.
+        """
+        layer = self.output_layer
+        if resolution:
+            levels = set(i for i in range(layer.N) if 2 ** (i + 2) >= resolution)
+        elif memory_budget:
+            levels = plan_checkpoint(self.activation_bytes(batch_size), memory_budget)
+        else:
+            levels = set()
+        layer.checkpoint_levels = levels
+        return levels
+
     def forward(self, x, y=None, cur_level=None, insert_y_at=None):
         return self.output_layer(x, y, cur_level, insert_y_at)
 
 
 def D_conv(incoming, in_channels, out_channels, kernel_size, padding, nonlinearity, init, param=None, 
-        to_sequential=True, use_wscale=True, use_gdrop=True, use_layernorm=False, gdrop_param=dict()):
+        to_sequential=True, use_wscale=True, use_gdrop=True, use_layernorm=False, gdrop_param=dict(), fused_scale=None):
     layers = incoming
     if use_gdrop:
         layers += [GDropLayer(**gdrop_param)]
-    layers += [nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=1, padding=padding)]
+    layers += [conv_layer(in_channels, out_channels, kernel_size, padding, use_wscale, fused_scale)]
     he_init(layers[-1], init, param)  # init layers
-    if use_wscale:
-        layers += [WScaleLayer(layers[-1])]
     layers += [nonlinearity]
     if use_layernorm:
         layers += [LayerNormLayer()]  # TODO: requires incoming layer
@@ -140,11 +221,15 @@ class Discriminator(nn.Module):
                 fmap_decay      = 1.0,
                 fmap_max        = 256,
                 mbstat_avg      = 'all',
+                mbstat_group_size = None,
                 mbdisc_kernels  = None,
                 use_wscale      = True,
                 use_gdrop       = True,
                 use_layernorm   = False,
-                sigmoid_at_end  = False):
+                sigmoid_at_end  = False,
+                fused_scale     = False,    # Fuse conv + downsample in blocks of resolution >= 128.
+                channels_last   = False,    # Keep weights and activations in NHWC memory format.
+                growable        = False):   # Build blocks lazily with grow().
         super(Discriminator, self).__init__()
         self.num_channels = num_channels
         self.resolution = resolution
@@ -153,14 +238,37 @@ class Discriminator(nn.Module):
         self.fmap_decay = fmap_decay
         self.fmap_max = fmap_max
         self.mbstat_avg = mbstat_avg
+        self.mbstat_group_size = mbstat_group_size
         self.mbdisc_kernels = mbdisc_kernels
         self.use_wscale = use_wscale
         self.use_gdrop = use_gdrop
         self.use_layernorm = use_layernorm
         self.sigmoid_at_end = sigmoid_at_end
+        self.fused_scale = fused_scale
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+        self.growable = growable
 
         R = int(np.log2(resolution))
         assert resolution == 2**R and resolution >= 4
+        self.R = R
+
+        nins = nn.ModuleList([None] * (R - 1))  # filled by grow()
+        lods = nn.ModuleList([None] * (R - 1))
+        pre = None
+
+        self.output_layer = DSelectLayer(pre, lods, nins)
+        self.gdrop_layers = []
+        self._gdrop_strength = None
+        self.mbstat_layers = []
+        self.grow(1 if self.growable else R - 1)
+
+    def get_nf(self, stage):
+        return min(int(self.fmap_base / (2.0 ** (stage * self.fmap_decay))), self.fmap_max)
+
+    def _build_level(self, level):
+        """Conv block and from_rgb layer of chain index `level` (0 is the highest resolution)."""
+        R = self.R
         gdrop_strength = 0.0
 
         negative_slope = 0.2
@@ -172,30 +280,29 @@ class Discriminator(nn.Module):
         output_iact = 'sigmoid' if self.sigmoid_at_end else 'linear'
         gdrop_param = {'mode': 'prop', 'strength': gdrop_strength}
 
-        nins = nn.ModuleList()
-        lods = nn.ModuleList()
-        pre = None
-
-        nins.append(NINLayer([], self.num_channels, self.get_nf(R-1), act, iact, negative_slope, True, self.use_wscale))
+        # from_rgb layer
+        # nin = [nn.AvgPool2d(kernel_size=2, stride=2, ceil_mode=False, count_include_pad=False)]
+        nin = NINLayer([], self.num_channels, self.get_nf(R-1-level), act, iact, negative_slope, True, self.use_wscale)
 
-        for I in range(R-1, 1, -1):
+        if level < R - 2:
+            I = R - 1 - level
             ic, oc = self.get_nf(I), self.get_nf(I-1)
             net = D_conv([], ic, ic, 3, 1, act, iact, negative_slope, False, 
                         self.use_wscale, self.use_gdrop, self.use_layernorm, gdrop_param)
-            net = D_conv(net, ic, oc, 3, 1, act, iact, negative_slope, False, 
-                        self.use_wscale, self.use_gdrop, self.use_layernorm, gdrop_param)
-            net += [nn.AvgPool2d(kernel_size=2, stride=2, ceil_mode=False, count_include_pad=False)]
-            lods.append(nn.Sequential(*net))
-            # nin = [nn.AvgPool2d(kernel_size=2, stride=2, ceil_mode=False, count_include_pad=False)]
-            nin = []
-            nin = NINLayer(nin, self.num_channels, oc, act, iact, negative_slope, True, self.use_wscale)
-            nins.append(nin)
+            if self.fused_scale and 2 ** (I + 1) >= 128:  # strided conv, downsamples before the activation
+                net = D_conv(net, ic, oc, 3, 1, act, iact, negative_slope, False, 
+                            self.use_wscale, self.use_gdrop, self.use_layernorm, gdrop_param, 'down')
+            else:
+                net = D_conv(net, ic, oc, 3, 1, act, iact, negative_slope, False, 
+                            self.use_wscale, self.use_gdrop, self.use_layernorm, gdrop_param)
+                net += [nn.AvgPool2d(kernel_size=2, stride=2, ceil_mode=False, count_include_pad=False)]
+            return nn.Sequential(*net), nin
 
         net = []
         ic = oc = self.get_nf(1)
         if self.mbstat_avg is not None:
-            net += [MinibatchStatConcatLayer(averaging=self.mbstat_avg)]
-            ic += 1
+            net += [MinibatchStatConcatLayer(averaging=self.mbstat_avg, group_size=self.mbstat_group_size)]
+            ic += net[-1].num_new_features(ic)
         net = D_conv(net, ic, oc, 3, 1, act, iact, negative_slope, False, 
                     self.use_wscale, self.use_gdrop, self.use_layernorm, gdrop_param)
         net = D_conv(net, oc, self.get_nf(0), 4, 0, act, iact, negative_slope, False,
@@ -207,17 +314,91 @@ class Discriminator(nn.Module):
 
         oc = 1 + self.label_size
         # lods.append(NINLayer(net, self.get_nf(0), oc, 'linear', 'linear', None, True, self.use_wscale))
-        lods.append(NINLayer(net, self.get_nf(0), oc, output_act, output_iact, None, True, self.use_wscale))
-
-        self.output_layer = DSelectLayer(pre, lods, nins)
-
-    def get_nf(self, stage):
-        return min(int(self.fmap_base / (2.0 ** (stage * self.fmap_decay))), self.fmap_max)
-
-    def forward(self, x, y=None, cur_level=None, insert_y_at=None, gdrop_strength=0.0):
-        for module in self.modules():
-            if hasattr(module, 'strength'):
-                module.strength = gdrop_strength
+        return NINLayer(net, self.get_nf(0), oc, output_act, output_iact, None, True, self.use_wscale), nin
+
+    def grow(self, cur_level):
+        """
+        Build the blocks that are missing to run at cur_level.
+        Returns the parameters of every new level (one list per level, in build order),
+        already placed on the device, dtype and memory format of the existing ones.
+        """
+        chain, inputs, N = self.output_layer.chain, self.output_layer.inputs, self.output_layer.N
+        params = [p for p in self.parameters()]
+        new_params = []
+        for level in range(N - 1, int(np.floor(N - cur_level)) - 1, -1):
+            if chain[level] is not None:
+                continue
+            net, nin = self._build_level(level)
+            if params:
+                net.to(params[0].device, params[0].dtype)
+                nin.to(params[0].device, params[0].dtype)
+            net.to(memory_format=self.memory_format)
+            nin.to(memory_format=self.memory_format)
+            chain[level], inputs[level] = net, nin
+            new_params += [list(net.parameters()) + list(nin.parameters())]
+        if new_params:
+            self.gdrop_layers = [m for m in self.modules() if isinstance(m, GDropLayer)]
+            self._gdrop_strength = None
+            self.mbstat_layers = [m for m in self.modules() if isinstance(m, MinibatchStatConcatLayer)]
+        return new_params
+
+    def level_parameters(self):
+        """Parameters of every built level, one list per level in build order."""
+        layer = self.output_layer
+        return [list(layer.chain[i].parameters()) + list(layer.inputs[i].parameters())
+                for i in range(layer.N - 1, -1, -1) if layer.chain[i] is not None]
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        levels = [int(k.split('.')[2]) for k in state_dict if k.startswith('output_layer.chain.')]
+        if levels:
+            self.grow(self.output_layer.N - min(levels))
+        state_dict = convert_wscale_state_dict(state_dict, self)  # checkpoints of Conv2d + WScaleLayer
+        return super(Discriminator, self).load_state_dict(state_dict, *args, **kwargs)
+
+    def activation_bytes(self, batch_size):
+        """Bytes each built level stores for backward in a forward of batch_size samples."""
+        layer = self.output_layer
+        p = next(self.parameters())
+        top = min(i for i in range(layer.N) if layer.chain[i] is not None)
+        resol = 2 ** (self.R - top)
+        result = {}
+        for n in [1, 2]:  # bytes = fixed + n * per_sample
+            x = torch.zeros(n, self.num_channels, resol, resol, device=p.device, dtype=p.dtype)
+            x = layer.inputs[top](layer.pre(x) if layer.pre is not None else x)
+            for level in range(top, layer.N):
+                nbytes, x = saved_tensor_bytes(layer.chain[level], x)
+                result[level] = nbytes if n == 1 else result[level] + (nbytes - result[level]) * (batch_size - 1)
+        return result
+
+    def set_checkpoint(self, resolution=None, memory_budget=None, batch_size=1):
+        """
+        Recompute the activations of some levels during backward instead of storing them:
+        every level working at `resolution` or above, or else the largest built levels until
+        a forward of batch_size samples stores at most memory_budget bytes.
+        Without arguments checkpointing is turned off. Returns the checkpointed levels.
+        """
+        layer = self.output_layer
+        if resolution:
+            levels = set(i for i in range(layer.N) if 2 ** (self.R - i) >= resolution)
+        elif memory_budget:
+            levels = plan_checkpoint(self.activation_bytes(batch_size), memory_budget)
+        else:
+            levels = set()
+        layer.checkpoint_levels = levels
+        return levels
+
+    def set_gdrop_strength(self, strength):
+        # a tensor strength (computed on the device) is not compared, that would read it on the host
+        if not torch.is_tensor(strength) and not torch.is_tensor(self._gdrop_strength) and strength == self._gdrop_strength:
+            return
+        for layer in self.gdrop_layers:
+            layer.strength = strength
+        self._gdrop_strength = strength
+
+    def forward(self, x, y=None, cur_level=None, insert_y_at=None, gdrop_strength=0.0, mbstat_pool=None):
+        self.set_gdrop_strength(gdrop_strength)
+        for layer in self.mbstat_layers:
+            layer.pool = mbstat_pool  # minibatch statistics of accumulated micro-batches, see MinibatchStatPool
         return self.output_layer(x, y, cur_level, insert_y_at)
 
 
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Int8 post-training static quantization of a frozen Generator (see models/export.py) for CPU
+inference. Every conv with its activation becomes an int8 island between a quantize and a
+dequantize step, PixelNorm and the to_rgb output layer stay in float.
+"""
+import copy
+import torch
+import torch.nn as nn
+from torch.ao import quantization as tq
+
+
+class QuantizedBlock(nn.Module):
+    """Quantizes its input, runs the wrapped layers in int8 and dequantizes the output."""
+    def __init__(self, layers):
+        super(QuantizedBlock, self).__init__()
+        self.quant = tq.QuantStub()
+        self.layers = nn.Sequential(*layers)
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.layers(self.quant(x)))
+
+
+def qconfig_for(conv, backend):
+    """Per output channel weight scales, per tensor for transposed convs which only support those."""
+    activation = tq.HistogramObserver.with_args(reduce_range=backend in ['x86', 'fbgemm'])
+    if isinstance(conv, nn.ConvTranspose2d):
+        return tq.QConfig(activation=activation, weight=tq.default_weight_observer)
+    return tq.QConfig(activation=activation, weight=tq.default_per_channel_weight_observer)
+
+
+def quantize_generator(frozen, calibration_latents, backend='fbgemm', batch_size=16):
+    """
+    Int8 copy of a frozen generator, calibrated on calibration_latents (N x latent_size).
+    The last conv (to_rgb) and everything after it, PixelNorm and reshapes stay in float.
+    fbgemm is the default backend: the x86 and onednn int8 transposed convs give wrong results
+    when the input and output channel counts differ.
+    """
+    assert backend in torch.backends.quantized.supported_engines, 'Unsupported quantization backend %s' % backend
+    torch.backends.quantized.engine = backend
+    layers = list(copy.deepcopy(frozen).cpu().float().eval())
+    last_conv = max(i for i, m in enumerate(layers) if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)))
+    blocks, i = [], 0
+    while i < len(layers):
+        m = layers[i]
+        if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)) and i < last_conv:
+            island = [m]
+            if i + 1 < len(layers) and isinstance(layers[i + 1], (nn.LeakyReLU, nn.ReLU)):
+                island += [layers[i + 1]]
+            block = QuantizedBlock(island)
+            block.qconfig = qconfig_for(m, backend)
+            blocks += [block]
+            i += len(island)
+        else:
+            blocks += [m]
+            i += 1
+    model = nn.Sequential(*blocks).eval()
+    tq.prepare(model, inplace=True)
+    with torch.no_grad():
+        for start in range(0, calibration_latents.size(0), batch_size):
+            model(calibration_latents[start:start + batch_size].cpu().float())
+    tq.convert(model, inplace=True)
+    return model
+
+
+def quantization_report(frozen, quantized, latents, batch_size=16):
+    """
+    Accuracy of the quantized generator against the float one on latents: pixel MSE and PSNR
+    of the [-1, 1] outputs mapped to [0, 255], and SSIM.
+    """
+    from metrics.ssim import ssim
+    mse = ssim_sum = 0.0
+    with torch.no_grad():
+        for start in range(0, latents.size(0), batch_size):
+            z = latents[start:start + batch_size].cpu().float()
+            x = (frozen.cpu().float()(z).clamp(-1, 1) + 1) * 127.5
+            y = (quantized(z).clamp(-1, 1) + 1) * 127.5
+            mse += ((x - y) ** 2).mean(dim=[1, 2, 3]).sum().item()
+            ssim_sum += ssim(x, y, data_range=255.0).sum().item()
+    mse /= latents.size(0)
+    return {'mse': mse, 'psnr': 10 * torch.log10(torch.tensor(255.0 ** 2 / max(mse, 1e-10))).item(),
+            'ssim': ssim_sum / latents.size(0)}
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP service generating images from trained generators, with dynamic micro-batching.
+Usage: python serve.py --ckpt_dir "exp/2018-01-01 000000/ckpts" --port 8000
+
+POST /generate {"seed": 0, "count": 4, "level": 6, "which_file": "128x128-stabilize-105000"}
+    -> {"which_file": ..., "level": ..., "seeds": [...], "images": [base64 PNG, ...]}
+    level and which_file are optional, image i uses seed + i like generate.py, count is at most --max_count.
+GET /stats -> request, batch and latency counters.
+
+Concurrent requests for the same checkpoint and level are merged into one forward of up to
+--max_batch images, waiting at most --max_latency_ms for more requests to arrive.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+import numpy as np
+import PIL.Image
+import torch
+from models.export import load_generator, freeze_generator
+from utils.sampling import parse_ckpt_name, generator_path, find_ckpts, read_options, ckpt_level, latents, to_uint8
+
+
+class ModelCache(object):
+    """Loaded generators (and their frozen levels) keyed by checkpoint, least recently used evicted first."""
+    def __init__(self, ckpt_dir, device, max_models=2, ema=True):
+        self.ckpt_dir = ckpt_dir
+        self.device = device
+        self.ema = ema
+        self.max_models = max_models
+        self.opts = read_options(os.path.dirname(os.path.abspath(ckpt_dir)))
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, which_file):
+        with self.lock:
+            if which_file not in self.models:
+                G = load_generator(generator_path(self.ckpt_dir, which_file, self.ema)).to(self.device)
+                self.models[which_file] = (G, {})
+                while len(self.models) > self.max_models:
+                    self.models.popitem(last=False)
+            self.models.move_to_end(which_file)
+            return self.models[which_file]
+
+    def net(self, which_file, level):
+        """Function generating images from latents at level."""
+        G, frozen = self.get(which_file)
+        if level != int(level):
+            return lambda z: G(z, cur_level=level)
+        with self.lock:
+            if level not in frozen:
+                frozen[level] = freeze_generator(G, int(level))
+            return frozen[level]
+
+
+class Request(object):
+    def __init__(self, which_file, level, seeds):
+        self.key = (which_file, level)
+        self.seeds = seeds
+        self.done = threading.Event()
+        self.images = None
+        self.error = None
+        self.submit_time = time.time()
+
+
+class Stats(object):
+    """Thread safe serving counters."""
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = self.images = self.batches = self.errors = 0
+        self.latencies = deque(maxlen=window)  # seconds, of the last requests
+        self.forward_time = 0.0
+
+    def add_batch(self, requests, n_images, forward_time):
+        now = time.time()
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.images += n_images
+            self.forward_time += forward_time
+            self.latencies.extend(now - r.submit_time for r in requests)
+
+    def as_dict(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+            return {'requests': self.requests, 'images': self.images, 'batches': self.batches, 'errors': self.errors,
+                    'mean_batch_size': self.images / max(self.batches, 1),
+                    'images_per_s': self.images / elapsed, 'busy_fraction': self.forward_time / elapsed,
+                    'latency_ms_mean': float(latencies.mean()), 'latency_ms_p50': float(np.percentile(latencies, 50)),
+                    'latency_ms_p95': float(np.percentile(latencies, 95)), 'latency_ms_max': float(latencies.max())}
+
+
+class MicroBatcher(object):
+    """
+    Runs queued requests in a single worker thread. Requests with the same checkpoint and level
+    are merged until max_batch images are collected or the first one waited max_latency seconds.
+    """
+    def __init__(self, models, max_batch=32, max_latency=0.01):
+        self.models = models
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = Queue()
+        self.pending = []  # requests taken from the queue for another key
+        self.stats = Stats()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, which_file, level, seeds):
+        request = Request(which_file, level, seeds)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.images
+
+    def next_batch(self):
+        first = self.pending.pop(0) if self.pending else self.queue.get()
+        batch, n_images = [first], len(first.seeds)
+        deadline = first.submit_time + self.max_latency
+        others = []
+        for request in self.pending:  # requests that arrived during the previous forward
+            if request.key == first.key and n_images + len(request.seeds) <= self.max_batch:
+                batch += [request]
+                n_images += len(request.seeds)
+            else:
+                others += [request]
+        self.pending = others
+        while n_images < self.max_batch:
+            try:
+                request = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except Empty:
+                break
+            if request.key == first.key and n_images + len(request.seeds) <= self.max_batch:
+                batch += [request]
+                n_images += len(request.seeds)
+            else:
+                self.pending += [request]
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            which_file, level = batch[0].key
+            try:
+                start = time.time()
+                net = self.models.net(which_file, level)
+                G, _ = self.models.get(which_file)
+                p = next(G.parameters())
+                seeds = [seed for request in batch for seed in request.seeds]
+                images = []
+                with torch.no_grad():
+                    for i in range(0, len(seeds), self.max_batch):  # a single request may exceed max_batch
+                        z = torch.from_numpy(latents(seeds[i:i + self.max_batch], G._latent_size)).to(p.device)
+                        images += [to_uint8(net(z)).cpu().numpy()]
+                images = np.concatenate(images)
+                forward_time = time.time() - start
+                i = 0
+                for request in batch:
+                    request.images = images[i:i + len(request.seeds)]
+                    i += len(request.seeds)
+                self.stats.add_batch(batch, len(seeds), forward_time)
+            except Exception as e:
+                with self.stats.lock:
+                    self.stats.errors += len(batch)
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+
+def encode_png(image):
+    buf = io.BytesIO()
+    PIL.Image.fromarray(image[:, :, 0] if image.shape[2] == 1 else image).save(buf, format='PNG')
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+class Server(ThreadingHTTPServer):
+    request_queue_size = 128  # bursts of concurrent clients are the point of batching
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    batcher = None
+    default_file = None
+    max_count = 64
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.batcher.stats.as_dict())
+        else:
+            self.send_json(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            return self.send_json(404, {'error': 'unknown path %s' % self.path})
+        try:
+            query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            assert isinstance(query, dict), 'the request must be a JSON object'
+            which_file = query.get('which_file') or self.default_file
+            parse_ckpt_name(which_file)  # only checkpoint names, no paths
+            level = float(query['level']) if 'level' in query else ckpt_level(which_file, self.batcher.models.opts)
+            seed, count = int(query.get('seed', 0)), int(query.get('count', 1))
+            assert 1 <= count <= self.max_count, 'count must be in [1, %d]' % self.max_count
+        except (ValueError, TypeError, AssertionError) as e:
+            return self.send_json(400, {'error': str(e)})
+        try:
+            max_level = self.batcher.models.get(which_file)[0].output_layer.N
+        except Exception as e:
+            return self.send_json(500, {'error': '%s: %s' % (e.__class__.__name__, e)})
+        if not 1 <= level <= max_level:  # cur_level 1 is 4x4
+            return self.send_json(400, {'error': 'level must be in [1, %d] for %s' % (max_level, which_file)})
+        seeds = list(range(seed, seed + count))
+        try:
+            images = self.batcher.submit(which_file, level, seeds)
+        except Exception as e:
+            return self.send_json(500, {'error': '%s: %s' % (e.__class__.__name__, e)})
+        self.send_json(200, {'which_file': which_file, 'level': level, 'seeds': seeds,
+                             'images': [encode_png(image) for image in images]})
+
+    def log_message(self, format, *args):
+        pass  # counters are in /stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt_dir', required=True, type=str, help='ckpts dir of an experiment.')
+    parser.add_argument('--which_file', default='', type=str, help='default checkpoint, e.g. 128x128-fade_in-105000, default the latest.')
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='address to listen on.')
+    parser.add_argument('--port', default=8000, type=int, help='port to listen on.')
+    parser.add_argument('--max_batch', default=32, type=int, help='max # images per forward.')
+    parser.add_argument('--max_latency_ms', default=10, type=float, help='max time a request waits for others to batch with.')
+    parser.add_argument('--max_models', default=2, type=int, help='# checkpoints kept loaded.')
+    parser.add_argument('--max_count', default=64, type=int, help='max # images per request.')
+    parser.add_argument('--no_ema', action='store_true', help='serve the trained G instead of its moving average Gs.')
+    parser.add_argument('--gpu', default='', type=str, help='gpu to use.')
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    device = torch.device('cuda' if args.gpu else 'cpu')
+    models = ModelCache(args.ckpt_dir, device, args.max_models, not args.no_ema)
+    Handler.default_file = args.which_file or find_ckpts(args.ckpt_dir)[-1]
+    Handler.max_count = args.max_count
+    Handler.batcher = MicroBatcher(models, args.max_batch, args.max_latency_ms / 1000.0)
+    models.get(Handler.default_file)  # load before the first request
+    server = Server((args.host, args.port), Handler)
+    print('Serving %s on http://%s:%d' % (Handler.default_file, args.host, args.port))
+    server.serve_forever()
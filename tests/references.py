@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Straightforward reference implementations of optimized code paths, the oracles of the tests
+(benchmark.py times the optimized paths against them).
+"""
+import numpy as np
+import torch
+from models.base_model import resize_activations
+
+
+def blend_gselect_forward(layer, x, cur_level):
+    """GSelectLayer.forward without the stabilize fast path: to_rgb twice, resize and blend."""
+    min_level, max_level = int(np.floor(cur_level-1)), int(np.ceil(cur_level-1))
+    min_level_weight, max_level_weight = int(cur_level+1)-cur_level, cur_level-int(cur_level)
+    x = layer.pre(x)
+    for level in range(max_level+1):
+        x = layer.chain[level](x)
+        if level == min_level:
+            x_min = layer.post[level](x)
+        if level == max_level:
+            x_max = layer.post[level](x)
+            x = resize_activations(x_min, x_max.size()) * min_level_weight + x_max * max_level_weight
+    return x
+
+
+def reference_mbstat(x, averaging, group_size=None):
+    """Per-sample loop reference of MinibatchStatConcatLayer."""
+    def std(v, dims):
+        return torch.sqrt(torch.mean((v - torch.mean(v, dim=dims, keepdim=True)) ** 2, dim=dims, keepdim=True) + 1e-8)
+
+    N, C, H, W = x.size()
+    G = N if group_size is None else min(group_size, N)
+    M = N // G
+    out = []
+    for i in range(N):
+        group = x[[g * M + i % M for g in range(G)]]
+        if averaging == 'all':
+            vals = torch.mean(std(group, [0]), dim=1, keepdim=True)
+        elif averaging == 'spatial':
+            vals = torch.mean(std(group, [0]), dim=[2, 3], keepdim=True)
+        elif averaging == 'none':
+            vals = std(group, [0])
+        elif averaging == 'gpool':
+            vals = torch.mean(group, dim=[0, 2, 3], keepdim=True)
+        elif averaging == 'flat':
+            vals = std(group, [0, 1, 2, 3])
+        else:
+            n = int(averaging[5:])
+            vals = torch.stack([torch.mean(v) for v in torch.chunk(std(group, [0]), n, dim=1)]).view(1, n, 1, 1)
+        out += [torch.cat([x[i:i+1], vals.expand(1, -1, H, W)], 1)]
+    return torch.cat(out)
+
+
+def sample_loop(fake, real, n_row):
+    """Per-image reference of the sample grid: host copies image by image, grid assembled in python."""
+    n_col = fake.size(0) // n_row
+    samples = []
+    i = j = 0
+    for row in range(n_row):
+        one_row = [fake[i + col].float().cpu().numpy() for col in range(n_col)]
+        one_row += [real[j + col].float().cpu().numpy() for col in range(n_col)]
+        i, j = i + n_col, j + n_col
+        samples += [np.concatenate(one_row, axis=2)]
+    return np.concatenate(samples, axis=1).transpose([1, 2, 0])
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import os
+import torch
+from utils.checkpoint import CheckpointWriter, atomic_save
+
+
+def test_atomic_save(tmp_path):
+    path = str(tmp_path / 'x.pth')
+    atomic_save({'w': torch.arange(3)}, path)
+    assert os.listdir(str(tmp_path)) == ['x.pth']
+    assert torch.equal(torch.load(path)['w'], torch.arange(3))
+
+
+def test_checkpoint_writer_keeps_last_and_latest_of_each_phase(tmp_path):
+    names = ['4x4-stabilize-000010', '4x4-stabilize-000020', '8x8-fade_in-000030', '8x8-fade_in-000040',
+             '8x8-stabilize-000050', '8x8-stabilize-000060', '8x8-stabilize-000070', '16x16-fade_in-000080',
+             '16x16-fade_in-000090']
+    writer = CheckpointWriter(str(tmp_path), keep_last=2)
+    w = torch.zeros(2)
+    for name in names:
+        w += 1
+        writer.save(name, {'G': {'w': w}, 'D': {'w': -w}})  # snapshots, later changes of w are not written
+    writer.close()
+    kept = ['4x4-stabilize-000020', '8x8-fade_in-000040', '8x8-stabilize-000070', '16x16-fade_in-000080', '16x16-fade_in-000090']
+    assert sorted(os.listdir(str(tmp_path))) == sorted('%s-%s.pth' % (n, s) for n in kept for s in ['G', 'D'])
+    for n in kept:
+        i = names.index(n) + 1
+        assert torch.equal(torch.load(str(tmp_path / ('%s-G.pth' % n)))['w'], torch.full((2,), float(i)))
+        assert torch.equal(torch.load(str(tmp_path / ('%s-D.pth' % n)))['w'], torch.full((2,), -float(i)))
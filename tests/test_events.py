@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+import numpy as np
+import pytest
+from utils import events
+
+
+def table_crc32c(data):
+    crc = 0xFFFFFFFF
+    for b in bytearray(data):
+        crc = events._CRC32C_TABLE[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    """TFRecord checksum, as specified for tf.io.TFRecordWriter."""
+    crc = table_crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def read_fields(data):
+    """{field: [values]} of a serialized protobuf message, varints as ints, fixed64/32 and bytes as bytes."""
+    fields, i = {}, 0
+
+    def varint():
+        nonlocal i
+        n = shift = 0
+        while True:
+            byte = data[i]
+            i += 1
+            n |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return n
+    while i < len(data):
+        key = varint()
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value = varint()
+        else:
+            size = {1: 8, 5: 4}.get(wire_type) or varint()
+            value, i = data[i:i + size], i + size
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+@pytest.fixture
+def python_crc32c(monkeypatch):
+    monkeypatch.setattr(events, 'crc32c', None)  # the optional C implementation
+
+
+def test_crc32c_check_value(python_crc32c):
+    assert events._crc32c(b'123456789') == 0xE3069283
+    assert events._crc32c(b'') == 0
+
+
+@pytest.mark.parametrize('n', [4095, 4096, 4097, 10000, 65536 + 7])
+def test_crc32c_large_inputs(python_crc32c, n):
+    data = np.random.RandomState(n).randint(0, 256, n).astype(np.uint8).tobytes()
+    assert events._crc32c(data) == table_crc32c(data)
+    assert events._crc32c(bytes(n)) == table_crc32c(bytes(n))
+
+
+def test_scalar_event_record(tmp_path, python_crc32c):
+    writer = events.EventFileWriter(str(tmp_path))
+    writer.add(lambda: events.event(42, summary=events.summary([events.scalar_value('loss/D', 0.25)])))
+    writer.close()
+    with open(writer.path, 'rb') as f:
+        data = f.read()
+    records = []
+    while data:
+        header, (header_crc,) = data[:8], struct.unpack('<I', data[8:12])
+        assert header_crc == masked_crc32c(header)
+        (length,) = struct.unpack('<Q', header)
+        record, (record_crc,) = data[12:12 + length], struct.unpack('<I', data[12 + length:16 + length])
+        assert record_crc == masked_crc32c(record)
+        records.append(record)
+        data = data[16 + length:]
+    assert len(records) == 2
+    assert read_fields(records[0])[3] == [b'brain.Event:2']
+    fields = read_fields(records[1])
+    assert fields[2] == [42]
+    value = read_fields(read_fields(fields[5][0])[1][0])
+    assert value[1] == [b'loss/D'] and struct.unpack('<f', value[2][0]) == (0.25,)
+    assert os.path.basename(writer.path).startswith('events.out.tfevents.')
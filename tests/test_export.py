@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+from models.export import export_onnx, export_torchscript, freeze_generator
+from models.model import Generator
+
+
+@pytest.mark.parametrize('fused_scale', [False, True])
+def test_frozen_and_torchscript_match_eager(tmp_path, fused_scale):
+    G = Generator(num_channels=3, latent_size=16, resolution=128, fmap_max=16, fmap_base=1024, fused_scale=fused_scale).eval()
+    z = torch.randn(4, 16)
+    for level in [1, 3, 6]:
+        frozen = freeze_generator(G, level)
+        scripted = export_torchscript(frozen, str(tmp_path / ('G%d.pt' % level)))
+        loaded = torch.jit.load(str(tmp_path / ('G%d.pt' % level)))
+        with torch.no_grad():
+            expected = G(z, cur_level=level)
+            for net in [frozen, scripted, loaded]:
+                torch.testing.assert_close(net(z), expected, rtol=0, atol=1e-4)
+
+
+def test_export_onnx(tmp_path):
+    onnx = pytest.importorskip('onnx')
+    G = Generator(num_channels=3, latent_size=16, resolution=16, fmap_max=16, fmap_base=64).eval()
+    path = str(tmp_path / 'G.onnx')
+    export_onnx(freeze_generator(G), path, 16)
+    model = onnx.load(path)
+    onnx.checker.check_model(model)
+    assert [i.name for i in model.graph.input] == ['latent'] and [o.name for o in model.graph.output] == ['image']
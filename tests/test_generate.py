@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import time
+import numpy as np
+import PIL.Image
+from generate import ArrayWriter, PNGWriter
+
+
+def test_png_writer_bounds_pending(tmp_path):
+    writer = PNGWriter(str(tmp_path), 40, workers=1, max_pending=8)
+    save = writer._save
+    writer._save = lambda index, image: (time.sleep(0.01), save(index, image))  # slower than generation
+    for start in range(0, 40, 4):
+        writer.write(start, np.full((4, 8, 8, 3), start, np.uint8))
+        assert sum(n for _, n in writer.futures) <= 8
+    writer.close()
+    assert np.asarray(PIL.Image.open(str(tmp_path / '36.png')))[0, 0, 0] == 36
+
+
+def test_array_writer_bounds_pending(tmp_path):
+    path = str(tmp_path / 'images.npz')
+    writer = ArrayWriter(path, 40, (8, 8, 3), max_pending=8)
+    for start in range(0, 40, 4):
+        writer.write(start, np.full((4, 8, 8, 3), start, np.uint8))
+        assert sum(n for _, n in writer.futures) <= 8
+    writer.close()
+    np.testing.assert_array_equal(np.load(path)['images'][:, 0, 0, 0], np.arange(40) // 4 * 4)
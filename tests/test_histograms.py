@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import types
+import numpy as np
+import torch
+from utils import histograms
+from utils.histograms import HistogramSampler
+
+
+class RecordingLogger(object):
+    def __init__(self):
+        self.histograms = []
+        self.flushes = 0
+
+    def add_histogram(self, tag, counts, limits, lo, hi, num, total, squares, step):
+        self.histograms += [(tag, counts, limits, lo, hi, num, total, squares, step)]
+
+    def flush(self):
+        self.flushes += 1
+
+
+def named_tensors():
+    return [('G/%d' % i, torch.randn(10 + i)) for i in range(5)] + [('D/0', torch.randn(3)), ('D/empty', torch.zeros(0))]
+
+
+def test_histogram_stats():
+    logger = RecordingLogger()
+    sampler = HistogramSampler(logger, bins=4)
+    x = torch.tensor([0.0, 1.0, 1.0, 2.0, 4.0])
+    assert sampler([('x', x)], 7) == ['x']
+    sampler.close()
+    (tag, counts, limits, lo, hi, num, total, squares, step), = logger.histograms
+    assert (tag, lo, hi, num, total, squares, step) == ('x', 0.0, 4.0, 5, 8.0, 22.0, 7)
+    np.testing.assert_array_equal(counts, [1, 2, 1, 1])
+    np.testing.assert_allclose(limits, [0, 1, 2, 3, 4])
+
+
+def test_subset_and_rotation():
+    logger = RecordingLogger()
+    sampler = HistogramSampler(logger, bins=8, pattern='^G/', max_tensors=2)
+    calls = [sampler(named_tensors(), step) for step in range(4)]
+    sampler.close()
+    assert calls == [['G/0', 'G/1'], ['G/2', 'G/3'], ['G/4', 'G/0'], ['G/1', 'G/2']]
+    assert [(h[0], h[-1]) for h in logger.histograms] == [(tag, step) for step, tags in enumerate(calls) for tag in tags]
+    assert logger.flushes == 4
+    # all the non empty tensors without a pattern
+    sampler = HistogramSampler(RecordingLogger())
+    assert sampler(named_tensors(), 0) == ['G/0', 'G/1', 'G/2', 'G/3', 'G/4', 'D/0']
+    sampler.close()
+
+
+def test_time_budget(monkeypatch):
+    clock = iter(np.arange(0, 100, 0.01))  # 10 ms per time.time() call
+    monkeypatch.setattr(histograms, 'time', types.SimpleNamespace(time=lambda: next(clock)))
+    sampler = HistogramSampler(RecordingLogger(), bins=8, budget_ms=25)
+    calls = [sampler(named_tensors(), step) for step in range(3)]
+    sampler.close()
+    # the tensor over budget is the last one of a call, the next call continues after it
+    assert calls == [['G/0', 'G/1', 'G/2'], ['G/3', 'G/4', 'D/0'], ['G/0', 'G/1', 'G/2']]
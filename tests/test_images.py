@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import PIL.Image
+import pytest
+import torch
+from references import sample_loop
+from utils.images import SampleWriter, grid_rows, sample_grid, to_uint8
+
+
+@pytest.mark.parametrize('batch_size', [4, 16, 32])
+def test_sample_grid_matches_loop(batch_size):
+    fake, real = torch.randn(batch_size, 3, 8, 8), torch.randn(batch_size, 3, 8, 8)
+    rows = grid_rows(batch_size)
+    expected = sample_loop(to_uint8(fake), to_uint8(real), rows).astype(np.uint8)
+    np.testing.assert_array_equal(sample_grid(fake, real, rows).numpy(), expected)
+
+
+def test_sample_writer(tmp_path):
+    grid = sample_grid(torch.randn(4, 3, 8, 8), torch.randn(4, 3, 8, 8), 2)
+    path = str(tmp_path / 'sample.png')
+    writer = SampleWriter()
+    writer.write(path, grid)
+    writer.close()
+    np.testing.assert_array_equal(np.asarray(PIL.Image.open(path)), grid.numpy())
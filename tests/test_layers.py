@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+from models.base_model import MinibatchStatConcatLayer
+from references import blend_gselect_forward, reference_mbstat
+
+
+@pytest.mark.parametrize('group_size', [None, 2])
+@pytest.mark.parametrize('averaging', ['all', 'flat', 'spatial', 'none', 'gpool', 'group4'])
+def test_mbstat_matches_reference(averaging, group_size):
+    x = torch.randn(8, 16, 4, 4)
+    layer = MinibatchStatConcatLayer(averaging, group_size)
+    torch.testing.assert_close(layer(x), reference_mbstat(x, averaging, group_size), rtol=1e-5, atol=1e-5)
+
+
+def test_fused_layers_match_unfused():
+    from models.base_model import ConvDownscale2d, UpscaleConv2d, he_init
+    import torch.nn.functional as F
+    up, down = UpscaleConv2d(8, 8, 3, 1, 1), ConvDownscale2d(8, 8, 3, 1, 1)
+    he_init(up, 'leaky_relu', 0.2)
+    he_init(down, 'leaky_relu', 0.2)
+    x = torch.randn(2, 8, 8, 8)
+    with torch.no_grad():
+        torch.testing.assert_close(up(x), F.conv2d(F.interpolate(x, scale_factor=2, mode='nearest'), up.weight * up.scale, up.bias, padding=1),
+                                   rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(down(x), F.avg_pool2d(F.conv2d(x, down.weight * down.scale, down.bias, padding=1), 2),
+                                   rtol=1e-4, atol=1e-4)
+
+
+def test_fused_generator_matches_unfused():
+    from models.model import Generator
+    kwargs = dict(num_channels=3, latent_size=16, resolution=256, fmap_max=16, fmap_base=2048)
+    G, G_fused = Generator(**kwargs), Generator(fused_scale=True, **kwargs)
+    G_fused.load_state_dict(dict(zip(G_fused.state_dict().keys(), G.state_dict().values())))
+    z = torch.randn(2, 16)
+    with torch.no_grad():
+        for level in [5, 6, 6.5, 7]:
+            torch.testing.assert_close(G_fused(z, cur_level=level), G(z, cur_level=level), rtol=1e-4, atol=1e-4)
+
+
+def test_gselect_matches_blend():
+    from models.model import Generator
+    G = Generator(num_channels=3, latent_size=16, resolution=32, fmap_max=16, fmap_base=64)
+    z = torch.randn(2, 16)
+    with torch.no_grad():
+        for level in [1, 2, 2.25, 3, 3.5, 4]:
+            torch.testing.assert_close(G(z, cur_level=level), blend_gselect_forward(G.output_layer, z, level), rtol=1e-5, atol=1e-5)
+
+
+def test_channels_last_matches_nchw():
+    from models.model import Generator, Discriminator
+    G_kwargs = dict(num_channels=3, latent_size=16, resolution=16, fmap_max=16, fmap_base=64)
+    D_kwargs = dict(num_channels=3, resolution=16, fmap_max=16, fmap_base=64)
+    G, D = Generator(**G_kwargs), Discriminator(**D_kwargs)
+    G_cl, D_cl = Generator(channels_last=True, **G_kwargs), Discriminator(channels_last=True, **D_kwargs)
+    G_cl.load_state_dict(G.state_dict())
+    D_cl.load_state_dict(D.state_dict())
+    z = torch.randn(4, 16)
+    with torch.no_grad():
+        for level in [1, 2, 2.5, 3]:
+            fake = G_cl(z, cur_level=level)
+            assert fake.is_contiguous(memory_format=torch.channels_last)
+            torch.testing.assert_close(D_cl(fake, cur_level=level), D(G(z, cur_level=level), cur_level=level), rtol=1e-4, atol=1e-4)
+
+
+def _d_grads(D, steps, checkpoint_resolution):
+    """Gradients of D's parameters after the forwards in steps, [(input, kwargs)], and one backward."""
+    D.zero_grad()
+    D.set_checkpoint(checkpoint_resolution)
+    torch.manual_seed(1)  # the same unseeded GDropLayer noise
+    loss = 0
+    for x, kwargs in steps:
+        kwargs = dict(kwargs)
+        before = kwargs.pop('before', None)
+        if before is not None:
+            before()
+        loss = loss + D(x, cur_level=3, **kwargs).mean()
+    loss.backward()
+    return [p.grad.clone() for p in D.parameters() if p.grad is not None]
+
+
+def test_checkpoint_recomputes_with_forward_gdrop_strength():
+    from models.model import Discriminator
+    D = Discriminator(num_channels=3, resolution=16, fmap_max=16, fmap_base=64)
+    x = torch.randn(4, 3, 16, 16)
+    steps = [(x, dict(gdrop_strength=0.2)), (x, dict(gdrop_strength=0.0))]  # the second call resets the strength
+    expected = _d_grads(D, steps, None)
+    for actual, grad in zip(_d_grads(D, steps, 8), expected):
+        torch.testing.assert_close(actual, grad, rtol=1e-5, atol=1e-6)
+
+
+def test_checkpoint_recomputes_with_forward_mbstat_pool():
+    from models.base_model import MinibatchStatPool
+    from models.model import Discriminator
+    D = Discriminator(num_channels=3, resolution=16, fmap_max=16, fmap_base=64)
+    xs = [torch.randn(4, 3, 16, 16) for _ in range(2)]
+    pool = MinibatchStatPool()
+    with torch.no_grad():
+        for x in xs:
+            D(x, cur_level=3, mbstat_pool=pool)
+    pool.collecting = False
+
+    def select(i):
+        return lambda: setattr(pool, 'index', i)
+    steps = [(x, dict(mbstat_pool=pool, before=select(i))) for i, x in enumerate(xs)]
+    expected = _d_grads(D, steps, None)
+    for actual, grad in zip(_d_grads(D, steps, 4), expected):
+        torch.testing.assert_close(actual, grad, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('mode', ['mul', 'drop', 'prop'])
+def test_gdrop_seeded_noise_is_reproducible(mode):
+    from models.base_model import GDropLayer
+    x = torch.randn(4, 8, 4, 4)
+    a, b = GDropLayer(mode, 0.3, seed=5), GDropLayer(mode, 0.3, seed=5)
+    first = a(x)
+    torch.testing.assert_close(b(x), first)  # same seed, same noise whatever the global RNG
+    assert not torch.equal(a(x), first)  # the generator advances
+    a.manual_seed(5)
+    torch.testing.assert_close(a(x), first)  # reseeding rewinds it
+    assert not torch.equal(GDropLayer(mode, 0.3, seed=6)(x), first)
+    assert torch.equal(a(x, deterministic=True), x) and torch.equal(GDropLayer(mode, 0)(x), x)
+
+
+def test_gdrop_unseeded_noise_follows_torch_seed():
+    from models.base_model import GDropLayer
+    layer, x = GDropLayer('mul', 0.3), torch.randn(4, 8, 4, 4)
+    torch.manual_seed(1)
+    first = layer(x)
+    torch.manual_seed(1)
+    torch.testing.assert_close(layer(x), first)
+
+
+def test_gdrop_strength_cache_is_invalidated_by_grow():
+    from models.model import Discriminator
+    D = Discriminator(num_channels=3, resolution=16, fmap_max=16, fmap_base=64, growable=True)
+    D(torch.randn(2, 3, 4, 4), cur_level=1, gdrop_strength=0.3)
+    assert D.gdrop_layers and all(layer.strength == 0.3 for layer in D.gdrop_layers)
+    D.gdrop_layers[0].strength = 0.7
+    D(torch.randn(2, 3, 4, 4), cur_level=1, gdrop_strength=0.3)
+    assert D.gdrop_layers[0].strength == 0.7  # same strength: the layers are not visited again
+    n = len(D.gdrop_layers)
+    D.grow(3)
+    assert len(D.gdrop_layers) > n
+    D(torch.randn(2, 3, 16, 16), cur_level=3, gdrop_strength=0.3)
+    assert all(layer.strength == 0.3 for layer in D.gdrop_layers)  # the new levels' layers too
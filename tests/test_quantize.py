@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+import math
+import pytest
+import torch
+from models.export import freeze_generator
+from models.model import Generator
+from models.quantize import quantization_report, quantize_generator
+
+
+@pytest.mark.skipif('fbgemm' not in torch.backends.quantized.supported_engines, reason='fbgemm backend not available')
+@pytest.mark.parametrize('fused_scale', [False, True])
+def test_quantize_generator_report(fused_scale):
+    torch.manual_seed(0)
+    G = Generator(num_channels=3, latent_size=16, resolution=32, fmap_max=16, fmap_base=256, fused_scale=fused_scale).eval()
+    frozen = freeze_generator(G)
+    quantized = quantize_generator(frozen, torch.randn(32, 16))
+    report = quantization_report(frozen, quantized, torch.randn(8, 16), batch_size=4)
+    assert set(report) == {'mse', 'psnr', 'ssim'}
+    assert all(math.isfinite(v) for v in report.values())
+    assert report['mse'] >= 0 and report['psnr'] > 20 and -1 <= report['ssim'] <= 1
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import http.client
+import json
+import threading
+import pytest
+import torch
+from models.model import Generator
+from serve import Handler, MicroBatcher, ModelCache, Server
+
+
+@pytest.fixture
+def server(tmp_path):
+    ckpt_dir = tmp_path / 'ckpts'
+    ckpt_dir.mkdir()
+    G = Generator(num_channels=3, latent_size=512, resolution=8, fmap_max=512, fmap_base=8192)
+    torch.save(G.state_dict(), str(ckpt_dir / '8x8-stabilize-10-G.pth'))
+    Handler.default_file = '8x8-stabilize-10'
+    Handler.batcher = MicroBatcher(ModelCache(str(ckpt_dir), torch.device('cpu')), max_batch=4, max_latency=0.001)
+    Handler.max_count = 4
+    httpd = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(address, body):
+    connection = http.client.HTTPConnection(*address)
+    connection.request('POST', '/generate', body=body if isinstance(body, bytes) else json.dumps(body).encode('utf-8'))
+    response = connection.getresponse()
+    result = response.status, json.loads(response.read())
+    connection.close()
+    return result
+
+
+def test_generate(server):
+    status, result = post(server, {'seed': 3, 'count': 2, 'level': 2})
+    assert status == 200 and result['seeds'] == [3, 4] and len(result['images']) == 2
+    status, result = post(server, {})
+    assert status == 200 and result['level'] == 2  # from the checkpoint name
+
+
+@pytest.mark.parametrize('body', [b'[1, 2]', b'"x"', b'{"seed": null}', b'{"count": 5}', b'{"count": 0}',
+                                  b'{"level": 0}', b'{"level": 2.5}', b'{"level": "a"}', b'{"which_file": "../x"}'])
+def test_bad_requests(server, body):
+    status, result = post(server, body)
+    assert status == 400 and 'error' in result
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import tempfile
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import train
+from models.model import Generator, Discriminator
+from utils.checkpoint import ckpt_order, find_resume, snapshot
+from utils.data import RandomNoiseGenerator
+from utils.sampling import ckpt_level, read_options
+
+
+class RandomImages(object):
+    """Dataset stand-in: uniform noise images in [-1, 1]."""
+    def __call__(self, batch_size, size, level=None):
+        return np.random.uniform(-1, 1, (batch_size, 3, size, size)).astype(np.float32)
+
+
+def build_pggan(exp_dir, resol=8, opts=None, G_kwargs=None, D_kwargs=None, latent_size=16):
+    """Small PGGAN writing to exp_dir, with noise images for data."""
+    options = dict(gpu='', train_kimg=0.016, transition_kimg=0.016, total_kimg=10, rampup_kimg=10, rampdown_kimg=10,
+                   g_lr_max=1e-3, d_lr_max=1e-3, fake_weight=0.1, beta1=0.0, beta2=0.99, gan='lsgan', first_resol=4,
+                   target_resol=resol, drift=1e-3, mbstat_avg='all', mbstat_group_size=0, sample_freq=1000,
+                   save_freq=1000, exp_dir=exp_dir, no_noise=False, no_tanh=True, restore_dir='', which_file='')
+    options.update(opts or {})
+    G = Generator(num_channels=3, latent_size=latent_size, resolution=resol, fmap_max=latent_size,
+                  fmap_base=4 * latent_size, **(G_kwargs or {}))
+    D = Discriminator(num_channels=3, resolution=resol, fmap_max=latent_size, fmap_base=4 * latent_size,
+                      **dict(dict(sigmoid_at_end=True), **(D_kwargs or {})))
+    return train.PGGAN(G, D, RandomImages(), RandomNoiseGenerator(latent_size), options)
+
+
+@pytest.fixture
+def make_pggan(tmp_path, monkeypatch):
+    """Factory of build_pggan with a fresh experiment directory in tmp_path each call."""
+    monkeypatch.chdir(tmp_path)  # the tensorboard logs go to ./logs
+    return lambda *args, **kwargs: build_pggan(tempfile.mkdtemp(dir=str(tmp_path)), *args, **kwargs)
+
+
+def test_amp_bfloat16_cpu():
+    torch.manual_seed(0)
+    G = Generator(num_channels=3, latent_size=16, resolution=16, fmap_max=16, fmap_base=64)
+    D = Discriminator(num_channels=3, resolution=16, fmap_max=16, fmap_base=64)
+    z = torch.randn(4, 16)
+    for level in [1, 1.5, 2, 2.5, 3]:
+        with torch.no_grad():
+            expected = D(G(z, cur_level=level), cur_level=level)
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                d = D(G(z, cur_level=level), cur_level=level)
+        assert torch.isfinite(d.float()).all()
+        torch.testing.assert_close(d.float(), expected, rtol=0, atol=5e-2)
+
+
+def test_amp_bfloat16_training(make_pggan):
+    torch.manual_seed(0)
+    pggan = make_pggan(opts=dict(amp=True, amp_dtype='bfloat16'))
+    assert not pggan.scaler_G.is_enabled() and not pggan.scaler_D.is_enabled()  # no loss scaling for bfloat16
+    pggan.train()
+    for p in list(pggan.G.parameters()) + list(pggan.D.parameters()):
+        assert p.dtype == torch.float32 and torch.isfinite(p).all()
+
+
+def test_round_batch_size(make_pggan):
+    pggan = make_pggan(D_kwargs=dict(mbstat_group_size=4))
+    pggan.world_size = 3
+    assert pggan.round_batch_size(32) == 36  # 12 per rank, 3 groups of 4
+    assert pggan.round_batch_size(6) == 6  # 2 per rank, smaller than a group
+    assert pggan.round_batch_size(4) == 6
+
+
+def _ddp_worker(rank, world_size, port, exp_dir, results):
+    os.environ['MASTER_ADDR'], os.environ['MASTER_PORT'] = '127.0.0.1', str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    os.chdir(exp_dir)  # the tensorboard logs go to ./logs
+    torch.manual_seed(0)  # same initial G and D on every rank
+    pggan = build_pggan(exp_dir, G_kwargs=dict(growable=True), D_kwargs=dict(growable=True, mbstat_group_size=2))
+    np.random.seed(rank)  # each rank its own latents and images
+    torch.manual_seed(rank)
+    pggan.train()
+    params = torch.cat([p.detach().flatten() for p in list(pggan.G.parameters()) + list(pggan.D.parameters())])
+    gathered = [torch.zeros_like(params) for _ in range(world_size)]
+    dist.all_gather(gathered, params)
+    results.put((rank, max((g - params).abs().max().item() for g in gathered)))
+    dist.destroy_process_group()
+
+
+def test_ddp_gloo(tmp_path):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    world_size = 2
+    results = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(_ddp_worker, args=(world_size, port, tempfile.mkdtemp(dir=str(tmp_path)), results), nprocs=world_size)
+    results = sorted(results.get() for _ in range(world_size))
+    assert [rank for rank, _ in results] == list(range(world_size))
+    for rank, max_diff in results:
+        assert max_diff == 0, 'rank %d has different parameters' % rank
+
+
+def test_tune_batch_size_simulated_budget(make_pggan):
+    budget_mb = 4
+    pggan = make_pggan(resol=16, opts=dict(auto_bs=True, bs_memory_budget=budget_mb, bs_max=32))
+    pggan.create_optimizer()
+    pggan.create_criterion()
+    pggan.register_on_gpu()
+    for R in range(1, 4):
+        pggan.tune_batch_size(R, 4)
+        cur_level = R + 0.5 if R < 3 else R  # probed half way through the fade in
+        batch_size = pggan.bs_map[2 ** (R + 1)]
+        assert batch_size & (batch_size - 1) == 0 and batch_size <= 32  # a power of two up to bs_max
+        assert pggan.probe_memory(batch_size, cur_level) <= budget_mb * 2**20
+        if batch_size < 32:
+            assert pggan.probe_memory(2 * batch_size, cur_level) > budget_mb * 2**20
+    assert pggan.bs_tuned == {4, 8, 16}
+
+
+def test_tune_batch_size_over_budget(make_pggan):
+    pggan = make_pggan(opts=dict(auto_bs=True, bs_memory_budget=0.01))
+    pggan.create_optimizer()
+    pggan.create_criterion()
+    pggan.register_on_gpu()
+    with pytest.raises(RuntimeError, match='over the memory budget'):
+        pggan.tune_batch_size(1, 3)
+
+
+def test_noise_strength_zero_is_a_number(make_pggan):
+    pggan = make_pggan()
+    d, numbers = None, 0
+    for it in range(30):
+        d_real = 0.0 if it < 5 else 1.0
+        pggan.d_real = torch.full((4,), d_real)
+        strength = pggan.compute_noise_strength()
+        if d is None or d * 0.9 + 0.1 <= 0.5:  # zero whatever d_real: a number, GDropLayer draws no noise
+            assert not torch.is_tensor(strength) and strength == 0
+            numbers += 1
+        d = 0.0 if d is None else d * 0.9 + d_real * 0.1
+        assert float(strength) == pytest.approx(0.2 * max(d - 0.5, 0) ** 2, abs=1e-6)
+    assert 5 < numbers < 30 and torch.is_tensor(strength)
+
+
+@pytest.mark.parametrize('accum_steps', [1, 2])
+def test_ckpt_level_of_fade_in_checkpoints(make_pggan, accum_steps):
+    pggan = make_pggan(opts=dict(accum_steps=accum_steps, train_kimg=0.128, transition_kimg=0.128, save_freq=1))
+    pggan.bs_map = {resol: 4 for resol in pggan.bs_map}
+    pggan.save_options()
+    levels, saved = [], {}
+    step_G, save = pggan.step_G, pggan.save
+    pggan.step_G = lambda batches, cur_level: (levels.append(cur_level), step_G(batches, cur_level))
+    pggan.save = lambda which_file, state=None: (saved.setdefault(which_file, levels[-1]), save(which_file, state))[1]
+    pggan.train()
+    opts = read_options(os.path.dirname(pggan.opts['ckpt_dir']))
+    assert list(saved) == sorted(saved, key=ckpt_order)  # also the first fade in iteration, still at level R
+    fade_in = [name for name in saved if '-fade_in-' in name]
+    assert fade_in and all(name.startswith('8x8-') for name in fade_in)
+    for name in fade_in:
+        assert ckpt_level(name, opts) == pytest.approx(saved[name])
+
+
+def test_update_ema_halflife_every_and_growth(make_pggan):
+    torch.manual_seed(0)
+    pggan = make_pggan(opts=dict(ema_halflife_kimg=0.01, ema_every=2), G_kwargs=dict(growable=True), D_kwargs=dict(growable=True))
+    pggan.create_optimizer()
+    pggan.create_criterion()
+    pggan.register_on_gpu()
+    batch_size, beta = 4, 0.5 ** (4 * 2 / 10.0)  # half-life of 10 images, updates covering 2 batches
+
+    def step(it):
+        with torch.no_grad():
+            for p in pggan.G.parameters():
+                p.add_(torch.randn_like(p))
+        before = {k: v.clone() for k, v in pggan.Gs.state_dict().items()}
+        pggan.update_ema(it, batch_size)
+        return before
+
+    before = step(0)  # ema_every=2: no update at the first iteration
+    for k, v in pggan.Gs.state_dict().items():
+        assert torch.equal(v, before[k])
+    for cur_level in [1, 2]:
+        if cur_level == 2:
+            pggan.grow_models(cur_level)
+            G_state, Gs_state = pggan.G.state_dict(), pggan.Gs.state_dict()
+            assert set(Gs_state) == set(G_state)
+            new_keys = [k for k in G_state if k.startswith('output_layer.chain.1.') or k.startswith('output_layer.post.1.')]
+            assert new_keys
+            for k in new_keys:  # newly grown levels start as a copy of G
+                assert torch.equal(Gs_state[k], G_state[k])
+        before = step(1)
+        G_state = pggan.G.state_dict()
+        for k, v in pggan.Gs.state_dict().items():
+            torch.testing.assert_close(v, before[k] + (1 - beta) * (G_state[k] - before[k]))
+            assert not torch.equal(v, before[k])
+
+
+def test_phases_without_iterations(make_pggan):
+    pggan = make_pggan(opts=dict(train_kimg=0.01, transition_kimg=0.01))  # fewer images than a batch
+    pggan.train()
+    assert not os.listdir(pggan.opts['ckpt_dir'])
+
+
+def test_resume_matches_uninterrupted_run(make_pggan):
+    def make(**opts):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        pggan = make_pggan(opts=dict(dict(train_kimg=0.032, transition_kimg=0.032, save_freq=3, keep_ckpts=0), **opts),
+                           G_kwargs=dict(growable=True), D_kwargs=dict(growable=True))
+        pggan.bs_map = {resol: 4 for resol in pggan.bs_map}
+        return pggan
+
+    def tensors(pggan):
+        return [pggan.G.state_dict(), pggan.D.state_dict(), pggan.optim_G.state_dict()['state'], pggan.optim_D.state_dict()['state']]
+
+    full = make()
+    full.train()
+    restore_dir = os.path.dirname(full.opts['ckpt_dir'])
+    expected = [snapshot(sd) for sd in tensors(full)]
+    for which_file in ['4x4-stabilize-000003', '8x8-fade_in-000012']:
+        resumed = make(restore_dir=restore_dir, which_file=which_file)
+        resumed.train()
+        for sd, expected_sd in zip(tensors(resumed), expected):
+            assert sd.keys() == expected_sd.keys()
+            for k in sd:
+                for v, expected_v in zip(*[x.values() if isinstance(x, dict) else [x] for x in [sd[k], expected_sd[k]]]):
+                    assert torch.equal(torch.as_tensor(v), torch.as_tensor(expected_v)), k
+
+    # the newest complete training state, skipping a truncated one
+    names = sorted((f[:-len('-state.pth')] for f in os.listdir(full.opts['ckpt_dir']) if f.endswith('-state.pth')), key=ckpt_order)
+    assert len(names) > 2
+    for i, name in enumerate(names):
+        path = os.path.join(full.opts['ckpt_dir'], name + '-state.pth')
+        os.utime(path, (1e9 + i, 1e9 + i))
+    assert find_resume(full.opts['exp_dir']) == (restore_dir, names[-1])
+    with open(os.path.join(full.opts['ckpt_dir'], names[-1] + '-state.pth'), 'r+b') as f:
+        f.truncate(os.path.getsize(f.name) // 2)
+    assert find_resume(full.opts['exp_dir']) == (restore_dir, names[-2])
+
+
+def test_noise_strength_updated_once_per_step(make_pggan):
+    torch.manual_seed(0)
+    pggan = make_pggan(opts=dict(accum_steps=3, mbstat_accum=True), D_kwargs=dict(mbstat_group_size=2))
+    pggan.create_optimizer()
+    pggan.create_criterion()
+    pggan.register_on_gpu()
+    pggan._d_, pggan._d_max = torch.tensor(0.9), 0.9  # a noise strength above zero
+    pggan._copy_d_to_host()
+    pggan.d_real = torch.full((4, 1), 0.7)
+    strengths, passed = [], []
+    compute_noise_strength = pggan.compute_noise_strength
+    pggan.compute_noise_strength = lambda update=True: (strengths.append(compute_noise_strength()) or strengths[-1]
+                                                        if update else compute_noise_strength(update))
+    pggan.netD.register_forward_pre_hook(lambda m, args: passed.extend(kw.get('gdrop_strength') for kw in args[1]))
+    pggan.D.register_forward_pre_hook(  # the mbstat pools, without gradient
+        lambda m, args, kwargs: None if torch.is_grad_enabled() else passed.append(kwargs.get('gdrop_strength')), with_kwargs=True)
+    for step in range(2):
+        d_before, d_real = pggan._d_.clone(), pggan.d_real
+        batches = [(pggan.noise(2), np.random.uniform(-1, 1, (2, 3, 8, 8)).astype(np.float32)) for _ in range(3)]
+        pggan.step_D(batches, 2)
+        assert len(strengths) == step + 1
+        torch.testing.assert_close(pggan._d_, d_before * 0.9 + d_real.mean().clamp(0, 1) * 0.1)
+        # the real images of the mbstat pool and of the D passes get the same strength
+        real_passes = [s for s in passed if s is not None]
+        assert len(real_passes) == 6 and all(s is strengths[-1] for s in real_passes)
+        assert torch.is_tensor(strengths[-1]) and strengths[-1] > 0
+        assert pggan.d_real.size(0) == 6  # D's outputs on the real images of every micro-batch
+        passed.clear()
+
+
+@pytest.mark.parametrize('d_reg', ['gp', 'r1'])
+@pytest.mark.parametrize('reg_every', [1, 3])
+def test_gradient_penalty(make_pggan, d_reg, reg_every):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    pggan = make_pggan(opts=dict(gan='wgan_gp', drift=0, d_reg=d_reg, reg_every=reg_every, gp_lambda=5.0, r1_gamma=3.0),
+                       D_kwargs=dict(sigmoid_at_end=False))
+    pggan.create_optimizer()
+    pggan.create_criterion()
+    pggan.register_on_gpu()
+    pggan.preprocess(pggan.noise(4), np.random.uniform(-1, 1, (4, 3, 8, 8)).astype(np.float32))
+    pggan.reg_step = True
+    pggan.forward_D(2)
+    x = pggan.d_reg_inputs[0].detach().clone().requires_grad_(True)
+    if d_reg == 'gp':  # a random interpolation of each real image and its fake
+        fake, delta = pggan.fake.detach(), pggan.real - pggan.fake.detach()
+        eps = ((x - fake) * delta).sum(dim=[1, 2, 3], keepdim=True) / (delta * delta).sum(dim=[1, 2, 3], keepdim=True)
+        torch.testing.assert_close(x, fake + eps * delta)
+        assert ((eps >= 0) & (eps <= 1)).all()
+    else:
+        assert torch.equal(x, pggan.real)
+    grad, = torch.autograd.grad(pggan.D(x, cur_level=2).sum(), x)
+    norm = grad.flatten(1).norm(dim=1)
+    expected = 5.0 * torch.mean((norm - 1) ** 2) if d_reg == 'gp' else 3.0 / 2 * torch.mean(norm ** 2)
+    torch.testing.assert_close(pggan.compute_additional_d_loss(), expected * reg_every)
+    assert pggan.d_reg_inputs is None  # computed once
+
+
+def test_lazy_regularization_every_k_steps(make_pggan):
+    pggan = make_pggan(opts=dict(gan='wgan_gp', d_reg='r1', reg_every=3, train_kimg=0.032, transition_kimg=0.032),
+                       D_kwargs=dict(sigmoid_at_end=False))
+    pggan.bs_map = {resol: 4 for resol in pggan.bs_map}
+    penalties, its = [], []
+    input_gradient, report = pggan.input_gradient, pggan.report
+    pggan.input_gradient = lambda out, x: (penalties.append(len(its)), input_gradient(out, x))[1]
+    pggan.report = lambda it, *args, **kwargs: (its.append(it), report(it, *args, **kwargs))
+    pggan.train()
+    assert len(its) == 8 + 7 + 8
+    assert penalties == [i for i, it in enumerate(its) if it % 3 == 0]
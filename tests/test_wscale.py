@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import torch
+import torch.nn as nn
+from models.base_model import EqualizedConv2d, WScaleLayer, convert_wscale_state_dict, he_init
+
+
+class Block(nn.Module):
+    """conv 3x3 + leaky relu + 1x1 to_rgb, in the old (Conv2d + WScaleLayer) or the new layout."""
+    def __init__(self, legacy):
+        super(Block, self).__init__()
+        layers = []
+        for in_channels, out_channels, kernel_size, padding, init in [(8, 16, 3, 1, 'leaky_relu'), (16, 3, 1, 0, 'linear')]:
+            conv = (nn.Conv2d if legacy else EqualizedConv2d)(in_channels, out_channels, kernel_size, 1, padding)
+            he_init(conv, init, 0.2 if init == 'leaky_relu' else None)
+            layers += [conv, WScaleLayer(conv)] if legacy else [conv]
+            layers += [nn.LeakyReLU(0.2)] if init == 'leaky_relu' else []
+        self.seq = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.seq(x)
+
+
+def test_convert_preserves_outputs():
+    torch.manual_seed(0)
+    old = Block(legacy=True)
+    with torch.no_grad():  # a trained checkpoint no longer has unit RMS weights
+        for p in old.parameters():
+            p.add_(0.3 * torch.randn_like(p))
+    x = torch.randn(4, 8, 8, 8)
+    expected = old(x)
+
+    torch.manual_seed(0)  # same initial weights as the old model the checkpoint would be loaded into
+    new = Block(legacy=False)
+    state_dict = convert_wscale_state_dict(old.state_dict(), new)
+    assert sorted(state_dict) == sorted(new.state_dict())
+    new.load_state_dict(state_dict)
+    torch.testing.assert_close(new(x), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_new_layout_unchanged():
+    new = Block(legacy=False)
+    state_dict = new.state_dict()
+    assert convert_wscale_state_dict(state_dict, new) is state_dict
@@ -1,14 +1,58 @@
 import torch
+import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch.autograd import Variable
+from torch.nn.parallel import DistributedDataParallel
+import contextlib
+import copy
 import os
 import time
 from utils.data import CelebA, RandomNoiseGenerator
 from models.model import Generator, Discriminator
+from models.base_model import GDropLayer, MinibatchStatPool
 import argparse
 import numpy as np
-from scipy.misc import imsave
 from utils.logger import Logger
+from utils.checkpoint import CheckpointWriter, find_resume, snapshot
+from utils.autotune import largest_batch_size, measure_peak
+from utils.histograms import HistogramSampler
+from utils.images import SampleWriter, grid_rows, sample_grid
+
+
+class MultiForward(nn.Module):
+    """
+    Runs D on several batches in one forward call: DistributedDataParallel supports a single
+    forward per backward, and D sees real and fake images (with different kwargs) in the D step.
+    """
+    def __init__(self, D):
+        super(MultiForward, self).__init__()
+        self.D = D
+
+    def forward(self, inputs, kwargs):
+        return [self.D(x, **kw) for x, kw in zip(inputs, kwargs)]
+
+
+class LossAccumulator(object):
+    """Running sums of named losses kept on the device, only means() reads them on the host."""
+    def __init__(self, names):
+        self.names = names
+        self.sums = None
+        self.count = 0
+
+    def add(self, losses):
+        ref = next(v for v in losses.values() if torch.is_tensor(v))
+        values = torch.stack([losses[n].detach().float().reshape(()) if torch.is_tensor(losses[n])
+                              else ref.new_full((), losses[n], dtype=torch.float32) for n in self.names])
+        self.sums = values if self.sums is None else self.sums + values
+        self.count += 1
+
+    def means(self):
+        """{name: mean since the last call}."""
+        values = (self.sums / self.count).tolist()
+        self.sums, self.count = None, 0
+        return dict(zip(self.names, values))
 
 
 class PGGAN(object):
@@ -19,17 +63,55 @@ class PGGAN(object):
         self.noise = noise
         self.opts = opts
         self.current_time = time.strftime('%Y-%m-%d %H%M%S')
-        self.logger = Logger('./logs/' + self.current_time + "/")
+
+        # data parallel training, one process per rank (see run()), rank 0 logs, samples and saves
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        self.is_master = self.rank == 0
+
+        self.logger = Logger('./logs/' + self.current_time + "/") if self.is_master else None
+        self.losses = LossAccumulator(['G', 'D', 'G_adv', 'G_add', 'D_adv', 'D_add', 'D_adv_fake', 'D_adv_real'])
+        self._report_time = time.time()
+        if self.is_master:
+            self.histograms = HistogramSampler(self.logger, self.opts.get('histo_bins', 1000), self.opts.get('histo_layers'),
+                                               self.opts.get('histo_max_tensors', 0), self.opts.get('histo_budget_ms', 0))
+            self.samples = SampleWriter(self.logger)
         gpu = self.opts['gpu']
         self.use_cuda = len(gpu) > 0
         os.environ['CUDA_VISIBLE_DEVICES'] = gpu
-
-        self.bs_map = {2**R: self.get_bs(2**R) for R in range(2, 11)}  # batch size map keyed by resolution_level
-        self.rows_map = {32: 8, 16: 4, 8: 4, 4: 2, 2: 2}
+        if self.use_cuda:
+            self.device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', self.rank)))
+            torch.cuda.set_device(self.device)
+        else:
+            self.device = torch.device('cpu')
+
+        # automatic mixed precision, fp16 needs loss scaling, bf16 does not
+        self.use_amp = self.opts.get('amp', False)
+        self.amp_dtype = getattr(torch, self.opts.get('amp_dtype', 'float16'))
+        use_scaler = self.use_amp and self.amp_dtype == torch.float16
+        self.scaler_G = torch.amp.GradScaler(self.device.type, enabled=use_scaler)
+        self.scaler_D = torch.amp.GradScaler(self.device.type, enabled=use_scaler)
+
+        self.bs_map = {2**R: self.round_batch_size(self.get_bs(2**R)) for R in range(2, 11)}  # batch size map keyed by resolution_level
+        self.accum_steps = self.opts.get('accum_steps', 1)  # micro-batches of bs_map images per optimizer step
+        self.reg_step = False  # whether the D step computes the gradient penalty, every reg_every iterations
+        self.bs_tuned = set()  # resolutions whose batch size was chosen by tune_batch_size()
+        self.rows_map = {32: 8, 16: 4, 8: 4, 4: 2, 2: 2}  # sample grid rows, other batch sizes use grid_rows
+
+        # exponential moving average of G (Gs in the original implementation), used for samples and evaluation
+        self.Gs = None
+        if self.opts.get('ema_halflife_kimg', 0) > 0 and self.is_master:
+            self.Gs = copy.deepcopy(self.G).eval().requires_grad_(False)
 
         self.restore_model()
 
-        # save opts
+        self.save_options()
+
+    def save_options(self):
+        """Write the options and the batch size map, again whenever the map changes."""
+        if not self.is_master:
+            return
         with open(os.path.join(self.opts['exp_dir'], self.time, 'options_%s.txt' % self.current_time), 'w') as f:
             for k, v in self.opts.items():
                 print('%s: %s' % (k, v), file=f)
@@ -39,6 +121,7 @@ class PGGAN(object):
         exp_dir = self.opts['restore_dir']
         which_file = self.opts['which_file']  # 128x128-fade_in-105000
         self.current_time = time.strftime('%Y-%m-%d %H%M%S')
+        self._resume_state = None
         if exp_dir == '' or which_file == '':
             self.time = self.current_time
             self._from_resol = self.opts['first_resol']
@@ -47,8 +130,9 @@ class PGGAN(object):
             self.is_restored = False
             self.opts['sample_dir'] = os.path.join(self.opts['exp_dir'], self.current_time, 'samples')
             self.opts['ckpt_dir'] = os.path.join(self.opts['exp_dir'], self.current_time, 'ckpts')
-            os.makedirs(self.opts['sample_dir'])
-            os.makedirs(self.opts['ckpt_dir'])
+            if self.is_master:
+                os.makedirs(self.opts['sample_dir'])
+                os.makedirs(self.opts['ckpt_dir'])
             return
         else:
             pattern = which_file.split('-')
@@ -67,6 +151,17 @@ class PGGAN(object):
             assert os.path.exists(G_model) and os.path.exists(D_model)
             self.G.load_state_dict(torch.load(G_model))
             self.D.load_state_dict(torch.load(D_model))
+            if self.Gs is not None:
+                Gs_model = os.path.join(self.opts['ckpt_dir'], which_file + '-Gs.pth')
+                self.Gs.load_state_dict(torch.load(Gs_model if os.path.exists(Gs_model) else G_model))
+                self.Gs.requires_grad_(False)  # levels built by a growable Gs while loading
+            state_file = os.path.join(self.opts['ckpt_dir'], which_file + '-state.pth')
+            if os.path.exists(state_file):
+                # optimizers, RNGs and the exact position, fade_in checkpoints are named after the next resolution
+                self._resume_state = torch.load(state_file, map_location='cpu', weights_only=False)
+                self._from_resol = 2 ** (self._resume_state['R'] + 1)
+                self._phase = self._resume_state['phase']
+                self._epoch = self._resume_state['it']
             self.is_restored = True
             print('Restored from dir: %s, pattern: %s' % (exp_dir, which_file))
 
@@ -78,14 +173,242 @@ class PGGAN(object):
             bs = 8 / 2**(min(2, R - 7))
         return int(bs)
 
+    def round_batch_size(self, batch_size):
+        """
+        Smallest batch size >= batch_size that splits into equal shares of the ranks, each a
+        multiple of D's minibatch stddev group size (or smaller than a group).
+        """
+        group_size = getattr(self.D, 'mbstat_group_size', None) or 1
+        local_batch_size = int(np.ceil(batch_size / float(self.world_size)))
+        if local_batch_size > group_size:
+            local_batch_size = int(np.ceil(local_batch_size / float(group_size))) * group_size
+        return local_batch_size * self.world_size
+
+    def memory_budget(self):
+        """Bytes a training iteration may use for tune_batch_size(), 0 when unknown."""
+        budget = self.opts.get('bs_memory_budget', 0) * 2**20
+        if not budget and self.use_cuda:
+            budget = torch.cuda.get_device_properties(self.device).total_memory * self.opts.get('bs_memory_fraction', 0.9)
+        return budget
+
+    def probe_memory(self, local_batch_size, cur_level):
+        """
+        Peak memory of a training iteration of local_batch_size samples at cur_level (see measure_peak).
+        Weights, optimizer and scaler states, RNGs and the noise strength are restored afterwards.
+        """
+        saved = {'G': snapshot(self.G.state_dict()), 'D': snapshot(self.D.state_dict()),
+                 'optim_G': snapshot(self.optim_G.state_dict()), 'optim_D': snapshot(self.optim_D.state_dict()),
+                 'scaler_G': self.scaler_G.state_dict(), 'scaler_D': self.scaler_D.state_dict(), 'rng': self.rng_state()}
+        members = {k: getattr(self, k, None) for k in ['_d_', '_d_max', '_d_copy', 'd_real']}
+        nets = self.netG, self.netD
+        self.netG, self.netD = self.G, MultiForward(self.D)  # no collectives, ranks may probe different sizes
+        self.update_checkpointing(local_batch_size, verbose=False)
+        self.reg_step = self.d_reg != 'none'  # the penalty's double backprop is part of the peak
+
+        def d_step():
+            self.preprocess(self.noise(local_batch_size), self.data(local_batch_size, 2 ** int(np.ceil(cur_level + 1)), cur_level))
+            self.optim_D.zero_grad()
+            self.forward_D(cur_level, detach=True, gdrop_strength=self.compute_noise_strength(update=False))
+            self.backward_D()
+
+        def g_step():
+            self.optim_G.zero_grad()
+            self.D.requires_grad_(False)
+            try:
+                self.forward_G(cur_level)
+                self.backward_G()
+            finally:
+                self.D.requires_grad_(True)
+
+        def kept_tensors():
+            models = [self.G, self.D] + ([self.Gs] if self.Gs is not None else [])
+            tensors = [t for m in models for t in list(m.parameters()) + list(m.buffers())]
+            tensors += [p.grad for m in models for p in m.parameters()]
+            tensors += [v for o in [self.optim_G, self.optim_D] for state in o.state.values() for v in state.values()]
+            return [t for t in tensors if torch.is_tensor(t)]
+
+        try:
+            return measure_peak([d_step, g_step], self.device, kept_tensors)
+        finally:
+            self.optim_G.zero_grad()
+            self.optim_D.zero_grad()
+            self.fake = self.d_fake = None
+            self.G.load_state_dict(saved['G'])
+            self.D.load_state_dict(saved['D'])
+            self.optim_G.load_state_dict(saved['optim_G'])
+            self.optim_D.load_state_dict(saved['optim_D'])
+            self.scaler_G.load_state_dict(saved['scaler_G'])
+            self.scaler_D.load_state_dict(saved['scaler_D'])
+            self.set_rng_state(saved['rng'])
+            for k, v in members.items():
+                if v is None:
+                    self.__dict__.pop(k, None)
+                else:
+                    setattr(self, k, v)
+            self.netG, self.netD = nets
+
+    def tune_batch_size(self, R, to_level):
+        """
+        Set the batch size of level R (resolution 2 ** (R + 1)) to the largest power of two, up to
+        bs_max, whose iterations fit memory_budget(). Probed where the level needs the most memory,
+        half way through its fade in if it has one. Every rank probes its share of the batch and
+        all use the smallest result.
+        """
+        resolution = 2 ** (R + 1)
+        budget = self.memory_budget()
+        if not budget:
+            if self.is_master:
+                print('No memory budget for the batch size auto-tuner on %s, use --bs_memory_budget' % self.device.type)
+            return
+        cur_level = R + 0.5 if R < to_level - 1 else R
+        self.grow_models(int(np.ceil(cur_level)))
+        max_local = int(np.ceil(self.opts.get('bs_max', 64) / float(self.world_size)))
+        candidates = [2 ** i for i in range(int(np.log2(max_local)) + 1)]
+        local_batch_size, probed = largest_batch_size(lambda bs: self.probe_memory(bs, cur_level), budget, candidates)
+        if local_batch_size is None:
+            raise RuntimeError('A batch of 1 needs %.0f MB at %dx%d, over the memory budget of %.0f MB' %
+                               (probed[1] / 2**20, resolution, resolution, budget / 2**20))
+        self.wrap_models()  # fresh DistributedDataParallel reducers, the probes' backward marked parameters as used
+        if self.distributed:
+            result = torch.tensor([local_batch_size], device=self.device)
+            dist.all_reduce(result, op=dist.ReduceOp.MIN)
+            local_batch_size = int(result.item())
+        self.bs_map[resolution] = local_batch_size * self.world_size
+        self.bs_tuned.add(resolution)
+        if self.is_master:
+            print('Batch size at %dx%d: %d (probed MB per rank: %s, budget %.0f MB)' % (
+                resolution, resolution, self.bs_map[resolution],
+                ', '.join('%d: %.0f' % (bs, b / 2**20) for bs, b in probed.items()), budget / 2**20))
+        self.save_options()
+
     def register_on_gpu(self):
         if self.use_cuda:
-            self.G.cuda()
-            self.D.cuda()
+            self.G.to(self.device)
+            self.D.to(self.device)
+            if self.Gs is not None:
+                self.Gs.to(self.device)
+        self.cache_ema_params()
+        self.wrap_models()
+
+    def wrap_models(self):
+        """
+        netG and netD run the forward passes of the G and D steps: DistributedDataParallel wrappers
+        when training on several ranks, rebuilt whenever levels are added so that the new parameters
+        are broadcast from rank 0 and registered for gradient all-reduce.
+        """
+        self.netG, self.netD = self.G, MultiForward(self.D)
+        if not self.distributed:
+            return
+        device_ids = [self.device.index] if self.use_cuda else None
+        # levels other than cur_level get no gradient
+        self.netG = DistributedDataParallel(self.netG, device_ids=device_ids, find_unused_parameters=True, broadcast_buffers=False)
+        self.netD = DistributedDataParallel(self.netD, device_ids=device_ids, find_unused_parameters=True, broadcast_buffers=False)
 
     def create_optimizer(self):
-        self.optim_G = optim.Adam(self.G.parameters(), lr=self.opts['g_lr_max'], betas=(self.opts['beta1'], self.opts['beta2']))
-        self.optim_D = optim.Adam(self.D.parameters(), lr=self.opts['d_lr_max'], betas=(self.opts['beta1'], self.opts['beta2']))
+        # one param group per level, so that levels built later by grow_models() can be appended
+        self.optim_G = optim.Adam([{'params': p} for p in self.G.level_parameters()], lr=self.opts['g_lr_max'], betas=(self.opts['beta1'], self.opts['beta2']))
+        self.optim_D = optim.Adam([{'params': p} for p in self.D.level_parameters()], lr=self.opts['d_lr_max'], betas=(self.opts['beta1'], self.opts['beta2']))
+
+    def grow_models(self, cur_level):
+        """Build the G and D blocks needed at cur_level (growable models) and register them with the optimizers."""
+        new_params = self.G.grow(cur_level)
+        for params in new_params:
+            self.optim_G.add_param_group({'params': params})
+        new_d_params = self.D.grow(cur_level)
+        for params in new_d_params:
+            self.optim_D.add_param_group({'params': params})
+        if new_params or new_d_params:
+            self.wrap_models()
+        if self.Gs is not None and new_params:
+            # new levels start from G's initialization
+            for params, ema_params in zip(new_params, self.Gs.grow(cur_level)):
+                for p, ema_p in zip(params, ema_params):
+                    ema_p.requires_grad_(False).copy_(p.detach())
+            self.cache_ema_params()
+
+    def rng_state(self):
+        """RNG states of this rank: numpy (latents and data), torch, cuda and the seeded GDrop layers."""
+        state = {'numpy': np.random.get_state(), 'torch': torch.get_rng_state(), 'gdrop': {}}
+        if self.use_cuda:
+            state['cuda'] = torch.cuda.get_rng_state(self.device)
+        for prefix, net in [('G.', self.G), ('D.', self.D)]:
+            for name, m in net.named_modules():
+                if isinstance(m, GDropLayer) and m._generators:
+                    state['gdrop'][prefix + name] = {str(device): g.get_state() for device, g in m._generators.items()}
+        return state
+
+    def set_rng_state(self, state):
+        np.random.set_state(state['numpy'])
+        torch.set_rng_state(state['torch'])
+        if self.use_cuda and 'cuda' in state:
+            torch.cuda.set_rng_state(state['cuda'], self.device)
+        modules = {}
+        for prefix, net in [('G.', self.G), ('D.', self.D)]:
+            modules.update((prefix + name, m) for name, m in net.named_modules())
+        for name, generators in state['gdrop'].items():
+            for device, g in generators.items():
+                modules[name]._generator(torch.device(device)).set_state(g)
+
+    def training_state(self, R, phase, it, cur_nimg):
+        """Everything besides the weights needed to continue training exactly, collective with several ranks."""
+        rng = [self.rng_state()]
+        if self.distributed:
+            rng = [None] * self.world_size
+            dist.all_gather_object(rng, self.rng_state())
+        return {'R': R, 'phase': phase, 'it': it, 'cur_nimg': cur_nimg,
+                'bs_map': self.bs_map, 'bs_tuned': self.bs_tuned,
+                'optim_G': self.optim_G.state_dict(), 'optim_D': self.optim_D.state_dict(),
+                'scaler_G': self.scaler_G.state_dict(), 'scaler_D': self.scaler_D.state_dict(),
+                '_d_': getattr(self, '_d_', None), 'd_real_mean': torch.mean(self.d_real.float()).item(), 'rng': rng}
+
+    def load_training_state(self, state):
+        self.bs_map.update(state.get('bs_map', {}))  # the iteration counts are in batches of these sizes
+        self.bs_tuned.update(state.get('bs_tuned', set()))
+        self.save_options()
+        # optimizer param groups are per level in build order, restoring G and D built the same levels
+        self.optim_G.load_state_dict(state['optim_G'])
+        self.optim_D.load_state_dict(state['optim_D'])
+        if state['scaler_G']:
+            self.scaler_G.load_state_dict(state['scaler_G'])
+            self.scaler_D.load_state_dict(state['scaler_D'])
+        if state['_d_'] is not None:
+            self._d_ = torch.as_tensor(state['_d_'], dtype=torch.float32, device=self.device)
+            self._d_max = float(state['_d_'])
+            self._copy_d_to_host()
+            # the next update of _d_ reads D's output of the previous iteration
+            self.d_real = torch.full((1,), state['d_real_mean'], device=self.device)
+        if len(state['rng']) == self.world_size:
+            self.set_rng_state(state['rng'][self.rank])
+        elif self.is_master:
+            print('Checkpoint was saved with %d ranks, not restoring the RNG states' % len(state['rng']))
+
+    def cache_ema_params(self):
+        """Matching lists of Gs and G tensors, built once per level instead of at every update."""
+        if self.Gs is not None:
+            self._ema_params = (list(self.Gs.parameters()) + list(self.Gs.buffers()),
+                                [p.detach() for p in self.G.parameters()] + list(self.G.buffers()))
+
+    def update_ema(self, it, batch_size):
+        """
+        Gs = beta * Gs + (1 - beta) * G, with beta giving a half-life of ema_halflife_kimg images.
+        With ema_every = k the update runs every k iterations with beta ** k, covering all k batches.
+        """
+        every = self.opts.get('ema_every', 1)
+        if self.Gs is None or (it + 1) % every:
+            return
+        beta = 0.5 ** (batch_size * every / (self.opts['ema_halflife_kimg'] * 1000.0))
+        ema_params, params = self._ema_params
+        torch._foreach_lerp_(ema_params, params, 1.0 - beta)
+
+    def update_checkpointing(self, batch_size, verbose=True):
+        """Choose the G and D levels recomputed during backward, by resolution or memory budget (split evenly)."""
+        resolution = self.opts.get('checkpoint_resol', 0)
+        memory_budget = self.opts.get('checkpoint_budget', 0) * 2**20 / 2
+        if resolution or memory_budget:
+            g_levels = self.G.set_checkpoint(resolution, memory_budget, batch_size)
+            d_levels = self.D.set_checkpoint(resolution, memory_budget, batch_size)
+            if self.is_master and verbose:
+                print('Gradient checkpointing: G levels %s, D levels %s' % (sorted(g_levels), sorted(d_levels)))
 
     def create_criterion(self):
         # w is for gan
@@ -97,18 +420,45 @@ class PGGAN(object):
             self.adv_criterion = lambda p, t, w: -w * (torch.mean(t * torch.log(p + 1e-8)) + torch.mean((1 - t) * torch.log(1 - p + 1e-8)))
         else:
             raise ValueError('Invalid/Unsupported GAN: %s.' % self.opts['gan'])
+        # gradient penalty of D: WGAN-GP (the default of wgan_gp), R1 or none
+        self.d_reg = self.opts.get('d_reg') or ('gp' if self.opts['gan'] == 'wgan_gp' else 'none')
+        if self.d_reg not in ['none', 'gp', 'r1']:
+            raise ValueError('Invalid/Unsupported D regularization: %s.' % self.d_reg)
 
     def compute_adv_loss(self, prediction, target, w):
-        return self.adv_criterion(prediction, target, w)
+        return self.adv_criterion(prediction.float(), float(target), w)  # criteria always in fp32
 
     def compute_additional_g_loss(self):
         return 0.0
 
     def compute_additional_d_loss(self):  # drifting loss and gradient penalty, weighting inside this function
-        return 0.0
+        loss = 0.0
+        if self.opts['gan'] == 'wgan_gp' and self.opts.get('drift', 0):
+            loss = loss + self.opts['drift'] * torch.mean(self.d_real.float() ** 2)  # keeps D's output near 0
+        if self.d_reg_inputs is not None:
+            # lazy regularization: computed every reg_every D steps, weighted reg_every times
+            x, out = self.d_reg_inputs
+            self.d_reg_inputs = None
+            norm = self.input_gradient(out, x).flatten(1).norm(dim=1)
+            if self.d_reg == 'gp':
+                target = self.opts.get('gp_target', 1.0)
+                penalty = torch.mean((norm - target) ** 2) * (self.opts.get('gp_lambda', 10.0) / target ** 2)
+            else:
+                penalty = torch.mean(norm ** 2) * (self.opts.get('r1_gamma', 10.0) / 2)
+            loss = loss + penalty * self.opts.get('reg_every', 1)
+        return loss
+
+    def input_gradient(self, out, x):
+        """Gradient of sum(out) with respect to x, with a graph for double backprop."""
+        out = out.float().sum()
+        # with fp16 loss scaling the gradient is taken through the loss scale, as a tensor so that it is not read on the host
+        scale = self.scaler_D.scale(torch.ones((), device=out.device)) if self.scaler_D.is_enabled() else None
+        grad, = torch.autograd.grad(out if scale is None else out * scale, x, create_graph=True)
+        return grad.float() if scale is None else grad.float() / scale
 
     def _get_data(self, d):
-        return d.data[0] if isinstance(d, Variable) else d
+        """Detached loss to accumulate on the device, see report()."""
+        return d.detach() if isinstance(d, torch.Tensor) else d
 
     def compute_G_loss(self):
         g_adv_loss = self.compute_adv_loss(self.d_fake, True, 1)
@@ -161,7 +511,7 @@ class PGGAN(object):
     def _numpy2var(self, x):
         var = Variable(torch.from_numpy(x))
         if self.use_cuda:
-            var = var.cuda()
+            var = var.to(self.device)
         return var
 
     def _var2numpy(self, var):
@@ -182,138 +532,294 @@ class PGGAN(object):
     #     noise = self._numpy2var(np.random.randn(*x.size()).astype(np.float32) * strength)
     #     return x + noise
 
-    def compute_noise_strength(self):
+    def compute_noise_strength(self, update=True):
         if self.opts.get('no_noise', False):
             return 0
 
-        if hasattr(self, '_d_'):
-            self._d_ = self._d_ * 0.9 + np.clip(torch.mean(self.d_real).data[0], 0.0, 1.0) * 0.1
+        # a tensor on the device, reading d_real on the host would wait for the D step every iteration
+        if not update:
+            if not hasattr(self, '_d_'):
+                return 0
+        elif hasattr(self, '_d_'):
+            d_prev = self._d_from_host()  # copied during the previous iteration
+            self._d_ = self._d_ * 0.9 + torch.mean(self.d_real.detach().float()).clamp(0.0, 1.0) * 0.1
+            self._d_max = d_prev * 0.9 + 0.1
+            self._copy_d_to_host()
         else:
-            self._d_ = 0.0
-        strength = 0.2 * max(0, self._d_ - 0.5)**2
+            self._d_ = torch.zeros((), device=self.device)
+            self._d_max = 0.0
+            self._copy_d_to_host()
+        if self._d_max <= 0.5:  # zero strength for sure, as a number GDropLayer skips drawing the noise
+            return 0
+        strength = 0.2 * torch.clamp(self._d_ - 0.5, min=0)**2
         return strength
 
+    def _copy_d_to_host(self):
+        """Start copying _d_ to the host without waiting for it, _d_from_host() reads the copy."""
+        if self._d_.device.type == 'cuda':
+            host = torch.empty((), pin_memory=True)
+            host.copy_(self._d_, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            self._d_copy = (host, event)
+        else:
+            self._d_copy = (self._d_, None)
+
+    def _d_from_host(self):
+        """_d_ of the last _copy_d_to_host(), waits for the copy if it is still running."""
+        host, event = self._d_copy
+        if event is not None:
+            event.synchronize()
+        return float(host)
+
     def preprocess(self, z, real):
         self.z = self._numpy2var(z)
         self.real = self._numpy2var(real)
 
-    def forward_G(self, cur_level):
-        self.d_fake = self.D(self.fake, cur_level=cur_level)
-
-    def forward_D(self, cur_level, detach=True):
-        self.fake = self.G(self.z, cur_level=cur_level)
-        strength = self.compute_noise_strength()
-        self.d_real = self.D(self.real, cur_level=cur_level, gdrop_strength=strength)
-        self.d_fake = self.D(self.fake.detach() if detach else self.fake, cur_level=cur_level)
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.use_amp)
+
+    def forward_G(self, cur_level, mbstat_pool=None):
+        # D's gradients of the G step would be discarded, and with DistributedDataParallel they would
+        # mark D's parameters as used in the next D step, see train_phase() for re-enabling them
+        with self.autocast():
+            self.d_fake = self.D(self.fake, cur_level=cur_level, mbstat_pool=mbstat_pool)
+
+    def forward_D(self, cur_level, detach=True, fake=None, mbstat_pools=(None, None), gdrop_strength=0):
+        """
+        D on the real batch, with noise of gdrop_strength (see compute_noise_strength()), and on fake,
+        or G's output for self.z when fake is None. On regularization steps also the inputs and outputs
+        of the gradient penalty: the real batch for R1, random interpolations of real and fake for
+        WGAN-GP, run by the same netD call for DistributedDataParallel.
+        """
+        reg = self.d_reg if self.reg_step else 'none'
+        if reg == 'r1':
+            self.real.requires_grad_(True)
+        with self.autocast():
+            self.fake = self.netG(self.z, cur_level=cur_level) if fake is None else fake
+            inputs = [self.real, self.fake.detach() if detach else self.fake]
+            kwargs = [dict(cur_level=cur_level, gdrop_strength=gdrop_strength, mbstat_pool=mbstat_pools[0]),
+                      dict(cur_level=cur_level, mbstat_pool=mbstat_pools[1])]
+            if reg == 'gp':
+                eps = torch.rand(self.real.size(0), 1, 1, 1, device=self.real.device)
+                inputs += [torch.lerp(self.fake.detach().to(self.real.dtype), self.real, eps).requires_grad_(True)]
+                kwargs += [dict(cur_level=cur_level)]
+            outputs = self.netD(inputs, kwargs)
+            self.d_real, self.d_fake = outputs[:2]
+        self.d_reg_inputs = {'none': None, 'r1': (self.real, self.d_real), 'gp': (inputs[-1], outputs[-1])}[reg]
         # print('d_real', self.d_real.view(-1))
         # print('d_fake', self.d_fake.view(-1))
         # print(self.fake[0].view(-1))
 
-    def backward_G(self):
+    def backward_G(self, step=True):
+        """Backward of the G loss, a share of the accum_steps micro-batches, and the optimizer step if step."""
         g_loss = self.compute_G_loss()
-        g_loss.backward()
-        self.optim_G.step()
+        self.scaler_G.scale(g_loss / self.accum_steps).backward()
+        if step:
+            self.scaler_G.step(self.optim_G)
+            self.scaler_G.update()
         self.g_loss = self._get_data(g_loss)
 
-    def backward_D(self, retain_graph=False):
+    def backward_D(self, retain_graph=False, step=True):
+        """Backward of the D loss, a share of the accum_steps micro-batches, and the optimizer step if step."""
         d_loss = self.compute_D_loss()
-        d_loss.backward(retain_graph=retain_graph)
-        self.optim_D.step()
+        self.scaler_D.scale(d_loss / self.accum_steps).backward(retain_graph=retain_graph)
+        if step:
+            self.scaler_D.step(self.optim_D)
+            self.scaler_D.update()
         self.d_loss = self._get_data(d_loss)
 
-    def report(self, it, num_it, phase, resol):
+    def no_sync(self, net, accumulate):
+        """While accumulating, skip the gradient all-reduce of a DistributedDataParallel net until the last micro-batch."""
+        if accumulate and isinstance(net, DistributedDataParallel):
+            return net.no_sync()
+        return contextlib.nullcontext()
+
+    def pool_mbstat(self, inputs, cur_level, **kwargs):
+        """MinibatchStatPool of D's minibatch statistics over the micro-batches in inputs, None unless --mbstat_accum."""
+        if len(inputs) == 1 or not self.opts.get('mbstat_accum', False):
+            return None
+        pool = MinibatchStatPool()
+        with torch.no_grad(), self.autocast():
+            for x in inputs:
+                self.D(x, cur_level=cur_level, mbstat_pool=pool, **kwargs)
+        pool.collecting = False
+        return pool
+
+    def _mean_losses(self, names, means, n):
+        """Add the detached losses in names divided by n to means, the running means over micro-batches."""
+        for name in names:
+            value = self._get_data(getattr(self, name)) / n
+            means[name] = means[name] + value if name in means else value
+        return means
+
+    def step_D(self, batches, cur_level):
+        """
+        One D update from the micro-batches [(z, real)] in batches, their gradients accumulated.
+        The fakes of several micro-batches are generated without gradient and kept for step_G().
+        The noise strength is updated once, from D's outputs on the real images of the previous step.
+        """
+        n = len(batches)
+        strength = self.compute_noise_strength()
+        if n == 1:  # G's forward is kept for the G step
+            self.preprocess(*batches[0])
+            self.forward_D(cur_level, detach=True, gdrop_strength=strength)
+            self.backward_D()
+            return
+        with torch.no_grad(), self.autocast():
+            self.fakes = [self.G(self._numpy2var(z), cur_level=cur_level) for z, _ in batches]
+        reals = [self._numpy2var(x) for _, x in batches]
+        pools = (self.pool_mbstat(reals, cur_level, gdrop_strength=strength), self.pool_mbstat(self.fakes, cur_level))
+        means, d_reals = {}, []
+        for i, (z, x) in enumerate(batches):
+            for pool in pools:
+                if pool is not None:
+                    pool.index = i
+            self.z, self.real = self._numpy2var(z), reals[i]
+            with self.no_sync(self.netD, i < n - 1):
+                self.forward_D(cur_level, detach=True, fake=self.fakes[i], mbstat_pools=pools, gdrop_strength=strength)
+                self.backward_D(step=i == n - 1)
+            means = self._mean_losses(['d_loss', 'd_adv_loss', 'd_add_loss', 'd_adv_loss_real', 'd_adv_loss_fake'], means, n)
+            d_reals += [self.d_real.detach()]
+        for name, value in means.items():
+            setattr(self, name, value)
+        self.d_real = torch.cat(d_reals)  # the next noise strength update reads the whole batch
+
+    def step_G(self, batches, cur_level):
+        """One G update from the latents of the micro-batches in batches, see step_D()."""
+        n = len(batches)
+        if n == 1:
+            self.forward_G(cur_level)
+            self.backward_G()
+            return
+        pool = self.pool_mbstat(self.fakes, cur_level)  # D changed in the D step
+        means = {}
+        for i, (z, _) in enumerate(batches):
+            if pool is not None:
+                pool.index = i
+            self.z = self._numpy2var(z)
+            with self.no_sync(self.netG, i < n - 1):
+                with self.autocast():
+                    self.fake = self.netG(self.z, cur_level=cur_level)
+                self.forward_G(cur_level, mbstat_pool=pool)
+                self.backward_G(step=i == n - 1)
+            means = self._mean_losses(['g_loss', 'g_adv_loss', 'g_add_loss'], means, n)
+        for name, value in means.items():
+            setattr(self, name, value)
+        self.fakes = None
+
+    def report(self, it, num_it, phase, resol, force=False):
+        """
+        Accumulate the losses of this iteration on the device. Every report_freq iterations or
+        report_secs seconds (or if force), print and log their means since the last report.
+        """
+        if not self.is_master:
+            return
+        self.losses.add({'G': self.g_loss, 'D': self.d_loss, 'G_adv': self.g_adv_loss, 'G_add': self.g_add_loss,
+                         'D_adv': self.d_adv_loss, 'D_add': self.d_add_loss,
+                         'D_adv_fake': self._get_data(self.d_adv_loss_fake), 'D_adv_real': self._get_data(self.d_adv_loss_real)})
+        report_secs = self.opts.get('report_secs', 0)
+        if not (force or self.losses.count >= self.opts.get('report_freq', 1) or
+                (report_secs and time.time() - self._report_time >= report_secs)):
+            return
+        self._report_time = time.time()
+        n_it = self.losses.count
+        losses = self.losses.means()
         formation = 'Iter[%d|%d], %s, %s, G: %.3f, D: %.3f, G_adv: %.3f, G_add: %.3f, D_adv: %.3f, D_add: %.3f'
-        values = (it, num_it, phase, resol, self.g_loss, self.d_loss, self.g_adv_loss, self.g_add_loss, self.d_adv_loss, self.d_add_loss)
-        print(formation % values)
+        values = (it, num_it, phase, resol, losses['G'], losses['D'], losses['G_adv'], losses['G_add'], losses['D_adv'], losses['D_add'])
+        print(formation % values + ('' if n_it == 1 else ' (mean of %d iterations)' % n_it))
+
+        prefix = str(resol) + '/' + phase + '/'
+        for name, value in losses.items():
+            self.logger.scalar_summary(prefix + name + '_loss', value, it)
 
-    def tensorboard(self, it, num_it, phase, resol, samples):
-        # (1) Log the scalar values
+    def tensorboard(self, it, num_it, phase, resol):
+        # (1) Log values and gradients of the parameters (histogram), the part that fits in the budget
         prefix = str(resol) + '/' + phase + '/'
-        info = {prefix + 'G_loss': self.g_loss,
-                prefix + 'G_adv_loss': self.g_adv_loss,
-                prefix + 'G_add_loss': self.g_add_loss,
-                prefix + 'D_loss': self.d_loss,
-                prefix + 'D_adv_loss': self.d_adv_loss,
-                prefix + 'D_add_loss': self.d_add_loss,
-                prefix + 'D_adv_loss_fake': self._get_data(self.d_adv_loss_fake),
-                prefix + 'D_adv_loss_real': self._get_data(self.d_adv_loss_real)}
-
-        for tag, value in info.items():
-            self.logger.scalar_summary(tag, value, it)
-
-        # (2) Log values and gradients of the parameters (histogram)
-        for tag, value in self.G.named_parameters():
-            tag = tag.replace('.', '/')
-            self.logger.histo_summary('G/' + prefix + tag, self._var2numpy(value), it)
-            if value.grad is not None:
-                self.logger.histo_summary('G/' + prefix + tag + '/grad', self._var2numpy(value.grad), it)
-
-        for tag, value in self.D.named_parameters():
-            tag = tag.replace('.', '/')
-            self.logger.histo_summary('D/' + prefix + tag, self._var2numpy(value), it)
-            if value.grad is not None:
-                self.logger.histo_summary('D/' + prefix + tag + '/grad',
-                                          self._var2numpy(value.grad), it)
-
-        # (3) Log the images
-        # info = {'images': samples[:10]}
-        # for tag, images in info.items():
-        #     logger.image_summary(tag, images, it)
-
-    def train_phase(self, R, phase, batch_size, cur_nimg, from_it, total_it):
-        assert total_it >= from_it
-        resol = 2 ** (R + 1)
-
-        for it in range(from_it, total_it):
+        named_tensors = []
+        for name, net in [('G/', self.G), ('D/', self.D)]:
+            for tag, value in net.named_parameters():
+                tag = name + prefix + tag.replace('.', '/')
+                named_tensors += [(tag, value), (tag + '/grad', value.grad)]
+        self.histograms(named_tensors, it)
+        # the sample images are logged by the sample writer
+
+    def train_phase(self, R, phase, batch_size, cur_nimg, from_it, total_it, start_it=None):
+        """Iterations from_it to total_it of a phase, starting at start_it when resuming in the middle."""
+        start_it = from_it if start_it is None else start_it
+        assert total_it >= start_it >= from_it
+        # samples, checkpoints and tags of a fade in are named after the resolution it fades in,
+        # also at its first iteration where cur_level is still R
+        resol = 2 ** (R + 1) if phase == 'stabilize' else 2 ** (R + 2)
+        # batch_size is split across ranks and accum_steps micro-batches, their gradients are accumulated
+        assert batch_size % (self.world_size * self.accum_steps) == 0, \
+            'Batch size %d does not split into %d ranks x %d micro-batches' % (batch_size, self.world_size, self.accum_steps)
+        local_batch_size = batch_size // (self.world_size * self.accum_steps)
+        self.grow_models(R if phase == 'stabilize' else R + 1)
+        self.update_checkpointing(local_batch_size)
+
+        for it in range(start_it, total_it):
             if phase == 'stabilize':
                 cur_level = R
             else:
-                cur_level = R + total_it / float(from_it)
+                cur_level = R + float(it - from_it) / (total_it - from_it)  # fade in the next level
             cur_resol = 2 ** int(np.ceil(cur_level + 1))
 
-            # get a batch noise and real images
-            z = self.noise(batch_size)
-            x = self.data(batch_size, cur_resol, cur_level)
+            # get a batch noise and real images, in micro-batches
+            batches = []
+            for _ in range(self.accum_steps):
+                z = self.noise(local_batch_size)
+                batches += [(z, self.data(local_batch_size, cur_resol, cur_level))]
 
             # ===preprocess===
-            self.preprocess(z, x)
             self.update_lr(cur_nimg)
 
             # ===update D===
             self.optim_D.zero_grad()
-            self.forward_D(cur_level, detach=True)
-            self.backward_D()
+            self.reg_step = self.d_reg != 'none' and it % self.opts.get('reg_every', 1) == 0
+            self.step_D(batches, cur_level)
 
             # ===update G===
             self.optim_G.zero_grad()
-            self.forward_G(cur_level)
-            self.backward_G()
+            self.D.requires_grad_(False)
+            self.step_G(batches, cur_level)
+            self.D.requires_grad_(True)
+            self.update_ema(it, batch_size)
 
             # ===report ===
-            self.report(it, total_it, phase, cur_resol)
+            self.report(it, total_it, phase, resol, force=it == total_it - 1)
 
             cur_nimg += batch_size
 
+            save = (it % self.opts['save_freq'] == 0 and it > 0) or it == total_it - 1
+            state = self.training_state(R, phase, it, cur_nimg) if save else None
+
             # ===generate sample images===
-            samples = []
+            if not self.is_master:
+                continue
             if (it % self.opts['sample_freq'] == 0) or it == total_it - 1:
-                samples = self.sample()
-                imsave(os.path.join(self.opts['sample_dir'],
-                                    '%dx%d-%s-%s.png' % (cur_resol, cur_resol, phase, str(it).zfill(6))), samples)
+                self.samples.write(os.path.join(self.opts['sample_dir'],
+                                                '%dx%d-%s-%s.png' % (resol, resol, phase, str(it).zfill(6))),
+                                   self.sample(cur_level), str(resol) + '/' + phase + '/samples', it)
 
             # ===tensorboard visualization===
             if (it % self.opts['sample_freq'] == 0) or it == total_it - 1:
-                self.tensorboard(it, total_it, phase, cur_resol, samples)
+                self.tensorboard(it, total_it, phase, resol)
 
             # ===save model===
-            if (it % self.opts['save_freq'] == 0 and it > 0) or it == total_it - 1:
-                self.save(os.path.join(self.opts['ckpt_dir'], '%dx%d-%s-%s' % (cur_resol, cur_resol, phase, str(it).zfill(6))))
+            if save:
+                blocked = self.save('%dx%d-%s-%s' % (resol, resol, phase, str(it).zfill(6)), state)
+                self.logger.scalar_summary(str(resol) + '/' + phase + '/checkpoint_blocked_ms', blocked * 1000, it)
 
     def train(self):
         # prepare
         self.create_optimizer()
         self.create_criterion()
         self.register_on_gpu()
+        if self.is_master:
+            self.checkpoints = CheckpointWriter(self.opts['ckpt_dir'], self.opts.get('keep_ckpts', 0))
+        if self._resume_state is not None:
+            self.load_training_state(self._resume_state)
 
         to_level = int(np.log2(self.opts['target_resol']))
         from_level = int(np.log2(self._from_resol))
@@ -323,50 +829,86 @@ class PGGAN(object):
         transition_kimg = int(self.opts['transition_kimg'] * 1000)
 
         for R in range(from_level - 1, to_level):
-            batch_size = self.bs_map[2 ** (R + 1)]
+            resumed = self.is_restored and R == from_level - 1  # keeps the batch size its iterations were counted in
+            if self.opts.get('auto_bs', False) and not resumed and 2 ** (R + 1) not in self.bs_tuned:
+                self.tune_batch_size(R, to_level)
+            batch_size = self.bs_map[2 ** (R + 1)] * self.accum_steps  # images per optimizer step
 
             phases = {'stabilize': [0, train_kimg // batch_size], 'fade_in': [train_kimg // batch_size + 1, (transition_kimg + train_kimg) // batch_size]}
-            if self.is_restored and R == from_level - 1:
-                phases[self._phase][0] = self._epoch + 1
+            if R == to_level - 1:  # no next level to fade in
+                del phases['fade_in']
+            start = {phase: _range[0] for phase, _range in phases.items()}
+            if resumed:
+                start[self._phase] = self._epoch + 1  # the fade in still blends from the start of the phase
                 if self._phase == 'fade_in':
                     del phases['stabilize']
 
             for phase in ['stabilize', 'fade_in']:
-                if phase in phases:
+                # phases shorter than a batch have no iterations, nor have phases resumed at their end
+                if phase in phases and start[phase] < phases[phase][1]:
                     _range = phases[phase]
-                    self.train_phase(R, phase, batch_size, _range[0] * batch_size, _range[0], _range[1])
-
-    def sample(self):
+                    self.train_phase(R, phase, batch_size, start[phase] * batch_size, _range[0], _range[1], start[phase])
+        if self.is_master:
+            self.checkpoints.close()
+            self.histograms.close()
+            self.samples.close()
+            self.logger.close()
+
+    def sample(self, cur_level=None):
+        """Grid of Gs (or G) samples next to the real batch, a uint8 HxWxC tensor on the device."""
+        fake = self.fake
+        if self.Gs is not None:
+            with torch.no_grad():
+                fake = self.Gs(self.z, cur_level=cur_level)
         batch_size = self.z.size(0)
-        n_row = self.rows_map[batch_size]
-        n_col = int(np.ceil(batch_size / float(n_row)))
-        samples = []
-        i = j = 0
-        for row in range(n_row):
-            one_row = []
-            # fake
-            for col in range(n_col):
-                one_row.append(self.fake[i].cpu().data.numpy())
-                i += 1
-            # real
-            for col in range(n_col):
-                one_row.append(self.real[j].cpu().data.numpy())
-                j += 1
-            samples += [np.concatenate(one_row, axis=2)]
-        samples = np.concatenate(samples, axis=1).transpose([1, 2, 0])
-
-        half = samples.shape[1] // 2
-        samples[:, :half, :] = samples[:, :half, :] - np.min(samples[:, :half, :])
-        samples[:, :half, :] = samples[:, :half, :] / np.max(samples[:, :half, :])
-        samples[:, half:, :] = samples[:, half:, :] - np.min(samples[:, half:, :])
-        samples[:, half:, :] = samples[:, half:, :] / np.max(samples[:, half:, :])
-        return samples
-
-    def save(self, file_name):
-        g_file = file_name + '-G.pth'
-        d_file = file_name + '-D.pth'
-        torch.save(self.G.state_dict(), g_file)
-        torch.save(self.D.state_dict(), d_file)
+        n_row = self.rows_map.get(batch_size) or grid_rows(batch_size)
+        return sample_grid(fake, self.real, n_row)
+
+    def save(self, which_file, state=None):
+        """
+        Queue a checkpoint for the background writer, with the training state of training_state()
+        if given. Returns the seconds training was blocked.
+        """
+        state_dicts = {'G': self.G.state_dict(), 'D': self.D.state_dict()}
+        if self.Gs is not None:
+            state_dicts['Gs'] = self.Gs.state_dict()
+        if state is not None:
+            state_dicts['state'] = state  # written last, marks a complete checkpoint for --auto_resume
+        blocked = self.checkpoints.save(which_file, state_dicts)
+        print('Checkpoint %s queued, training blocked for %.1f ms' % (which_file, blocked * 1000))
+        return blocked
+
+
+def run(rank, world_size, args, opts):
+    """Train in the process of rank `rank` out of world_size data parallel processes."""
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group('nccl' if args.gpu else 'gloo', rank=rank, world_size=world_size)
+
+    # Dimensionality of the latent vector.
+    latent_size = 512
+    # Use sigmoid activation for the last layer?
+    sigmoid_at_end = args.gan in ['lsgan', 'gan']
+    if hasattr(args, 'no_tanh'):
+        tanh_at_end = False
+    else:
+        tanh_at_end = True
+
+    torch.manual_seed(args.seed)  # same initial G and D on every rank
+    G = Generator(num_channels=3, latent_size=latent_size, resolution=args.target_resol, fmap_max=latent_size, fmap_base=8192, tanh_at_end=tanh_at_end, fused_scale=args.fused_scale, channels_last=args.channels_last, growable=args.growable)
+    # with several ranks minibatch stddev is over groups of 4 by default, the same whatever the number of ranks
+    mbstat_group_size = args.mbstat_group_size or (4 if world_size > 1 and not args.mbstat_accum else None)
+    D = Discriminator(num_channels=3, mbstat_avg=args.mbstat_avg, mbstat_group_size=mbstat_group_size, resolution=args.target_resol, fmap_max=latent_size, fmap_base=8192, sigmoid_at_end=sigmoid_at_end, fused_scale=args.fused_scale, channels_last=args.channels_last, growable=args.growable)
+    if rank == 0:
+        print(G)
+        print(D)
+    data = CelebA(rank, world_size)
+    noise = RandomNoiseGenerator(latent_size, 'gaussian')
+    np.random.seed(args.seed + rank)  # each rank draws its own latents and images
+    torch.manual_seed(args.seed + rank)
+    pggan = PGGAN(G, D, data, noise, opts)
+    pggan.train()
+    if dist.is_initialized():
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
@@ -382,38 +924,71 @@ if __name__ == '__main__':
     parser.add_argument('--fake_weight', default=0.1, type=float, help="weight of fake images' loss of D")
     parser.add_argument('--beta1', default=0, type=float, help='beta1 for adam')
     parser.add_argument('--beta2', default=0.99, type=float, help='beta2 for adam')
-    parser.add_argument('--gan', default='lsgan', type=str, help='model: lsgan/wgan_gp/gan, currently only support lsgan or gan with no_noise option.')
+    parser.add_argument('--gan', default='lsgan', type=str, help='loss: lsgan, gan or wgan_gp, the latter with the WGAN-GP gradient penalty by default (see --d_reg).')
     parser.add_argument('--first_resol', default=4, type=int, help='first resolution')
     parser.add_argument('--target_resol', default=256, type=int, help='target resolution')
-    parser.add_argument('--drift', default=1e-3, type=float, help='drift, only available for wgan_gp.')
+    parser.add_argument('--drift', default=1e-3, type=float, help='weight of the drift loss keeping D\'s output near 0, only used by wgan_gp.')
+    parser.add_argument('--d_reg', default='', type=str, help='gradient penalty of D: gp (WGAN-GP), r1 or none, empty means gp for wgan_gp and none otherwise.')
+    parser.add_argument('--gp_lambda', default=10.0, type=float, help='weight of the WGAN-GP penalty.')
+    parser.add_argument('--gp_target', default=1.0, type=float, help='gradient norm targeted by the WGAN-GP penalty.')
+    parser.add_argument('--r1_gamma', default=10.0, type=float, help='weight (gamma) of the R1 penalty.')
+    parser.add_argument('--reg_every', default=1, type=int, help='lazy regularization: compute the gradient penalty every # D steps, weighted # times.')
     parser.add_argument('--mbstat_avg', default='all', type=str, help='MinibatchStatConcatLayer averaging strategy (Which dimensions to average the statistic over?)')
+    parser.add_argument('--mbstat_group_size', default=0, type=int, help='MinibatchStatConcatLayer group size, 0 means the whole minibatch (4 with several data parallel processes).')
     parser.add_argument('--sample_freq', default=500, type=int, help='sampling frequency.')
     parser.add_argument('--save_freq', default=5000, type=int, help='save model frequency.')
+    parser.add_argument('--report_freq', default=100, type=int, help='print and log the mean losses every # iterations.')
+    parser.add_argument('--report_secs', default=0, type=float, help='also report every # seconds, 0 to only use report_freq.')
+    parser.add_argument('--histo_bins', default=1000, type=int, help='# bins of the parameter and gradient histograms.')
+    parser.add_argument('--histo_layers', default='', type=str, help='regular expression, only log histograms of matching tags (e.g. G/.*/chain), empty for all.')
+    parser.add_argument('--histo_max_tensors', default=0, type=int, help='most histograms logged every sample_freq, the next ones are logged next time, 0 for no limit.')
+    parser.add_argument('--histo_budget_ms', default=50, type=float, help='training time spent on histograms every sample_freq, the rest is logged next time, 0 for no limit.')
+    parser.add_argument('--keep_ckpts', default=5, type=int, help='keep the # latest checkpoints plus the latest of each resolution and phase, 0 keeps all.')
     parser.add_argument('--exp_dir', default='./exp', type=str, help='experiment dir.')
     parser.add_argument('--no_noise', action='store_true', help='do not add noise to real data.')
     parser.add_argument('--no_tanh', action='store_true', help='do not use tanh in the last layer of the generator.')
     parser.add_argument('--restore_dir', default='', type=str, help='restore from which exp dir.')
+    parser.add_argument('--auto_resume', action='store_true', help='resume from the newest full training state in exp_dir, unless restore_dir is set.')
     parser.add_argument('--which_file', default='', type=str, help='restore from which file, e.g. 128x128-fade_in-105000.')
+    parser.add_argument('--auto_bs', action='store_true', help='choose the batch size of each resolution by probing memory use when training reaches it.')
+    parser.add_argument('--bs_memory_budget', default=0, type=float, help='memory (MB) a training iteration may use for --auto_bs, 0 means bs_memory_fraction of the gpu memory.')
+    parser.add_argument('--bs_memory_fraction', default=0.9, type=float, help='fraction of the gpu memory used by --auto_bs without bs_memory_budget.')
+    parser.add_argument('--bs_max', default=64, type=int, help='largest batch size chosen by --auto_bs.')
+    parser.add_argument('--accum_steps', default=1, type=int, help='accumulate the gradients of # micro-batches (of the batch size map) per optimizer step.')
+    parser.add_argument('--mbstat_accum', action='store_true', help='with accum_steps, minibatch statistics over all accumulated micro-batches of each rank (without mbstat_group_size).')
+    parser.add_argument('--amp', action='store_true', help='use automatic mixed precision.')
+    parser.add_argument('--growable', action='store_true', help='build the blocks of each level only when training reaches it.')
+    parser.add_argument('--checkpoint_resol', default=0, type=int, help='recompute activations of levels at this resolution and above in backward, 0 to disable.')
+    parser.add_argument('--checkpoint_budget', default=0, type=float, help='otherwise recompute the largest levels until stored activations fit this budget (MB).')
+    parser.add_argument('--fused_scale', action='store_true', help='use fused upsample + conv and conv + downsample blocks at resolution 128 and above. G computes the same function, D does not: it pools before the activation.')
+    parser.add_argument('--channels_last', action='store_true', help='run G and D in NHWC (channels_last) memory format.')
+    parser.add_argument('--ema_halflife_kimg', default=0, type=float, help='half-life (kimg) of the moving average of G used for samples and saved as -Gs.pth, e.g. 10; 0 (default) disables it.')
+    parser.add_argument('--ema_every', default=1, type=int, help='update the moving average of G every # iterations.')
+    parser.add_argument('--world_size', default=0, type=int, help='# data parallel processes, 0 means one per gpu in --gpu (one on cpu). torchrun launches are detected.')
+    parser.add_argument('--dist_port', default=29500, type=int, help='port of the rank 0 process for data parallel training.')
+    parser.add_argument('--seed', default=0, type=int, help='random seed, rank r uses seed + r.')
+    parser.add_argument('--amp_dtype', default='float16', type=str, help='autocast dtype: float16 (with loss scaling) or bfloat16, use bfloat16 on cpu.')
 
     # TODO: support conditional inputs
 
     args = parser.parse_args()
     opts = {k: v for k, v in args._get_kwargs()}
+    if args.auto_resume and not args.restore_dir:
+        found = find_resume(args.exp_dir)
+        if found is not None:
+            opts['restore_dir'], opts['which_file'] = found
+        else:
+            print('No training state to resume in %s, starting from scratch' % args.exp_dir)
 
-    # Dimensionality of the latent vector.
-    latent_size = 512
-    # Use sigmoid activation for the last layer?
-    sigmoid_at_end = args.gan in ['lsgan', 'gan']
-    if hasattr(args, 'no_tanh'):
-        tanh_at_end = False
+    if 'WORLD_SIZE' in os.environ:  # launched by torchrun
+        dist.init_process_group('nccl' if args.gpu else 'gloo')
+        run(dist.get_rank(), dist.get_world_size(), args, opts)
     else:
-        tanh_at_end = True
-
-    G = Generator(num_channels=3, latent_size=latent_size, resolution=args.target_resol, fmap_max=latent_size, fmap_base=8192, tanh_at_end=tanh_at_end)
-    D = Discriminator(num_channels=3, mbstat_avg=args.mbstat_avg, resolution=args.target_resol, fmap_max=latent_size, fmap_base=8192, sigmoid_at_end=sigmoid_at_end)
-    print(G)
-    print(D)
-    data = CelebA()
-    noise = RandomNoiseGenerator(latent_size, 'gaussian')
-    pggan = PGGAN(G, D, data, noise, opts)
-    pggan.train()
+        world_size = args.world_size or max(1, len([g for g in args.gpu.split(',') if g]))
+        if world_size > 1:
+            os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+            os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+            os.environ.setdefault('MASTER_PORT', str(args.dist_port))
+            mp.spawn(run, args=(world_size, args, opts), nprocs=world_size)
+        else:
+            run(0, 1, args, opts)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Batch size auto-tuning: the largest batch size whose training step fits a memory budget,
+found by running the step at increasing batch sizes. Peak memory is measured by the allocator
+on cuda; on other devices (or to simulate a smaller device) it is estimated from the tensors
+the model keeps and the tensors autograd saves during the step.
+"""
+import torch
+from models.base_model import saved_tensor_bytes
+
+
+def tensor_bytes(tensors):
+    """Bytes of the distinct storages of tensors (None entries are skipped)."""
+    storages = {}
+    for t in tensors:
+        if t is not None:
+            storage = t.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+def measure_peak(steps, device, kept_tensors):
+    """
+    Peak memory (bytes) of running the functions in steps, float('inf') when they run out of memory.
+    cuda: the allocator's peak. Otherwise an upper bound: the bytes of kept_tensors() after the
+    steps (weights, gradients, optimizer states) plus everything autograd saved during the steps.
+    """
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        try:
+            for step in steps:
+                step()
+            torch.cuda.synchronize(device)
+        except torch.cuda.OutOfMemoryError:
+            return float('inf')
+        finally:
+            torch.cuda.empty_cache()
+        return torch.cuda.max_memory_allocated(device)
+    saved = sum(saved_tensor_bytes(step)[0] for step in steps)
+    return tensor_bytes(kept_tensors()) + saved
+
+
+def largest_batch_size(probe, memory_budget, candidates):
+    """
+    Largest of the increasing candidates with probe(batch_size) <= memory_budget, stopping at the
+    first one over budget. Returns (batch size or None, {batch size: probed bytes}).
+    """
+    best, probed = None, {}
+    for batch_size in candidates:
+        probed[batch_size] = probe(batch_size)
+        if probed[batch_size] > memory_budget:
+            break
+        best = batch_size
+    return best, probed
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Background checkpoint writer. The training thread only copies the state dicts to host memory,
+serialization and disk writes happen on a writer thread. Every file is written to a temporary
+name and renamed, so a crash never leaves a truncated checkpoint behind.
+"""
+import glob
+import os
+import threading
+import time
+from queue import Queue
+import torch
+from utils.sampling import CKPT_PATTERN, parse_ckpt_name
+
+
+def snapshot(obj):
+    """Host memory copy of (nested) state dicts, safe to serialize while training updates the originals."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        result = obj.__class__((k, snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):  # module state dict versions
+            result._metadata = obj._metadata
+        return result
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """torch.save to path.tmp, then rename it to path."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def ckpt_order(name):
+    """Sort key of checkpoint names in training order, fade_in of a resolution comes before its stabilize."""
+    resol, phase, it = parse_ckpt_name(name)
+    return resol, {'fade_in': 0, 'stabilize': 1}[phase], it
+
+
+def find_resume(exp_dir):
+    """
+    (restore_dir, which_file) of the newest full training state (-state.pth) in the experiments
+    of exp_dir that has its G and D and loads, None if there is none.
+    """
+    files = sorted(glob.glob(os.path.join(exp_dir, '*', 'ckpts', '*-state.pth')), key=os.path.getmtime, reverse=True)
+    for f in files:
+        ckpt_dir, name = os.path.dirname(f), os.path.basename(f)[:-len('-state.pth')]
+        if not CKPT_PATTERN.match(name):
+            continue
+        if not all(os.path.exists(os.path.join(ckpt_dir, '%s-%s.pth' % (name, s))) for s in ['G', 'D']):
+            continue
+        try:
+            torch.load(f, map_location='cpu', weights_only=False)
+        except Exception:
+            continue
+        return os.path.dirname(ckpt_dir), name
+    return None
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints (name-<suffix>.pth for each state dict) in ckpt_dir on a single writer thread,
+    in the order of the state dicts so that the last file marks a complete checkpoint.
+    After each write only the keep_last latest checkpoints are kept, plus the latest of every
+    resolution and phase; keep_last=0 keeps everything. At most one save is queued while another
+    is being written, further saves block the training thread until the writer catches up.
+    """
+    def __init__(self, ckpt_dir, keep_last=0):
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self.queue = Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, name, state_dicts):
+        """Queue state_dicts ({suffix: state dict}) for writing, returns the seconds training was blocked."""
+        self.check()
+        start = time.time()
+        item = (name, {suffix: snapshot(sd) for suffix, sd in state_dicts.items()})
+        self.queue.put(item)
+        return time.time() - start
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is not None and self.error is None:
+                    name, state_dicts = item
+                    for suffix, sd in state_dicts.items():
+                        atomic_save(sd, os.path.join(self.ckpt_dir, '%s-%s.pth' % (name, suffix)))
+                    self.prune()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if item is None:
+                return
+
+    def prune(self):
+        if self.keep_last <= 0:
+            return
+        files = glob.glob(os.path.join(self.ckpt_dir, '*.pth'))
+        names = set(os.path.basename(f).rsplit('-', 1)[0] for f in files)
+        names = sorted([n for n in names if CKPT_PATTERN.match(n)], key=ckpt_order)
+        keep = set(names[-self.keep_last:])
+        latest = {}
+        for n in names:
+            resol, phase, _ = parse_ckpt_name(n)
+            latest[(resol, phase)] = n
+        keep.update(latest.values())
+        for f in files:
+            name = os.path.basename(f).rsplit('-', 1)[0]
+            if CKPT_PATTERN.match(name) and name not in keep:
+                os.remove(f)
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError('Writing a checkpoint failed: %s' % self.error)
+
+    def close(self):
+        """Wait for the queued checkpoints to be written and stop the writer thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
@@ -3,6 +3,7 @@ import os, scipy.misc
 from glob import glob
 import numpy as np 
 import h5py
+from utils.images import to_png
 
 
 #prefix = 'C:\\Users\\yuan\\Downloads'
@@ -52,7 +53,7 @@ def get_img(img_path, is_crop=True, crop_h=256, resize_h=64, normalize=False):
 
 
 class CelebA():
-    def __init__(self):
+    def __init__(self, rank=0, world_size=1):
         datapath = 'celeba-hq-1024x1024.h5'
         resolution = ['data2x2', 'data4x4', 'data8x8', 'data16x16', 'data32x32', 'data64x64', \
                         'data128x128', 'data256x256', 'data512x512', 'data1024x1024']
@@ -60,10 +61,12 @@ class CelebA():
         self.dataset = h5py.File(os.path.join(prefix, datapath), 'r')
         self._len = {k:len(self.dataset[k]) for k in resolution}
         assert all([resol in self.dataset.keys() for resol in resolution])
+        self.rank, self.world_size = rank, world_size  # data parallel training: images rank, rank + world_size, ...
 
     def __call__(self, batch_size, size, level=None):
         key = self._base_key + '{}x{}'.format(size, size)
-        idx = np.random.randint(self._len[key], size=batch_size)
+        shard_len = (self._len[key] - self.rank + self.world_size - 1) // self.world_size
+        idx = self.rank + self.world_size * np.random.randint(shard_len, size=batch_size)
         batch_x = np.array([self.dataset[key][i]/127.5-1.0 for i in idx], dtype=np.float32)
         if level is not None:
             if level != int(level):
@@ -76,13 +79,11 @@ class CelebA():
     def save_imgs(self, samples, file_name):
         N_samples, channel, height, width = samples.shape
         N_row = N_col = int(np.ceil(N_samples**0.5))
-        combined_imgs = np.ones((channel, N_row*height, N_col*width))
-        for i in range(N_row):
-            for j in range(N_col):
-                if i*N_col+j < samples.shape[0]:
-                    combined_imgs[:,i*height:(i+1)*height, j*width:(j+1)*width] = samples[i*N_col+j]
-        combined_imgs = np.transpose(combined_imgs, [1, 2, 0])
-        scipy.misc.imsave(file_name+'.png', combined_imgs)
+        padding = np.ones((N_row*N_col-N_samples, channel, height, width), dtype=samples.dtype)
+        combined_imgs = np.concatenate([samples, padding]).reshape(N_row, N_col, channel, height, width)
+        combined_imgs = combined_imgs.transpose([0, 3, 1, 4, 2]).reshape(N_row*height, N_col*width, channel)
+        with open(file_name+'.png', 'wb') as f:
+            f.write(to_png(combined_imgs))
 
 
 class RandomNoiseGenerator():
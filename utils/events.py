@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+TensorBoard event files without TensorFlow: the few protobuf messages the Logger needs
+(Event, Summary, HistogramProto, Summary.Image) encoded by hand, written as TFRecords
+(length, masked crc32c of the length, data, masked crc32c of the data) by a background thread.
+"""
+import atexit
+import os
+import socket
+import struct
+import threading
+import time
+from queue import Queue
+import numpy as np
+
+try:
+    from crc32c import crc32c  # optional C implementation
+except ImportError:
+    crc32c = None
+
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+_CRC32C_TABLE_NP = np.array(_CRC32C_TABLE, dtype=np.uint32)
+
+
+def _gf2_apply(matrix, v):
+    """Product of a 32x32 GF(2) matrix (its 32 columns as ints) and the bit vector v."""
+    result, b = 0, 0
+    while v:
+        if v & 1:
+            result ^= matrix[b]
+        v >>= 1
+        b += 1
+    return result
+
+
+def _zero_bytes_matrices():
+    """Matrices of the crc state update over 2**i zero bytes, for i < 64."""
+    one = [_CRC32C_TABLE[(1 << b) & 0xFF] ^ ((1 << b) >> 8) for b in range(32)]
+    matrices = [one]
+    for _ in range(63):
+        m = matrices[-1]
+        matrices.append([_gf2_apply(m, c) for c in m])
+    return matrices
+
+
+_ZERO_BYTES = _zero_bytes_matrices()
+
+
+def _zero_bytes_matrix(n):
+    """Matrix of the crc state update over n zero bytes."""
+    matrix = [1 << b for b in range(32)]
+    i = 0
+    while n:
+        if n & 1:
+            matrix = [_gf2_apply(_ZERO_BYTES[i], c) for c in matrix]
+        n >>= 1
+        i += 1
+    return matrix
+
+
+def _crc32c(data):
+    if crc32c is not None:
+        return crc32c(data)
+    n = len(data)
+    if n < 4096:
+        crc = 0xFFFFFFFF
+        table = _CRC32C_TABLE
+        for b in bytearray(data):
+            crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+        return crc ^ 0xFFFFFFFF
+    # the crc is linear: run it on K rows of L bytes at once with numpy from a zero state (leading
+    # zero bytes keep it zero, so the data is padded in front), then combine the rows and the
+    # initial state through the matrices of the update over zero bytes
+    L = int(np.sqrt(n))
+    K = -(-n // L)
+    rows = np.frombuffer(bytes(K * L - n) + bytes(data), dtype=np.uint8).reshape(K, L).T.copy()
+    state = np.zeros(K, dtype=np.uint32)
+    for row in rows:
+        state = _CRC32C_TABLE_NP[(state ^ row) & 0xFF] ^ (state >> 8)
+    shift = _zero_bytes_matrix(L)
+    crc = 0
+    for s in state.tolist():
+        crc = _gf2_apply(shift, crc) ^ s
+    return crc ^ _gf2_apply(_zero_bytes_matrix(n), 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    crc = _crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def record(data):
+    """data framed as a TFRecord."""
+    header = struct.pack('<Q', len(data))
+    return header + struct.pack('<I', masked_crc32c(header)) + data + struct.pack('<I', masked_crc32c(data))
+
+
+# protobuf wire format, only the field types used below
+def _varint(n):
+    out = bytearray()
+    n &= 0xFFFFFFFFFFFFFFFF  # negative int64 as two's complement
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _key(field, wire_type):
+    return _varint(field << 3 | wire_type)
+
+
+def _int(field, n):
+    return _key(field, 0) + _varint(n)
+
+
+def _double(field, x):
+    return _key(field, 1) + struct.pack('<d', x)
+
+
+def _float(field, x):
+    return _key(field, 5) + struct.pack('<f', x)
+
+
+def _bytes(field, data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return _key(field, 2) + _varint(len(data)) + data
+
+
+def _packed_doubles(field, values):
+    return _bytes(field, struct.pack('<%dd' % len(values), *values))
+
+
+def event(step, wall_time=None, summary=None, file_version=None):
+    """Serialized Event with a Summary (bytes from summary()) or a file_version."""
+    data = _double(1, time.time() if wall_time is None else wall_time) + _int(2, step)
+    if file_version is not None:
+        data += _bytes(3, file_version)
+    if summary is not None:
+        data += _bytes(5, summary)
+    return data
+
+
+def summary(values):
+    """Serialized Summary of serialized Summary.Value messages."""
+    return b''.join(_bytes(1, v) for v in values)
+
+
+def scalar_value(tag, value):
+    return _bytes(1, tag) + _float(2, value)
+
+
+def image_value(tag, png, height, width, colorspace):
+    image = _int(1, height) + _int(2, width) + _int(3, colorspace) + _bytes(4, png)
+    return _bytes(1, tag) + _bytes(4, image)
+
+
+def histogram_value(tag, min_value, max_value, num, sum_values, sum_squares, bucket_limit, bucket):
+    histo = (_double(1, min_value) + _double(2, max_value) + _double(3, num) + _double(4, sum_values) +
+             _double(5, sum_squares) + _packed_doubles(6, bucket_limit) + _packed_doubles(7, bucket))
+    return _bytes(1, tag) + _bytes(5, histo)
+
+
+class EventFileWriter(object):
+    """
+    Appends events to log_dir/events.out.tfevents.<time>.<host> from a background thread.
+    Events are buffered by the file and flushed every flush_secs, or on flush().
+    """
+    def __init__(self, log_dir, flush_secs=10):
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        self.path = os.path.join(log_dir, 'events.out.tfevents.%010d.%s' % (time.time(), socket.gethostname()))
+        self.flush_secs = flush_secs
+        self.queue = Queue()
+        self.file = open(self.path, 'wb')
+        self.file.write(record(event(0, file_version='brain.Event:2')))
+        self.file.flush()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add(self, make_event):
+        """Queue make_event(), called on the writer thread, returning a serialized Event."""
+        self.queue.put(make_event)
+
+    def flush(self):
+        self.queue.put('flush')
+
+    def run(self):
+        last_flush = time.time()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if item == 'flush' or time.time() - last_flush > self.flush_secs:
+                self.file.flush()
+                last_flush = time.time()
+            if item != 'flush':
+                try:
+                    self.file.write(record(item()))
+                except Exception as e:  # a bad summary must not stop the logging
+                    print('Event not written: %s' % e)
+        self.file.close()
+
+    def close(self):
+        """Write the queued events and close the file."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Budgeted parameter / gradient histograms for tensorboard. Histograms are computed on the
+tensors' device with torch.histc, a call only covers as many tensors as fit in its time budget
+and the next call continues where it stopped, so every layer is logged in turn. Copies to the
+host, summaries and the (single) flush per call happen on a background thread.
+"""
+import re
+import threading
+import time
+from queue import Queue
+import numpy as np
+import torch
+
+
+def histogram_stats(x, bins):
+    """
+    Float tensor [min, max, sum, sum of squares, counts of the `bins` equal bins between min and
+    max], without synchronizing with the device.
+    """
+    x = x.detach().float().flatten()
+    lo, hi = x.min(), x.max()
+    # histc needs python bounds, normalize to [0, 1] instead of reading min and max on the host
+    counts = torch.histc((x - lo) / (hi - lo).clamp_min(1e-12), bins=bins, min=0, max=1)
+    return torch.cat([torch.stack([lo, hi, x.sum(), (x * x).sum()]), counts])
+
+
+class HistogramSampler(object):
+    """
+    Logs histograms of named tensors to logger (see Logger.add_histogram).
+    - pattern: regular expression on the tags, only matching tensors are logged (None for all)
+    - max_tensors: most tensors per call, 0 for no limit
+    - budget_ms: training thread time per call, the tensor over budget is the last one (0 for no limit)
+    """
+    def __init__(self, logger, bins=1000, pattern=None, max_tensors=0, budget_ms=0):
+        self.logger = logger
+        self.bins = bins
+        self.pattern = re.compile(pattern) if pattern else None
+        self.max_tensors = max_tensors
+        self.budget = budget_ms / 1000.0
+        self.next_tag = None  # rotation: the first tag of the next call
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, named_tensors, step):
+        """Queue histograms of some of named_tensors ([(tag, tensor)] in a stable order), returns their tags."""
+        start = time.time()
+        named_tensors = [(tag, t) for tag, t in named_tensors
+                         if t is not None and t.numel() > 0 and (self.pattern is None or self.pattern.search(tag))]
+        if not named_tensors:
+            return []
+        tags = [tag for tag, _ in named_tensors]
+        first = tags.index(self.next_tag) if self.next_tag in tags else 0
+        named_tensors = named_tensors[first:] + named_tensors[:first]
+        if self.max_tensors:
+            named_tensors = named_tensors[:self.max_tensors]
+        batch = []
+        with torch.no_grad():
+            for tag, t in named_tensors:
+                batch += [(tag, t.numel(), histogram_stats(t, self.bins))]
+                if self.budget and time.time() - start > self.budget:
+                    break
+        self.next_tag = tags[(first + len(batch)) % len(tags)]
+        self.queue.put((step, batch))
+        return [tag for tag, _, _ in batch]
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            step, batch = item
+            for tag, num, stats in batch:
+                stats = stats.cpu().double().numpy()
+                lo, hi, total, squares = stats[:4]
+                counts = stats[4:]
+                self.logger.add_histogram(tag, counts, np.linspace(lo, hi, len(counts) + 1), float(lo), float(hi),
+                                          num, float(total), float(squares), step)
+            self.logger.flush()
+            self.queue.task_done()
+
+    def close(self):
+        """Write the queued histograms and stop the background thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Sample grids. The grid is assembled on the images' device with one reshape and permute and
+converted to uint8 there, copied to the host once, and the PNG file and the tensorboard image
+are written from the one encoding on a background thread.
+"""
+import io
+import os
+import threading
+from queue import Queue
+import numpy as np
+import PIL.Image
+import torch
+
+
+def to_png(img):
+    """PNG bytes of an HxW or HxWxC image, float images are scaled from their min and max to [0, 255]."""
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        img = img.astype(np.float64)
+        low, high = img.min(), img.max()
+        img = ((img - low) / max(high - low, 1e-12) * 255 + 0.5).astype(np.uint8)
+    if img.ndim == 3 and img.shape[2] == 1:
+        img = img[:, :, 0]
+    s = io.BytesIO()
+    PIL.Image.fromarray(img).save(s, format='png')
+    return s.getvalue()
+
+
+def grid_rows(n):
+    """Rows of the fake | real grid of n images each: the divisor of n closest to a square grid, sqrt(2n)."""
+    return min((r for r in range(1, n + 1) if n % r == 0), key=lambda r: abs(r - np.sqrt(2 * n)))
+
+
+def to_uint8(x):
+    """x scaled from its min and max to [0, 255], on its device."""
+    x = x.detach().float()
+    lo, hi = x.min(), x.max()
+    return ((x - lo) / (hi - lo).clamp_min(1e-12) * 255 + 0.5).to(torch.uint8)
+
+
+def sample_grid(fake, real, rows):
+    """
+    HxWxC uint8 tensor on the device of fake: `rows` rows of fakes followed by as many reals,
+    both NCHW batches of the same size and each half scaled separately.
+    """
+    n, c, h, w = fake.shape
+    assert real.shape == fake.shape and n % rows == 0
+    cols = n // rows
+    halves = torch.stack([to_uint8(fake), to_uint8(real)])  # 2 x n x C x H x W
+    grid = halves.view(2, rows, cols, c, h, w).permute(1, 4, 0, 2, 5, 3)  # rows x H x 2 x cols x W x C
+    return grid.reshape(rows * h, 2 * cols * w, c)
+
+
+class SampleWriter(object):
+    """
+    Writes sample grids (uint8 HxWxC tensors, on any device) as PNG files and, if logger is given,
+    as tensorboard images, on a background thread.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, path, grid, tag=None, step=0):
+        """Queue grid for path (and the tensorboard image tag at step)."""
+        self.queue.put((path, grid, tag, step))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, grid, tag, step = item
+            try:
+                img = grid.cpu().numpy()
+                png = to_png(img)
+                tmp = path + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(png)
+                os.replace(tmp, path)
+                if self.logger is not None and tag is not None:
+                    self.logger.add_image(tag, png, img.shape[0], img.shape[1], img.shape[2], step)
+                    self.logger.flush()
+            except Exception as e:  # a failed sample must not stop the training
+                print('Sample %s not written: %s' % (path, e))
+
+    def close(self):
+        """Write the queued samples and stop the background thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
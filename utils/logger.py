@@ -1,76 +1,58 @@
 # -*- coding: utf-8 -*-
 """
 Reference : https://github.com/SherlockLiao/pytorch-beginner/tree/master/04-Convolutional%20Neural%20Network
+Summaries are written by utils/events.py, TensorBoard reads them without TensorFlow installed.
 """
-import tensorflow as tf
 import numpy as np
-import scipy.misc
-try:
-    from StringIO import StringIO  # Python 2.7
-except ImportError:
-    from io import BytesIO         # Python 3.x
+from utils import events
+from utils.images import to_png
 
 
 class Logger(object):
 
     def __init__(self, log_dir):
         """Create a summary writer logging to log_dir."""
-        self.writer = tf.summary.FileWriter(log_dir)
+        self.writer = events.EventFileWriter(log_dir)
 
     def scalar_summary(self, tag, value, step):
         """Log a scalar variable."""
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag,
-                                                     simple_value=value)])
-        self.writer.add_summary(summary, step)
+        value = float(value)
+        self.writer.add(lambda: events.event(step, summary=events.summary([events.scalar_value(tag, value)])))
 
     def image_summary(self, tag, images, step):
         """Log a list of images."""
+        images = [np.array(img) for img in images]  # copies, encoded on the writer thread
 
-        img_summaries = []
-        for i, img in enumerate(images):
-            # Write the image to a string
-            try:
-                s = StringIO()
-            except:
-                s = BytesIO()
-            scipy.misc.toimage(img).save(s, format="png")
+        def make_event():
+            values = []
+            for i, img in enumerate(images):
+                colorspace = 1 if img.ndim == 2 else img.shape[2]
+                values.append(events.image_value('%s/%d' % (tag, i), to_png(img), img.shape[0], img.shape[1], colorspace))
+            return events.event(step, summary=events.summary(values))
+        self.writer.add(make_event)
 
-            # Create an Image object
-            img_sum = tf.Summary.Image(encoded_image_string=s.getvalue(),
-                                       height=img.shape[0],
-                                       width=img.shape[1])
-            # Create a Summary value
-            img_summaries.append(
-                tf.Summary.Value(tag='%s/%d' % (tag, i), image=img_sum))
-
-        # Create and write Summary
-        summary = tf.Summary(value=img_summaries)
-        self.writer.add_summary(summary, step)
+    def add_image(self, tag, png, height, width, colorspace, step):
+        """Log an image already encoded as PNG."""
+        self.writer.add(lambda: events.event(step, summary=events.summary([events.image_value(
+            tag, png, height, width, colorspace)])))
 
     def histo_summary(self, tag, values, step, bins=1000):
-        """Log a histogram of the tensor of values."""
+        """Log a histogram of the tensor of values, computed with numpy."""
 
         # Create a histogram using numpy
         counts, bin_edges = np.histogram(values, bins=bins)
+        self.add_histogram(tag, counts, bin_edges, float(np.min(values)), float(np.max(values)),
+                           int(np.prod(values.shape)), float(np.sum(values)), float(np.sum(values**2)), step)
 
-        # Fill the fields of the histogram proto
-        hist = tf.HistogramProto()
-        hist.min = float(np.min(values))
-        hist.max = float(np.max(values))
-        hist.num = int(np.prod(values.shape))
-        hist.sum = float(np.sum(values))
-        hist.sum_squares = float(np.sum(values**2))
-
+    def add_histogram(self, tag, counts, bin_edges, min_value, max_value, num, sum_values, sum_squares, step):
+        """Log a histogram already computed, len(bin_edges) == len(counts) + 1. Not flushed, see flush()."""
         # Drop the start of the first bin
-        bin_edges = bin_edges[1:]
+        bucket_limit, bucket = np.asarray(bin_edges[1:], np.float64), np.asarray(counts, np.float64)
+        self.writer.add(lambda: events.event(step, summary=events.summary([events.histogram_value(
+            tag, min_value, max_value, num, sum_values, sum_squares, bucket_limit.tolist(), bucket.tolist())])))
 
-        # Add bin edges and counts
-        for edge in bin_edges:
-            hist.bucket_limit.append(edge)
-        for c in counts:
-            hist.bucket.append(c)
-
-        # Create and write Summary
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, histo=hist)])
-        self.writer.add_summary(summary, step)
+    def flush(self):
         self.writer.flush()
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to generate images from trained generators outside of the PGGAN trainer.
+"""
+import ast
+import glob
+import os
+import re
+import numpy as np
+import torch
+
+CKPT_PATTERN = re.compile(r'^(\d+)x(\d+)-(stabilize|fade_in)-(\d+)$')  # e.g. 128x128-fade_in-105000
+
+
+def parse_ckpt_name(which_file):
+    """(resolution, phase, iteration) of a checkpoint name such as 128x128-fade_in-105000."""
+    m = CKPT_PATTERN.match(which_file)
+    assert m is not None, 'Not a checkpoint name: %s' % which_file
+    return int(m.group(1)), m.group(3), int(m.group(4))
+
+
+def find_ckpts(ckpt_dir):
+    """Checkpoint names in ckpt_dir with a generator, from the earliest to the latest in training."""
+    names = [os.path.basename(f)[:-len('-G.pth')] for f in glob.glob(os.path.join(ckpt_dir, '*-G.pth'))]
+    names = [n for n in names if CKPT_PATTERN.match(n)]
+    order = {'stabilize': 0, 'fade_in': 1}
+    key = lambda n: (lambda resol, phase, it: (resol, -order[phase], it))(*parse_ckpt_name(n))
+    return sorted(names, key=key)
+
+
+def generator_path(ckpt_dir, which_file, ema=True):
+    """The moving average generator (-Gs.pth) of a checkpoint if it was saved and ema is set, else -G.pth."""
+    path = os.path.join(ckpt_dir, which_file + '-Gs.pth')
+    if ema and os.path.exists(path):
+        return path
+    return os.path.join(ckpt_dir, which_file + '-G.pth')
+
+
+def read_options(exp_dir):
+    """The options train.py recorded in exp_dir (its latest options_*.txt), {} if there is none."""
+    files = sorted(glob.glob(os.path.join(exp_dir, 'options_*.txt')))
+    opts = {}
+    if files:
+        with open(files[-1]) as f:
+            for line in f:
+                k, _, v = line.rstrip('\n').partition(': ')
+                try:
+                    opts[k] = ast.literal_eval(v)
+                except (ValueError, SyntaxError):
+                    opts[k] = v
+    return opts
+
+
+def ckpt_level(which_file, opts=None):
+    """
+    Generator cur_level a checkpoint was saved at. Fade-in checkpoints are named after the
+    resolution being faded in, their exact blend needs train_kimg, transition_kimg, the
+    batch size map and accum_steps from the training options, without them the new level is used as is.
+    """
+    resol, phase, it = parse_ckpt_name(which_file)
+    R = int(np.log2(resol))
+    opts = opts or {}
+    if phase == 'stabilize' or not all(k in opts for k in ['train_kimg', 'transition_kimg', 'batch_size_map']):
+        return R - 1
+    batch_size = opts['batch_size_map'][2 ** (R - 1)] * opts.get('accum_steps', 1)  # same arithmetic as PGGAN.train
+    train_kimg = int(opts['train_kimg'] * 1000)
+    transition_kimg = int(opts['transition_kimg'] * 1000)
+    from_it, total_it = train_kimg // batch_size + 1, (transition_kimg + train_kimg) // batch_size
+    return R - 2 + min(max(float(it - from_it) / (total_it - from_it), 0.0), 1.0)
+
+
+def latents(seeds, latent_size):
+    """One gaussian latent per seed, so that an image only depends on its own seed and not on its batch."""
+    return np.stack([np.random.RandomState(seed).randn(latent_size) for seed in seeds]).astype(np.float32)
+
+
+def to_uint8(images):
+    """NCHW images in [-1, 1] to NHWC uint8, on the device of the images."""
+    images = (images.float() + 1) * 127.5
+    return images.clamp_(0, 255).round_().to(torch.uint8).permute(0, 2, 3, 1)
+
+
+def activation_bytes_per_sample(net, *args, **kwargs):
+    """
+    Peak activation bytes of a no_grad forward net(*args, **kwargs) with a batch of one: the
+    largest input plus output of any layer, measured with forward hooks on the leaf modules.
+    """
+    peak = [0]
+
+    def hook(module, inputs, output):
+        nbytes = sum(x.numel() * x.element_size() for x in list(inputs) + [output] if isinstance(x, torch.Tensor))
+        peak[0] = max(peak[0], nbytes)
+
+    handles = [m.register_forward_hook(hook) for m in net.modules() if not list(m.children())]
+    try:
+        with torch.no_grad():
+            net(*args, **kwargs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return peak[0]
+
+
+def batch_size_for_budget(G, level, memory_budget, max_batch_size=1024):
+    """Largest batch size whose activations fit memory_budget bytes when generating at level."""
+    p = next(G.parameters())
+    z = torch.zeros(1, G._latent_size, device=p.device, dtype=p.dtype)
+    per_sample = activation_bytes_per_sample(G, z, cur_level=level)
+    return int(max(1, min(max_batch_size, memory_budget // per_sample)))